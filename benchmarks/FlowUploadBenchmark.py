@@ -0,0 +1,64 @@
+# Benchmark for uploading flow intervals to a local stub server
+# Reports the number of requests and the bytes sent for single uploads, batch uploads and compressed batch uploads
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+from SprinklerConfig import config
+
+config['FORCE_DUMMY_GPIO'] = True
+config['PRODUCT_KEY'] = 'benchmark-key'
+config['FLOW_SENSOR_PIN'] = 38
+
+from FlowSensorControl import FlowSensor
+from StubServer import StubServer
+
+NUM_INTERVALS = 600
+BATCH_SIZE = 30
+# Upload mode and compression of each scenario
+SCENARIOS = [
+    ('single', None),
+    ('batch', None),
+    ('batch', 'gzip')
+]
+
+
+# Runs NUM_INTERVALS save flow processes with some pulses each and measures what has been sent to the server
+def measure(upload_mode, compression, stub):
+    config['FLOW_UPLOAD_MODE'] = upload_mode
+    config['FLOW_BATCH_COMPRESSION'] = compression
+    config['FLOW_BATCH_MAX_RECORDS'] = BATCH_SIZE
+    flow = FlowSensor()
+    stub.reset()
+    start = time.perf_counter()
+    for i in range(NUM_INTERVALS):
+        flow.pulses += 500 + i % 50
+        flow.save_flow_process()
+    elapsed = time.perf_counter() - start
+    assert flow.pulses == 0 and len(stub.flow_records) == NUM_INTERVALS
+    return {
+        'requests': len(stub.requests),
+        'bytes': stub.bytes_received,
+        'elapsed_sec': elapsed
+    }
+
+
+def run():
+    logging.disable(logging.CRITICAL)
+    stub = StubServer(config['PRODUCT_KEY']).start()
+    config['SERVER_IP'] = 'localhost'
+    config['SERVER_PORT'] = stub.port
+    try:
+        return [(upload_mode, compression, measure(upload_mode, compression, stub))
+                for upload_mode, compression in SCENARIOS]
+    finally:
+        stub.stop()
+
+
+if __name__ == '__main__':
+    for upload_mode, compression, result in run():
+        print('%-6s %-4s: %5d requests  %8d body bytes  %.3f sec' % (
+            upload_mode, compression or '-', result['requests'], result['bytes'], result['elapsed_sec']))
@@ -0,0 +1,82 @@
+# Benchmark for the gateway mode
+# Simulates a LAN of devices that each poll their valve state and upload a flow record per cycle, once talking to a
+# local stub server directly and once through a gateway in front of it, and compares the requests and bytes that
+# reach the server
+import logging
+import os
+import sys
+import threading
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+import requests
+
+from SprinklerConfig import config
+
+config['FORCE_DUMMY_GPIO'] = True
+
+import Gateway
+from StubServer import StubServer
+
+DEVICES = 20
+CYCLES = 10
+
+
+# Runs the cycles of all devices against the given port. Each device sends its requests from its own thread
+def run_devices(port):
+    sessions = [requests.Session() for _ in range(DEVICES)]
+
+    def device_cycle(index):
+        auth = ('API_KEY', 'device-%d' % index)
+        url = 'http://localhost:%d' % port
+        assert sessions[index].get(url + '/valve', auth=auth, timeout=30).status_code == 200
+        resp = sessions[index].post(url + '/flow', json={'volume': 1.0, 'duration': 10}, auth=auth, timeout=30)
+        assert resp.status_code == 200
+
+    start = time.perf_counter()
+    for _ in range(CYCLES):
+        threads = [threading.Thread(target=device_cycle, args=(index,)) for index in range(DEVICES)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    for session in sessions:
+        session.close()
+    return (time.perf_counter() - start) / CYCLES
+
+
+def run(server_latency=0.05):
+    logging.disable(logging.CRITICAL)
+    # The direct scenario needs a stub server that accepts the keys of all devices
+    stub = StubServer(config['PRODUCT_KEY']).start()
+    stub.is_authorized = lambda header: True
+    stub.set_latency(server_latency)
+    config['SERVER_IP'] = 'localhost'
+    config['SERVER_PORT'] = stub.port
+    config['GATEWAY_COALESCE_DELAY'] = 0.02
+    results = []
+    try:
+        cycle_time = run_devices(stub.port)
+        results.append(('direct', len(stub.requests) / float(CYCLES), stub.bytes_received / float(CYCLES),
+                        cycle_time))
+        stub.reset()
+        stub.set_latency(server_latency)
+        gateway = Gateway.Gateway('localhost', 0).start()
+        try:
+            cycle_time = run_devices(gateway.port)
+        finally:
+            gateway.stop()
+        results.append(('gateway', len(stub.requests) / float(CYCLES), stub.bytes_received / float(CYCLES),
+                        cycle_time))
+    finally:
+        stub.stop()
+    return results
+
+
+if __name__ == '__main__':
+    print('%d devices, %d cycles of a valve poll and a flow upload each, 50 ms server latency' % (DEVICES, CYCLES))
+    for name, upstream_requests, upstream_bytes, cycle_time in run():
+        print('%-7s: %5.1f upstream requests, %6d upstream body bytes and %.3f sec per cycle' % (
+            name, upstream_requests, upstream_bytes, cycle_time))
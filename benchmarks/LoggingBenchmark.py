@@ -0,0 +1,146 @@
+# Benchmark for the direct and the queued logging modes
+# Logs at DEBUG level to a rotating log file like the application with LOG_FILE_LEVEL DEBUG and reports, per mode,
+# the latency of a single logger.debug call, of the valve update process and the save flow process against a local
+# stub server, and of the flow sensor pulse callback while other threads are logging
+import logging
+import logging.handlers
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+from SprinklerConfig import config
+
+config['FORCE_DUMMY_GPIO'] = True
+config['PRODUCT_KEY'] = 'benchmark-key'
+config['VALVE_PIN'] = 40
+config['FLOW_SENSOR_PIN'] = 38
+config['FLOW_RATE_SERIES_SIZE'] = 4096
+
+import DummyGPIO
+import SprinklerLogging
+from FlowSensorControl import FlowSensor
+from StubServer import StubServer
+from ValveControl import Valve
+
+MODES = ['direct', 'queued']
+NUM_LOG_CALLS = 20000
+NUM_PROCESS_CALLS = 300
+NUM_PULSES = 200000
+
+
+# Percentile of a list of values by nearest rank
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def latency_stats(latencies):
+    return percentile(latencies, 50) * 1e6, percentile(latencies, 99) * 1e6, max(latencies) * 1e6
+
+
+# Configures the root logger like logging.json with LOG_FILE_LEVEL DEBUG, with the log file in log_dir
+def configure(mode, log_dir):
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+    file_handler = logging.handlers.TimedRotatingFileHandler(os.path.join(log_dir, 'sprinkler-%s.log' % mode),
+                                                             when='D', backupCount=30, encoding='utf8')
+    file_handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(threadName)s:%(name)s :: %(message)s'))
+    handler = file_handler
+    if mode == 'queued':
+        handler = SprinklerLogging.QueuedLogHandler([file_handler], config['LOG_QUEUE_SIZE'],
+                                                    config['LOG_QUEUE_OVERFLOW'], config['LOG_QUEUE_BATCH_SIZE'],
+                                                    config['LOG_QUEUE_FLUSH_INTERVAL'])
+        handler.start()
+    root.setLevel(logging.DEBUG)
+    root.addHandler(handler)
+    return handler
+
+
+def time_calls(call, num_calls):
+    timer = time.perf_counter
+    latencies = []
+    for _ in range(num_calls):
+        start = timer()
+        call()
+        latencies.append(timer() - start)
+    return latencies
+
+
+# Keeps logging from a background thread until stopped, like the valve and flow loops logging concurrently
+def start_background_logging():
+    stop = threading.Event()
+    background_logger = logging.getLogger('BackgroundLoop')
+
+    def keep_logging():
+        while not stop.is_set():
+            background_logger.debug('Update loop completed with status %s. Sleeping for %d second(s)', True, 10)
+            time.sleep(0.0001)
+
+    thread = threading.Thread(target=keep_logging, name='BackgroundLoggingThread')
+    thread.start()
+    return stop, thread
+
+
+def measure(mode, stub, log_dir):
+    handler = configure(mode, log_dir)
+    results = {}
+    try:
+        bench_logger = logging.getLogger('LoggingBenchmark')
+        results['logger.debug'] = latency_stats(time_calls(
+            lambda: bench_logger.debug('Fetched valve info from server: %s', {'id': 1, 'state': 0}), NUM_LOG_CALLS))
+
+        valve = Valve()
+        results['valve_update_process'] = latency_stats(time_calls(valve.valve_update_process, NUM_PROCESS_CALLS))
+
+        flow = FlowSensor()
+
+        def save_flow():
+            flow.pulses = 1000
+            flow.save_flow_process()
+
+        results['save_flow_process'] = latency_stats(time_calls(save_flow, NUM_PROCESS_CALLS))
+
+        stop, thread = start_background_logging()
+        try:
+            callback = flow.edge_callback
+            pin = flow.pin
+            results['pulse_callback'] = latency_stats(time_calls(lambda: callback(pin), NUM_PULSES))
+        finally:
+            stop.set()
+            thread.join()
+    finally:
+        if mode == 'queued':
+            results['queue_stats'] = handler.stats()
+        logging.getLogger().removeHandler(handler)
+        handler.close()
+        DummyGPIO.cleanup()
+    return results
+
+
+def run():
+    stub = StubServer(config['PRODUCT_KEY']).start()
+    config['SERVER_IP'] = 'localhost'
+    config['SERVER_PORT'] = stub.port
+    log_dir = tempfile.mkdtemp()
+    try:
+        return dict((mode, measure(mode, stub, log_dir)) for mode in MODES)
+    finally:
+        shutil.rmtree(log_dir)
+        stub.stop()
+
+
+if __name__ == '__main__':
+    results = run()
+    for mode in MODES:
+        print(mode)
+        for name in ['logger.debug', 'valve_update_process', 'save_flow_process', 'pulse_callback']:
+            print('  %-22s p50 %9.1f us  p99 %9.1f us  max %10.1f us' % ((name,) + results[mode][name]))
+        if 'queue_stats' in results[mode]:
+            print('  queue: %s' % results[mode]['queue_stats'])
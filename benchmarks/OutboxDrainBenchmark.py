@@ -0,0 +1,61 @@
+# Benchmark for draining the flow outbox to a local stub server
+# Reports the drain throughput (records/sec) and the number of requests for several batch sizes
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+from SprinklerConfig import config
+
+config['FORCE_DUMMY_GPIO'] = True
+config['PRODUCT_KEY'] = 'benchmark-key'
+config['FLOW_SENSOR_PIN'] = 38
+
+from FlowSensorControl import FlowSensor
+from StubServer import StubServer
+
+NUM_RECORDS = 5000
+BATCH_SIZES = [1, 10, 100, 500]
+
+
+# Fills an outbox with NUM_RECORDS records and measures the time taken to drain it
+def measure(batch_size, stub, data_dir):
+    config['FLOW_OUTBOX_FILE'] = os.path.join(data_dir, 'flow-%d.outbox' % batch_size)
+    config['FLOW_OUTBOX_BATCH_SIZE'] = batch_size
+    flow = FlowSensor()
+    now = time.time()
+    for i in range(NUM_RECORDS):
+        flow.outbox.append(now + i * 10, 10.0, 1.5, 547)
+    num_requests = len(stub.requests)
+    start = time.perf_counter()
+    success = flow.drain_outbox()
+    elapsed = time.perf_counter() - start
+    assert success and len(flow.outbox) == 0
+    return {
+        'records_per_sec': NUM_RECORDS / elapsed,
+        'requests': len(stub.requests) - num_requests,
+        'elapsed_sec': elapsed
+    }
+
+
+def run():
+    logging.disable(logging.CRITICAL)
+    stub = StubServer(config['PRODUCT_KEY']).start()
+    config['SERVER_IP'] = 'localhost'
+    config['SERVER_PORT'] = stub.port
+    data_dir = tempfile.mkdtemp()
+    try:
+        return dict((batch_size, measure(batch_size, stub, data_dir)) for batch_size in BATCH_SIZES)
+    finally:
+        shutil.rmtree(data_dir)
+        stub.stop()
+
+
+if __name__ == '__main__':
+    for batch_size, result in sorted(run().items()):
+        print('batch size %4d: %10.0f records/sec  %5d requests  %.3f sec' % (
+            batch_size, result['records_per_sec'], result['requests'], result['elapsed_sec']))
@@ -0,0 +1,97 @@
+# Microbenchmark for the flow sensor pulse path
+# Reports the sustained pulses/sec and the per callback latency of the GPIO edge callback,
+# while a reader thread concurrently snapshots and acknowledges pulses like the flow sensor loop does
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+from FlowRateSeries import PulseTimestampRing
+from PulseCounter import PulseAccumulator
+
+NUM_PULSES = 1000000
+NUM_LATENCY_SAMPLES = 100000
+READ_INTERVAL = 0.001  # Seconds
+
+
+# Pulse counter as implemented before the pulse accumulator. Used as the baseline
+class LockedCounter(object):
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.pulses = 0
+
+    def edge_callback(self, _channel):
+        with self.lock:
+            self.pulses += 1
+        if self.pulses % 100 == 0:
+            pass
+
+    def read(self):
+        with self.lock:
+            return self.pulses
+
+
+# Keeps reading the counter until stopped, like the flow sensor save loop
+def start_reader(read):
+    stop = threading.Event()
+
+    def keep_reading():
+        while not stop.is_set():
+            read()
+            time.sleep(READ_INTERVAL)
+
+    reader = threading.Thread(target=keep_reading, name='ReaderThread')
+    reader.start()
+    return stop, reader
+
+
+# Measures throughput and latency of the given edge callback
+def measure(callback, read):
+    stop, reader = start_reader(read)
+    try:
+        start = time.perf_counter()
+        for _ in range(NUM_PULSES):
+            callback(38)
+        elapsed = time.perf_counter() - start
+
+        timer = time.perf_counter
+        latencies = []
+        for _ in range(NUM_LATENCY_SAMPLES):
+            t0 = timer()
+            callback(38)
+            latencies.append(timer() - t0)
+    finally:
+        stop.set()
+        reader.join()
+    latencies.sort()
+    return {
+        'pulses_per_sec': NUM_PULSES / elapsed,
+        'latency_p50_ns': latencies[len(latencies) // 2] * 1e9,
+        'latency_p99_ns': latencies[int(len(latencies) * 0.99)] * 1e9,
+        'latency_max_ns': latencies[-1] * 1e9
+    }
+
+
+def run():
+    locked = LockedCounter()
+    accumulator = PulseAccumulator()
+
+    def read_and_acknowledge():
+        _, pending = accumulator.snapshot()
+        accumulator.acknowledge(pending)
+
+    ring = PulseTimestampRing(8192)
+    return {
+        'rlock_counter': measure(locked.edge_callback, locked.read),
+        'pulse_accumulator': measure(accumulator.edge_callback, read_and_acknowledge),
+        'with_rate_series': measure(ring.make_edge_callback(accumulator.edge_callback), read_and_acknowledge)
+    }
+
+
+if __name__ == '__main__':
+    for name, result in sorted(run().items()):
+        print('%-20s %12.0f pulses/sec  p50 %6.0f ns  p99 %6.0f ns  max %9.0f ns' % (
+            name, result['pulses_per_sec'], result['latency_p50_ns'], result['latency_p99_ns'],
+            result['latency_max_ns']))
@@ -0,0 +1,92 @@
+# Compares the resident memory, CPU time and thread count of Sprinkler.py in the threaded and the asyncio runtime
+# Each mode is run as a separate process against a local stub server with the dummy GPIO module. Linux only (/proc)
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+from StubServer import StubServer
+
+PRODUCT_KEY = 'benchmark-key'
+RUN_DURATION = 20  # Seconds
+POLL_INTERVAL = 1  # Seconds
+MODES = ['threaded', 'asyncio']
+
+
+# Starts Sprinkler.py in a separate process, configured through a PrivateConfig module in config_dir
+def start_sprinkler(stub, mode, config_dir, poll_interval=POLL_INTERVAL):
+    private_config = {
+        'FORCE_DUMMY_GPIO': True,
+        'PRODUCT_KEY': PRODUCT_KEY,
+        'SERVER_IP': 'localhost',
+        'SERVER_PORT': stub.port,
+        'VALVE_PIN': 40,
+        'FLOW_SENSOR_PIN': 38,
+        'VALVE_STATE_POLL_INTERVAL': poll_interval,
+        'FLOW_DATA_SAVE_INTERVAL': poll_interval,
+        'RUNTIME_MODE': mode
+    }
+    with open(os.path.join(config_dir, 'PrivateConfig.py'), 'w') as config_file:
+        config_file.write('config = %r\n' % private_config)
+    env = dict(os.environ, PYTHONPATH=config_dir)
+    return subprocess.Popen([sys.executable, os.path.join(SRC_DIR, 'Sprinkler.py')], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+# Reads RSS (KB), number of threads and CPU seconds (user + system) of a process from /proc
+def read_process_stats(pid):
+    stats = {}
+    with open('/proc/%d/status' % pid) as status_file:
+        for line in status_file:
+            key, value = line.split(':', 1)
+            if key == 'VmRSS':
+                stats['rss_kb'] = int(value.split()[0])
+            elif key == 'Threads':
+                stats['threads'] = int(value)
+    with open('/proc/%d/stat' % pid) as stat_file:
+        fields = stat_file.read().rsplit(')', 1)[1].split()
+    stats['cpu_sec'] = (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+    return stats
+
+
+def measure(mode, stub, run_duration=RUN_DURATION):
+    config_dir = tempfile.mkdtemp()
+    try:
+        process = start_sprinkler(stub, mode, config_dir)
+        time.sleep(2)
+        start_stats = read_process_stats(process.pid)
+        time.sleep(run_duration)
+        end_stats = read_process_stats(process.pid)
+        stop_time = time.time()
+        process.send_signal(signal.SIGTERM)
+        process.wait()
+        return {
+            'rss_kb': end_stats['rss_kb'],
+            'threads': end_stats['threads'],
+            'cpu_sec_per_min': (end_stats['cpu_sec'] - start_stats['cpu_sec']) * 60.0 / run_duration,
+            'shutdown_sec': time.time() - stop_time
+        }
+    finally:
+        shutil.rmtree(config_dir)
+
+
+def run(run_duration=RUN_DURATION):
+    logging.disable(logging.CRITICAL)
+    stub = StubServer(PRODUCT_KEY).start()
+    try:
+        return dict((mode, measure(mode, stub, run_duration)) for mode in MODES)
+    finally:
+        stub.stop()
+
+
+if __name__ == '__main__':
+    for mode, result in sorted(run().items()):
+        print('%-10s RSS %6d KB  threads %2d  CPU %.3f sec/min  shutdown %.2f sec' % (
+            mode, result['rss_kb'], result['threads'], result['cpu_sec_per_min'], result['shutdown_sec']))
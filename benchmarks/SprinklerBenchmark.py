@@ -0,0 +1,263 @@
+# End-to-end benchmark suite for the client
+# Runs against a local stub server and the dummy GPIO module and writes the results as JSON.
+# If a baseline result file is given, metrics that regressed beyond the tolerance are reported
+# and the exit status is non-zero.
+#
+# Usage: python SprinklerBenchmark.py [--output results.json] [--baseline baseline.json] [--tolerance 0.2] [--quick]
+#                                     [--server-latency 0.05]
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.realpath(__file__))
+SRC_DIR = os.path.join(BENCHMARKS_DIR, '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+from SprinklerConfig import config
+
+config['FORCE_DUMMY_GPIO'] = True
+config['PRODUCT_KEY'] = 'benchmark-key'
+config['VALVE_PIN'] = 40
+config['FLOW_SENSOR_PIN'] = 38
+
+import DummyGPIO
+import RuntimeFootprintBenchmark
+from FlowSensorControl import FlowSensor
+from StubServer import StubServer
+from ValveControl import Valve
+
+# Whether a higher or a lower value is better, by metric name suffix
+HIGHER_IS_BETTER = ('_per_sec',)
+LOWER_IS_BETTER = ('_ms', '_sec', '_kb', '_per_min', '_lost', '_requests')
+
+
+# Percentile of a list of values by nearest rank
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def latency_stats(prefix, latencies):
+    return {
+        prefix + '_p50_ms': percentile(latencies, 50) * 1000,
+        prefix + '_p99_ms': percentile(latencies, 99) * 1000,
+        prefix + '_max_ms': max(latencies) * 1000
+    }
+
+
+# Pulse ingestion of the flow sensor: synchronous edges and a simulated pulse train while the save loop is running
+def bench_pulse_ingestion(stub, quick):
+    num_edges = 200000 if quick else 2000000
+    flow = FlowSensor()
+    start = time.perf_counter()
+    DummyGPIO.fire_edges(config['FLOW_SENSOR_PIN'], num_edges)
+    sync_elapsed = time.perf_counter() - start
+    assert flow.pulses == num_edges
+
+    config['FLOW_DATA_SAVE_INTERVAL'] = 0.1
+    flow = FlowSensor()
+    flow.start()
+    rate = 20000
+    train = DummyGPIO.start_pulse_train(config['FLOW_SENSOR_PIN'], DummyGPIO.constant_rate(rate))
+    duration = 1 if quick else 5
+    time.sleep(duration)
+    train.stop()
+    flow.stop()
+    uploaded = sum(record['volume'] for record in stub.flow_records) * config['PULSES_PER_LITRE']
+    return {
+        'sync_edges_per_sec': num_edges / sync_elapsed,
+        'train_edges_per_sec': train.fired / float(duration),
+        'train_max_lag_ms': train.max_lag * 1000,
+        'train_pulses_lost': train.fired - int(round(uploaded)) - flow.pulses
+    }
+
+
+# Command to GPIO latency: a full valve update process in poll mode and a command pushed through a long poll
+# Also the cost of the polls without a state change, which the server answers as not modified
+def bench_valve_command_latency(stub, quick):
+    num_commands = 20 if quick else 100
+    valve = Valve()
+    durations = []
+    for i in range(num_commands):
+        state = (i + 1) % 2
+        stub.set_valve_state(state)
+        start = time.perf_counter()
+        valve.valve_update_process()
+        durations.append(time.perf_counter() - start)
+        assert DummyGPIO.input(config['VALVE_PIN']) == state
+
+    idle_durations = []
+    sent_requests = len(stub.requests)
+    for _ in range(num_commands):
+        start = time.perf_counter()
+        valve.valve_update_process()
+        idle_durations.append(time.perf_counter() - start)
+    idle_requests = (len(stub.requests) - sent_requests) / float(num_commands)
+
+    config['VALVE_COMMAND_MODE'] = 'long_poll'
+    config['VALVE_LONG_POLL_TIMEOUT'] = 5
+    latencies = []
+    valve.start()
+    try:
+        for i in range(num_commands):
+            state = (valve.state + 1) % 2
+            time.sleep(0.01)
+            stub.set_valve_state(state)
+            while DummyGPIO.input(config['VALVE_PIN']) != state:
+                time.sleep(0.0001)
+            latencies.append(time.time() - stub.valve_state_time)
+    finally:
+        valve.stop()
+        config['VALVE_COMMAND_MODE'] = 'poll'
+    results = latency_stats('poll_update_process', durations)
+    results.update(latency_stats('poll_idle_process', idle_durations))
+    results['poll_idle_requests'] = idle_requests
+    results.update(latency_stats('long_poll_command_to_gpio', latencies))
+    return results
+
+
+# Round trip of a single flow upload and throughput of batched outbox uploads
+def bench_flow_upload(stub, quick, data_dir):
+    num_uploads = 50 if quick else 500
+    latencies = []
+    for _ in range(num_uploads):
+        start = time.perf_counter()
+        assert FlowSensor.send_flow_data(1.5, 10.0)
+        latencies.append(time.perf_counter() - start)
+    results = latency_stats('upload_round_trip', latencies)
+
+    config['FLOW_OUTBOX_FILE'] = os.path.join(data_dir, 'flow.outbox')
+    config['FLOW_OUTBOX_BATCH_SIZE'] = 100
+    flow = FlowSensor()
+    config['FLOW_OUTBOX_FILE'] = None
+    num_records = 1000 if quick else 10000
+    for i in range(num_records):
+        flow.outbox.append(time.time(), 10.0, 1.5, 547)
+    start = time.perf_counter()
+    assert flow.drain_outbox()
+    results['outbox_drain_records_per_sec'] = num_records / (time.perf_counter() - start)
+    return results
+
+
+# Cold start of Sprinkler.py until the first valve poll reaches the server
+def bench_startup(stub, quick, data_dir):
+    results = {}
+    for mode in RuntimeFootprintBenchmark.MODES:
+        times = []
+        for _ in range(2 if quick else 5):
+            stub.requests = []
+            start = time.time()
+            process = RuntimeFootprintBenchmark.start_sprinkler(stub, mode, data_dir, poll_interval=60)
+            while ('GET', '/valve') not in stub.requests and process.poll() is None:
+                time.sleep(0.001)
+            times.append(time.time() - start)
+            process.terminate()
+            process.wait()
+        results['%s_time_to_first_valve_poll_sec' % mode] = percentile(times, 50)
+    return results
+
+
+# Steady state CPU and RSS of Sprinkler.py
+def bench_footprint(quick):
+    results = {}
+    for mode, stats in RuntimeFootprintBenchmark.run(run_duration=5 if quick else 20).items():
+        results['%s_rss_kb' % mode] = stats['rss_kb']
+        results['%s_cpu_sec_per_min' % mode] = stats['cpu_sec_per_min']
+        results['%s_shutdown_sec' % mode] = stats['shutdown_sec']
+    return results
+
+
+def run(quick=False, server_latency=0.0):
+    logging.disable(logging.CRITICAL)
+    stub = StubServer(config['PRODUCT_KEY']).start()
+    stub.set_latency(server_latency)
+    config['SERVER_IP'] = 'localhost'
+    config['SERVER_PORT'] = stub.port
+    data_dir = tempfile.mkdtemp()
+    config_backup = config.copy()
+    results = {}
+    try:
+        benchmarks = [
+            ('pulse_ingestion', lambda: bench_pulse_ingestion(stub, quick)),
+            ('valve_command_latency', lambda: bench_valve_command_latency(stub, quick)),
+            ('flow_upload', lambda: bench_flow_upload(stub, quick, data_dir)),
+            ('startup', lambda: bench_startup(stub, quick, data_dir)),
+            ('footprint', lambda: bench_footprint(quick))
+        ]
+        for name, bench in benchmarks:
+            results[name] = bench()
+            config.update(config_backup)
+    finally:
+        stub.stop()
+        shutil.rmtree(data_dir)
+    return results
+
+
+# Metadata identifying the environment and the revision the results were obtained with
+def environment():
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BENCHMARKS_DIR,
+                                           stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        'time': time.time(),
+        'revision': revision,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'platform': platform.platform()
+    }
+
+
+# Returns the metrics that are worse than in the baseline by more than the tolerance (fraction)
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            base = baseline.get(name, {}).get(metric)
+            if not base or value is None:
+                continue
+            change = (value - base) / float(abs(base))
+            if metric.endswith(HIGHER_IS_BETTER) and change < -tolerance or \
+                    metric.endswith(LOWER_IS_BETTER) and change > tolerance:
+                regressions.append((name, metric, base, value, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark suite for the sprinkler client')
+    parser.add_argument('--output', default='bench_results.json', help='File to write the JSON results to')
+    parser.add_argument('--baseline', help='Previous JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative regression')
+    parser.add_argument('--quick', action='store_true', help='Shorter runs, for smoke testing')
+    parser.add_argument('--server-latency', type=float, default=0.0, help='Seconds added to every server response')
+    args = parser.parse_args()
+
+    results = run(args.quick, args.server_latency)
+    with open(args.output, 'w') as output_file:
+        json.dump({'environment': environment(), 'results': results}, output_file, indent=2, sort_keys=True)
+    for name, metrics in sorted(results.items()):
+        print(name)
+        for metric, value in sorted(metrics.items()):
+            print('  %-45s %14.3f' % (metric, value))
+    print('Results written to %s' % args.output)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for name, metric, base, value, change in regressions:
+            print('REGRESSION %s.%s: %.3f -> %.3f (%+.0f%%)' % (name, metric, base, value, change * 100))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
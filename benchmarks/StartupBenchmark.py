@@ -0,0 +1,77 @@
+# Benchmark for the cold start of the client
+# Starts Sprinkler.py in a new process against a local stub server and measures the time from starting the process
+# until the first valve poll reaches the server. The eager scenario imports requests and numpy before the client, as
+# the client did before they were imported on first use, to show what the lazy imports save
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+from StubServer import StubServer
+
+PRODUCT_KEY = 'benchmark-key'
+RUNS = 5
+TIMEOUT = 30
+# Code run in the client process. The settings are passed as the first argument
+CLIENT_CODE = '''
+import json, runpy, sys
+from SprinklerConfig import config
+config.update(json.loads(sys.argv[1]))
+for module in sys.argv[2:]:
+    __import__(module)
+runpy.run_path('Sprinkler.py', run_name='__main__')
+'''
+# Modules imported before the client in each scenario
+SCENARIOS = [
+    ('lazy', []),
+    ('eager', ['requests', 'numpy'])
+]
+
+
+# Seconds from starting the client until the stub server has received its first valve poll
+def time_to_first_poll(stub, preloaded):
+    settings = {
+        'FORCE_DUMMY_GPIO': True,
+        'PRODUCT_KEY': PRODUCT_KEY,
+        'SERVER_IP': 'localhost',
+        'SERVER_PORT': stub.port,
+        'VALVE_PIN': 40,
+        'FLOW_SENSOR_PIN': 38
+    }
+    stub.reset()
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-c', CLIENT_CODE, json.dumps(settings)] + preloaded, cwd=SRC_DIR,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while not any(path == '/valve' for _, path in stub.requests):
+            if time.perf_counter() - start > TIMEOUT or process.poll() is not None:
+                raise RuntimeError('Client did not poll the valve')
+            time.sleep(0.001)
+        return time.perf_counter() - start
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(TIMEOUT)
+
+
+def run():
+    stub = StubServer(PRODUCT_KEY).start()
+    try:
+        results = []
+        for name, preloaded in SCENARIOS:
+            times = [time_to_first_poll(stub, preloaded) for _ in range(RUNS)]
+            results.append((name, {'median_sec': statistics.median(times), 'min_sec': min(times)}))
+        return results
+    finally:
+        stub.stop()
+
+
+if __name__ == '__main__':
+    for name, result in run():
+        print('%-5s: time to first valve poll %.3f sec median, %.3f sec min' % (
+            name, result['median_sec'], result['min_sec']))
@@ -1,57 +1,14 @@
-import RPi.GPIO as pins
+# Flow sensor calibration. Captures timestamped pulse runs of a known volume and fits a K-factor table to them
+# Forwards to src/FlowCalibration.py, see there for the options
+#
+# Usage: python3 CaliberateFlowSensor.py capture flow-calib-runs.jsonl --volume 1 --pin 38
+#        python3 CaliberateFlowSensor.py fit flow-calib-runs.jsonl --output ../data/flow-calibration.json
+import os
 import sys
 
-INPUT_PIN=38
-CALIB_FACTOR=365 # pulses/Litre
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
 
-MODE="calib" #calib/test
-if len(sys.argv) > 1:
-    MODE = sys.argv[1]
+import FlowCalibration
 
-flow_pulse_counter=0
-def record_pulse(pin_no):
-    global flow_pulse_counter
-    flow_pulse_counter+=1
-
-pins.setmode(pins.BOARD)
-pins.setup(INPUT_PIN, pins.IN, pull_up_down=pins.PUD_DOWN)
-pins.add_event_detect(INPUT_PIN, pins.RISING, callback=record_pulse)
-
-calib_config = []
-if MODE == "calib":
-    calib_config += ["1 Litre"] * 5
-    calib_config += ["10 Litres"] * 3
-elif MODE == "test":
-    calib_config += ["1 Litre"] * 4
-else:
-    print "Invalid mode %s" % MODE
-    sys.exit(1)
-
-print "********Flow Sensor Caliberation************\n\n"
-
-for i,calib in enumerate(calib_config):
-
-    if MODE == "calib":
-        print "\n\nCaliberation %d of %d\n" % (i+1, len(calib_config))
-        raw_input("Press ENTER to start measuring %s" % calib)
-        flow_pulse_counter=0
-        raw_input("Press ENTER to stop measuring")
-        num_pulses = flow_pulse_counter
-        with open('flow-calib-results', 'a') as fp:
-            fp.write("%s,%d\n" % (calib, num_pulses))
-        print "Measured %s. Num pulses: %d" % (calib, num_pulses)
-    
-    elif MODE == "test":
-        print "\n\nTest %d of %d\n" % (i+1, len(calib_config))
-        raw_input("Press ENTER to start measuring %s" % calib)
-        flow_pulse_counter=0
-        raw_input("Press ENTER to stop measuring")
-        num_pulses = flow_pulse_counter
-        litres = float(num_pulses)/CALIB_FACTOR
-        with open('flow-calib-tests', 'a') as fp:
-            fp.write("%s,%f\n" % (calib, litres))
-        print "Measured %.2f L. Num pulses: %d" % (litres, num_pulses)
-
-pins.cleanup()
-
-print "************DONE*************"
+if __name__ == '__main__':
+    sys.exit(FlowCalibration.main())
@@ -0,0 +1,48 @@
+import logging
+import time
+
+from GPIOWrapper import pins
+from SprinklerConfig import config
+
+logger = logging.getLogger(__name__)
+
+
+# Decides how long the valve waits before polling the server again
+# Polls at the minimum interval right after a state change, while the valve is open or while water is flowing,
+# and backs off exponentially up to the maximum interval while the device is idle.
+# A next poll hint (seconds) sent by the server in the valve info takes precedence.
+class AdaptivePollScheduler(object):
+    def __init__(self, flow_sensor=None, clock=time.time):
+        self.flow_sensor = flow_sensor
+        self.clock = clock
+        self.interval = config['VALVE_POLL_MIN_INTERVAL']
+        self.last_activity_time = clock()
+        self.last_total_pulses = None
+
+    # Whether the flow sensor has recorded pulses since the last check
+    def is_flowing(self):
+        if self.flow_sensor is None:
+            return False
+        total_pulses, _ = self.flow_sensor.accumulator.snapshot()
+        flowing = self.last_total_pulses is not None and total_pulses > self.last_total_pulses
+        self.last_total_pulses = total_pulses
+        return flowing
+
+    # Computes the interval until the next poll after a valve update process, from the settings of its config snapshot
+    def next_interval(self, valve_info, state, state_changed, settings=config):
+        now = self.clock()
+        min_interval = settings['VALVE_POLL_MIN_INTERVAL']
+        max_interval = settings['VALVE_POLL_MAX_INTERVAL']
+        flowing = self.is_flowing()
+        if state_changed or flowing or state == pins.HIGH:
+            self.last_activity_time = now
+        if now - self.last_activity_time < settings['VALVE_POLL_ACTIVE_PERIOD']:
+            self.interval = min_interval
+        else:
+            self.interval = min(self.interval * settings['VALVE_POLL_BACKOFF_FACTOR'], max_interval)
+
+        hint = valve_info.get('next_poll') if isinstance(valve_info, dict) else None
+        if isinstance(hint, (int, float)) and not isinstance(hint, bool):
+            logger.debug('Using next poll hint from server: %s second(s)', hint)
+            return max(min_interval, min(hint, max_interval))
+        return self.interval
@@ -0,0 +1,120 @@
+import logging
+import random
+import threading
+
+import Clock
+import SprinklerMetrics
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+HALF_OPEN = 'half_open'
+OPEN = 'open'
+# Values of the breaker state gauge
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# Outcomes of asking the breaker for permission to call the server
+ALLOW = 'allow'
+PROBE = 'probe'
+REJECT = 'reject'
+
+
+# Jittered exponential backoff: base, base * factor, base * factor^2, ... capped at max_delay
+# Each delay is varied uniformly by up to +/- jitter of itself, so that many devices do not retry in lockstep
+class ExponentialBackoff(object):
+    def __init__(self, base, max_delay, factor=2.0, jitter=0.0, seed=None):
+        self.base = base
+        self.max_delay = max_delay
+        self.factor = factor
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.attempts = 0
+
+    # Returns the next delay and backs off further
+    def next_delay(self):
+        delay = min(self.base * self.factor ** self.attempts, self.max_delay)
+        self.attempts += 1
+        if self.jitter:
+            delay *= self.random.uniform(1 - self.jitter, 1 + self.jitter)
+        return delay
+
+    def reset(self):
+        self.attempts = 0
+
+
+# Stops the client from calling a failing server
+# Closed: calls go through. After threshold consecutive failed calls the breaker opens.
+# Open: calls are rejected without touching the network until the open time has passed. The open time backs off
+# exponentially with jitter while the server keeps failing.
+# Half-open: a single caller is told to probe the server with a cheap request while all others are still rejected.
+# A successful probe closes the breaker, a failed one opens it again.
+# A threshold of 0 disables the breaker
+class CircuitBreaker(object):
+    def __init__(self, threshold, open_time, max_open_time, jitter=0.0, clock=Clock.monotonic, seed=None):
+        self.threshold = threshold
+        self.backoff = ExponentialBackoff(open_time, max_open_time, jitter=jitter, seed=seed)
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.open_until = 0.0
+        SprinklerMetrics.SERVER_BREAKER_STATE.set(STATE_VALUES[CLOSED])
+
+    # Asks for permission to call the server. Returns ALLOW, PROBE or REJECT
+    # A caller told to PROBE must report the outcome of the probe with record
+    def acquire(self):
+        if not self.threshold:
+            return ALLOW
+        with self.lock:
+            if self.state == CLOSED:
+                return ALLOW
+            if self.state == OPEN and self.clock() >= self.open_until:
+                self.transition(HALF_OPEN)
+                return PROBE
+        SprinklerMetrics.SERVER_BREAKER_REJECTED.inc()
+        return REJECT
+
+    # Records the outcome of a call to the server. Server errors and unreachable servers are failures
+    def record(self, success):
+        if not self.threshold:
+            return
+        with self.lock:
+            if success:
+                self.failures = 0
+                if self.state != CLOSED:
+                    self.backoff.reset()
+                    self.transition(CLOSED)
+                return
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.threshold):
+                self.open()
+
+    # Closes the breaker, e.g. when the client has been pointed at another server
+    def reset(self):
+        with self.lock:
+            self.failures = 0
+            self.backoff.reset()
+            if self.state != CLOSED:
+                self.transition(CLOSED)
+
+    # Seconds until the next probe is allowed, 0 if not open
+    def remaining_open_time(self):
+        with self.lock:
+            if self.state != OPEN:
+                return 0
+            return max(self.open_until - self.clock(), 0)
+
+    # Must be called with the lock held
+    def open(self):
+        open_time = self.backoff.next_delay()
+        self.open_until = self.clock() + open_time
+        self.transition(OPEN)
+        logger.warning('Server failed %d consecutive call(s). Pausing calls for %.1f second(s)', self.failures,
+                       open_time)
+
+    # Must be called with the lock held
+    def transition(self, state):
+        logger.info('Circuit breaker state changed from %s to %s', self.state, state)
+        self.state = state
+        SprinklerMetrics.SERVER_BREAKER_STATE.set(STATE_VALUES[state])
+        SprinklerMetrics.SERVER_BREAKER_TRANSITIONS.labels(state).inc()
@@ -0,0 +1,154 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Real seconds between checks of whether an event waited on with the virtual clock has been set
+EVENT_POLL_INTERVAL = 0.005
+# Real seconds the virtual clock waits for the woken threads to block on it again before moving on
+SETTLE_TIMEOUT = 5.0
+
+
+# Source of the time and of the waits of the components
+# Components read the time and wait through the client wide clock instead of the time module, so that tests and
+# simulations can replace it with a virtual clock
+class SystemClock(object):
+    # Wall time in seconds since the epoch
+    def time(self):
+        return time.time()
+
+    # Seconds from an arbitrary point that never goes backwards, for measuring intervals
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(max(seconds, 0))
+
+    # Waits until the threading event is set or timeout seconds have passed. Returns whether the event is set
+    def wait(self, event, timeout=None):
+        return event.wait(timeout)
+
+    # Tells the clock about a thread that is going to wait on it
+    def add_thread(self, thread):
+        pass
+
+
+# Deterministic clock for tests and simulations. Time only moves when advanced
+# Threads that sleep or wait on the clock are blocked until the clock has been advanced past their deadline. advance()
+# moves the time from one deadline to the next and lets the woken threads run until they are blocked on the clock
+# again (or have ended) before moving on, so that a simulated day of polling runs in the same order as in real time,
+# only as fast as the work allows. Waits on an event also end as soon as the event is set
+class VirtualClock(object):
+    def __init__(self, start=None, settle_timeout=SETTLE_TIMEOUT):
+        # Starts at the current wall time by default, so that times stored by the components look realistic
+        self.start = time.time() if start is None else start
+        self.now = self.start
+        self.settle_timeout = settle_timeout
+        self.condition = threading.Condition()
+        # Deadline (None while waiting for the event only) and event of the threads blocked on the clock by thread
+        self.sleepers = {}
+        # Threads that have waited on the clock. They are let run after each step until they block again
+        self.threads = set()
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now - self.start
+
+    def sleep(self, seconds):
+        self.wait(None, seconds)
+
+    def wait(self, event, timeout=None):
+        thread = threading.current_thread()
+        with self.condition:
+            deadline = None if timeout is None else self.now + max(timeout, 0)
+            self.threads.add(thread)
+            self.sleepers[thread] = (deadline, event)
+            self.condition.notify_all()
+            try:
+                while not (event is not None and event.is_set()) and (deadline is None or self.now < deadline):
+                    self.condition.wait(EVENT_POLL_INTERVAL if event is not None else None)
+            finally:
+                del self.sleepers[thread]
+                self.condition.notify_all()
+        return event is not None and event.is_set()
+
+    # Tells the clock about a thread that is going to wait on it, so that advance() waits for it to block on the clock
+    # even if it has not done so yet
+    def add_thread(self, thread):
+        with self.condition:
+            self.threads.add(thread)
+
+    # Whether all other threads that use the clock are blocked on it and none of them is about to wake up
+    def is_settled(self):
+        current_thread = threading.current_thread()
+        self.threads = set(thread for thread in self.threads if thread.is_alive() or thread.ident is None)
+        return all(thread in self.sleepers or thread is current_thread for thread in self.threads) and \
+            not any(deadline is not None and deadline <= self.now or event is not None and event.is_set()
+                    for deadline, event in self.sleepers.values())
+
+    # Waits for the threads woken by the last step to block on the clock again
+    def settle(self):
+        give_up_time = time.monotonic() + self.settle_timeout
+        while not self.is_settled():
+            remaining = give_up_time - time.monotonic()
+            if remaining <= 0:
+                logger.warning('Threads using the virtual clock did not block again within %.1f second(s)',
+                               self.settle_timeout)
+                return False
+            self.condition.wait(min(remaining, EVENT_POLL_INTERVAL))
+        return True
+
+    # Moves the time forward by seconds, stopping at every deadline of the blocked threads on the way
+    def advance(self, seconds):
+        with self.condition:
+            end_time = self.now + max(seconds, 0)
+            self.settle()
+            while True:
+                next_deadline = min((deadline for deadline, _ in self.sleepers.values() if deadline is not None),
+                                    default=None)
+                if next_deadline is None or next_deadline > end_time:
+                    break
+                self.now = max(self.now, next_deadline)
+                self.condition.notify_all()
+                self.settle()
+            self.now = end_time
+            self.condition.notify_all()
+            self.settle()
+
+    # Advances the time until condition returns true, in steps of at most step seconds, or until timeout seconds have
+    # passed on the clock. Returns whether the condition is true
+    def run_until(self, condition, timeout, step=1.0):
+        end_time = self.now + timeout
+        while not condition():
+            if self.now >= end_time:
+                return False
+            self.advance(min(step, end_time - self.now))
+        return True
+
+
+clock = SystemClock()
+
+
+# Returns the client wide clock
+# Components take the clock when they are created, so a virtual clock has to be set before creating them
+def get_clock():
+    return clock
+
+
+# Replaces the client wide clock. Returns the previous one
+def set_clock(new_clock):
+    global clock
+    previous, clock = clock, new_clock
+    return previous
+
+
+# Current time of the client wide clock, for callers that may outlive a change of the clock
+def now():
+    return clock.time()
+
+
+def monotonic():
+    return clock.monotonic()
@@ -0,0 +1,278 @@
+# Immutable snapshots of the config, and hot reload of the config file
+# The config dict counts its changes, so a snapshot is only taken again after the config has changed. Components bind
+# the values they need from a snapshot once, and only bind them again when current() returns another snapshot.
+# CONFIG_FILE is a JSON object of settings applied over the private overrides. It is validated against the defaults
+# and watched for changes while running, and all settings of a valid file are applied together in a single update.
+import json
+import logging
+import os
+import threading
+import types
+
+import SprinklerUtils
+from SprinklerConfig import config, defaults
+
+logger = logging.getLogger(__name__)
+
+# Values allowed for settings with a fixed set of options
+CHOICES = {
+    'RUNTIME_MODE': ('threaded', 'asyncio'),
+    'ASYNC_HTTP_CLIENT': ('executor', 'aiohttp'),
+    'LOOP_MISSED_TICKS': ('skip', 'catch_up'),
+    'LOG_MODE': ('direct', 'queued'),
+    'LOG_FILE_LEVEL': ('DEBUG', 'INFO', 'WARNING', 'ERROR'),
+    'LOG_QUEUE_OVERFLOW': ('drop_new', 'drop_old'),
+    'VALVE_COMMAND_MODE': ('poll', 'long_poll', 'schedule'),
+    'VALVE_ACK_MODE': ('post', 'piggyback'),
+    'FLOW_UPLOAD_MODE': ('single', 'batch'),
+    'FLOW_BATCH_COMPRESSION': (None, 'gzip')
+}
+NUMBER = (int, float)
+# Types of the settings whose default is None, which stays allowed for them
+NULLABLE_TYPES = {
+    'CONFIG_FILE': str,
+    'PRODUCT_KEY': str,
+    'SERVER_DNS': str,
+    'SERVER_IP': str,
+    'SERVER_PORT': (int, str),
+    'JOURNAL_DIR': str,
+    'METRICS_PORT': int,
+    'METRICS_SNAPSHOT_FILE': str,
+    'VALVE_PIN': int,
+    'FLOW_SENSOR_PIN': int,
+    'FLOW_CALIBRATION_FILE': str,
+    'FLOW_OUTBOX_FILE': str,
+    'FLOW_ANALYTICS_INTERVAL': NUMBER,
+    'FLOW_EXPECTED_RATE': NUMBER,
+    'GATEWAY_PORT': int
+}
+# Intervals, timeouts, sizes and factors that must be greater than 0. Zero would make a loop spin or divide by zero.
+# The other numbers may be 0, which disables them or means right away
+POSITIVE_SETTINGS = frozenset([
+    'CONFIG_RELOAD_INTERVAL', 'SERVER_CONNECT_TIMEOUT', 'SERVER_READ_TIMEOUT', 'SERVER_POOL_SIZE',
+    'SERVER_CALL_DEADLINE', 'SERVER_BREAKER_OPEN_TIME', 'SERVER_BREAKER_MAX_OPEN_TIME', 'LOG_QUEUE_SIZE',
+    'LOG_QUEUE_BATCH_SIZE', 'LOG_QUEUE_FLUSH_INTERVAL', 'JOURNAL_SEGMENT_SIZE', 'JOURNAL_MAX_SEGMENTS', 'METRICS_PORT',
+    'METRICS_SNAPSHOT_INTERVAL', 'VALVE_STATE_POLL_INTERVAL', 'VALVE_LONG_POLL_TIMEOUT', 'VALVE_POLL_MIN_INTERVAL',
+    'VALVE_POLL_MAX_INTERVAL', 'VALVE_POLL_BACKOFF_FACTOR', 'PULSES_PER_LITRE', 'FLOW_DATA_SAVE_INTERVAL',
+    'MAX_FLOW_DURATION_FOR_SAVE', 'FLOW_OUTBOX_MAX_RECORDS', 'FLOW_OUTBOX_BATCH_SIZE', 'FLOW_BATCH_MAX_RECORDS',
+    'FLOW_BATCH_MAX_PENDING', 'FLOW_ANALYTICS_INTERVAL', 'FLOW_ANALYTICS_ALPHA', 'FLOW_ANOMALY_SAMPLES',
+    'FLOW_ANOMALY_LATENCY', 'FLOW_EXPECTED_RATE', 'FLOW_OVER_RATE_FACTOR', 'SCHEDULE_SYNC_INTERVAL', 'GATEWAY_PORT',
+    'GATEWAY_SYNC_INTERVAL', 'GATEWAY_FORWARD_TIMEOUT'
+])
+# Settings that are only read when the components are set up. Changes to them in the config file are applied on
+# the next start instead of while running
+RESTART_SETTINGS = frozenset([
+    'CONFIG_FILE', 'RUNTIME_MODE', 'ASYNC_HTTP_CLIENT', 'LOOP_MISSED_TICKS', 'LOG_MODE', 'LOG_FILE_LEVEL',
+    'LOG_QUEUE_SIZE', 'LOG_QUEUE_OVERFLOW', 'LOG_QUEUE_BATCH_SIZE', 'LOG_QUEUE_FLUSH_INTERVAL', 'JOURNAL_DIR',
+    'JOURNAL_SEGMENT_SIZE', 'JOURNAL_MAX_SEGMENTS', 'JOURNAL_FLUSH_BYTES', 'JOURNAL_FLUSH_INTERVAL', 'METRICS_HOST',
+    'METRICS_PORT', 'METRICS_SNAPSHOT_FILE', 'FORCE_DUMMY_GPIO', 'SERVER_POOL_SIZE', 'VALVE_PIN', 'VALVE_COMMAND_MODE',
+    'VALVE_POLL_ADAPTIVE', 'VALVE_POLL_JITTER', 'FLOW_SENSOR_PIN', 'FLOW_DATA_SAVE_JITTER', 'FLOW_RATE_SERIES_SIZE',
+    'FLOW_OUTBOX_FILE', 'FLOW_OUTBOX_MAX_RECORDS', 'FLOW_OUTBOX_FSYNC', 'FLOW_UPLOAD_MODE', 'FLOW_BATCH_MAX_PENDING',
+    'FLOW_CALIBRATION_FILE', 'FLOW_ANALYTICS_INTERVAL', 'ZONES', 'SCHEDULE_CACHE_FILE', 'GATEWAY_HOST', 'GATEWAY_PORT'
+])
+
+
+# Read-only copy of the config at one version
+class ConfigSnapshot(object):
+    __slots__ = ('values', 'version')
+
+    def __init__(self, values, version):
+        object.__setattr__(self, 'values', types.MappingProxyType(dict(values)))
+        object.__setattr__(self, 'version', version)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Config snapshots are immutable')
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+
+# Base of the components that read their settings from a snapshot instead of the live config
+# They bind a snapshot at the start of each cycle, so a reload of the config file applies between two cycles and never
+# half-way through one
+class SnapshotBound(object):
+    settings = None
+
+    # Binds the given snapshot, or the current one. Returns it
+    def bind(self, settings=None):
+        self.settings = current() if settings is None else settings
+        return self.settings
+
+
+snapshot = None
+snapshot_lock = threading.Lock()
+
+
+# Returns the snapshot of the current config
+# Costs a version comparison unless the config has changed since the last snapshot
+def current():
+    taken = snapshot
+    if taken is not None and taken.version == config.version:
+        return taken
+    return take_snapshot()
+
+
+def take_snapshot():
+    global snapshot
+    with snapshot_lock:
+        # The version is read before the values are copied, so a change in between only causes another snapshot
+        version = config.version
+        if snapshot is None or snapshot.version != version:
+            snapshot = ConfigSnapshot(config, version)
+        return snapshot
+
+
+# Returns the errors of the given settings, checked against the type of their default and their options
+def validate(settings):
+    if not isinstance(settings, dict):
+        return ['Config file must contain a JSON object']
+    errors = []
+    for key, value in sorted(settings.items()):
+        if key not in defaults:
+            errors.append('Unknown setting %s' % key)
+            continue
+        default = defaults[key]
+        if key in CHOICES:
+            if value not in CHOICES[key]:
+                errors.append('%s must be one of %s' % (key, ', '.join(str(choice) for choice in CHOICES[key])))
+            continue
+        if default is None:
+            if value is None:
+                continue
+            expected = NULLABLE_TYPES[key]
+        elif isinstance(default, bool):
+            expected = bool
+        elif isinstance(default, NUMBER):
+            expected = NUMBER
+        else:
+            expected = type(default)
+        if expected is bool:
+            if not isinstance(value, bool):
+                errors.append('%s must be true or false' % key)
+        elif isinstance(value, bool) or not isinstance(value, expected):
+            errors.append('%s must be a %s' % (key, type_name(expected)))
+        elif key in POSITIVE_SETTINGS and value <= 0:
+            errors.append('%s must be greater than 0' % key)
+        elif isinstance(value, NUMBER) and value < 0:
+            errors.append('%s must not be negative' % key)
+    return errors
+
+
+def type_name(expected):
+    if expected == NUMBER:
+        return 'number'
+    if expected is int:
+        return 'whole number'
+    if isinstance(expected, tuple):
+        return ' or '.join(each.__name__ for each in expected)
+    return expected.__name__
+
+
+# Applies the settings of the config file and reloads them when the file changes
+class ConfigFileWatcher(object):
+    def __init__(self, path):
+        self.path = path
+        # Modification time and size of the file last loaded
+        self.file_stat = None
+        # Settings applied from the file, and the values they replaced
+        self.overrides = {}
+        self.replaced = {}
+        self.reload_loop = None
+
+    # Loads the file if it has changed since it was last loaded. Returns whether settings have been applied
+    def check(self, restart=False):
+        try:
+            stat = os.stat(self.path)
+            file_stat = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            file_stat = None
+        if file_stat == self.file_stat:
+            return False
+        self.file_stat = file_stat
+        return self.load(restart)
+
+    # Reads, validates and applies the file. An invalid file is ignored and the current settings are kept
+    # While running, changes to RESTART_SETTINGS are not applied. Returns whether settings have been applied
+    def load(self, restart=True):
+        try:
+            with open(self.path, 'r') as config_file:
+                settings = json.load(config_file)
+        except (IOError, OSError):
+            logger.error('Config file %s could not be read. Keeping the current settings', self.path)
+            return False
+        except ValueError:
+            logger.exception('Config file %s is not valid JSON. Keeping the current settings', self.path)
+            return False
+        errors = validate(settings)
+        if errors:
+            logger.error('Config file %s is invalid. Keeping the current settings: %s', self.path, '; '.join(errors))
+            return False
+
+        changes = {}
+        for key in set(self.overrides) | set(settings):
+            value = settings[key] if key in settings else self.replaced[key]
+            if value == config[key]:
+                continue
+            if not restart and key in RESTART_SETTINGS:
+                logger.warning('Config file changes %s, which is applied on the next start', key)
+                continue
+            changes[key] = value
+        for key in settings:
+            self.replaced.setdefault(key, config[key])
+        self.overrides = settings
+        if changes:
+            config.update(changes)
+            logger.info('Applied %d setting(s) from config file %s: %s', len(changes), self.path,
+                        ', '.join(sorted(changes)))
+        return bool(changes)
+
+    # Returns nothing, as a number returned to the scheduler would be taken as the next interval
+    def reload_cycle(self):
+        self.check()
+
+    # Checks the file for changes every CONFIG_RELOAD_INTERVAL seconds
+    def start(self):
+        # Imported here as the config file is first loaded while the config module itself is imported
+        import Scheduler
+
+        self.reload_loop = Scheduler.get_scheduler().schedule(
+            'ConfigReload', self.reload_cycle, lambda: config['CONFIG_RELOAD_INTERVAL'])
+        logger.info('Watching config file %s for changes', self.path)
+
+    def stop(self):
+        if self.reload_loop is not None:
+            self.reload_loop.cancel()
+            self.reload_loop.join()
+            self.reload_loop = None
+
+
+watcher = None
+
+
+# Returns the watcher of CONFIG_FILE, or None if there is no config file
+def get_watcher():
+    global watcher
+    if watcher is None and config['CONFIG_FILE']:
+        watcher = ConfigFileWatcher(SprinklerUtils.get_abs_path(config['CONFIG_FILE']))
+    return watcher
+
+
+# Applies CONFIG_FILE over the other settings. Called once while the config module is imported
+def load_config_file():
+    config_watcher = get_watcher()
+    if config_watcher is not None:
+        config_watcher.check(restart=True)
+
+
+# Starts reloading CONFIG_FILE when it changes
+def start_watching():
+    if get_watcher() is not None:
+        watcher.start()
+
+
+def stop_watching():
+    if watcher is not None:
+        watcher.stop()
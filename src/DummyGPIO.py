@@ -1,4 +1,11 @@
-# Dummy (non functional) module to emulate raspberry pi driver
+# Dummy module to emulate raspberry pi driver
+# Works as a hardware simulator: keeps the state of each pin and drives the registered edge callbacks from
+# simulated pulse trains, so that the components can be exercised at realistic load on any machine
+import itertools
+import random
+import threading
+
+import Clock
 
 HIGH=1
 LOW=0
@@ -14,23 +21,186 @@ PUD_DOWN=30
 RISING=41
 FALLING = 40
 
+# Pulse trains fire all due edges at once and then sleep for at least this long, so that rates of tens of kHz
+# can be sustained without sleeping between single edges
+PULSE_TRAIN_TICK = 0.001  # Seconds
+
+
+# State of a single pin
+class Pin(object):
+    def __init__(self, direction, pull_up_down):
+        self.direction = direction
+        self.pull_up_down = pull_up_down
+        self.value = HIGH if pull_up_down == PUD_UP else LOW
+        self.edge = None
+        self.callbacks = []
+
+
+lock = threading.RLock()
+mode = None
+pins = {}
+pulse_trains = []
+
+
 def setmode(x):
-    pass
+    global mode
+    mode = x
 
 def getmode():
-    return BOARD
+    return mode
 
-def setup(x,y,pull_up_down=None):
-    pass
+def setup(x,y,pull_up_down=None,initial=None):
+    with lock:
+        pin = Pin(y, pull_up_down)
+        if initial is not None:
+            pin.value = initial
+        pins[x] = pin
 
 def input(x):
-    pass
+    with lock:
+        pin = pins.get(x)
+        return pin.value if pin is not None else None
 
 def output(x, y):
-    pass
+    with lock:
+        pin = pins.setdefault(x, Pin(OUT, None))
+        pin.value = y
+        # Wakes the pulse trains, so that those gated by a pin react without polling
+        for train in pulse_trains:
+            train.changed.set()
 
 def cleanup():
-    pass
+    with lock:
+        trains = list(pulse_trains)
+    for train in trains:
+        train.stop()
+    with lock:
+        pins.clear()
+
+# Registers the callback for the given edge. Replaces any previous edge detection on the pin
+def add_event_detect(x,y,callback=None,bouncetime=None):
+    with lock:
+        pin = pins.setdefault(x, Pin(IN, None))
+        pin.edge = y
+        pin.callbacks = [callback] if callback is not None else []
+
+def add_event_callback(x, callback):
+    with lock:
+        pins[x].callbacks.append(callback)
+
+def remove_event_detect(x):
+    with lock:
+        pin = pins.get(x)
+        if pin is not None:
+            pin.edge = None
+            pin.callbacks = []
+
+
+# Fires the given number of rising edges on the pin synchronously in the calling thread
+def fire_edges(x, count=1):
+    with lock:
+        callbacks = list(pins[x].callbacks) if x in pins else []
+    for _ in range(count):
+        for callback in callbacks:
+            callback(x)
+
+
+# Pulse train generators. Each yields the intervals in seconds between consecutive pulses
+
+# Pulses at a constant rate (Hz)
+def constant_rate(rate):
+    return itertools.repeat(1.0 / rate)
+
+# Bursts of pulses at the given rate (Hz) lasting on_time seconds, separated by off_time seconds of no pulses
+def bursts(rate, on_time, off_time):
+    num_pulses = max(int(rate * on_time), 1)
+    while True:
+        for _ in range(num_pulses - 1):
+            yield 1.0 / rate
+        yield 1.0 / rate + off_time
+
+# Randomly varies each interval by up to +/- fraction. Deterministic for a given seed
+def jitter(intervals, fraction, seed=0):
+    rand = random.Random(seed)
+    for interval in intervals:
+        yield interval * (1 + rand.uniform(-fraction, fraction))
+
+
+# Drives the edge callbacks of a pin in a background thread from a pulse train generator
+# If gate_pin is given (e.g. a valve pin), pulses are only generated while that pin is HIGH, like water only
+# flowing while the valve is open. The pulses are timed and waited for on the client wide clock, so that a train runs
+# on the virtual clock of a simulation as well
+class PulseTrain(object):
+    def __init__(self, pin, intervals, gate_pin=None, max_pulses=None, clock=None):
+        self.pin = pin
+        self.intervals = iter(intervals)
+        self.gate_pin = gate_pin
+        self.max_pulses = max_pulses
+        self.clock = Clock.get_clock() if clock is None else clock
+        # Set when an output changes or the train is stopped
+        self.changed = threading.Event()
+        self.fired = 0
+        self.max_lag = 0.0
+        self.active = False
+        self.thread = None
+
+    def is_open(self):
+        return self.gate_pin is None or input(self.gate_pin) == HIGH
+
+    # Waits until the gate pin is HIGH. Returns whether the train is still active
+    def wait_for_gate(self):
+        while self.active and not self.is_open():
+            self.clock.wait(self.changed)
+            self.changed.clear()
+        return self.active
+
+    def run(self):
+        next_time = self.clock.time()
+        while self.active and (self.max_pulses is None or self.fired < self.max_pulses):
+            self.changed.clear()
+            if not self.is_open():
+                if not self.wait_for_gate():
+                    break
+                next_time = self.clock.time()
+            with lock:
+                callbacks = list(pins[self.pin].callbacks) if self.pin in pins else []
+            now = self.clock.time()
+            while next_time <= now and (self.max_pulses is None or self.fired < self.max_pulses):
+                for callback in callbacks:
+                    callback(self.pin)
+                self.fired += 1
+                self.max_lag = max(self.max_lag, now - next_time)
+                try:
+                    next_time += next(self.intervals)
+                except StopIteration:
+                    self.active = False
+                    return
+            self.clock.wait(self.changed, max(next_time - self.clock.time(), PULSE_TRAIN_TICK))
+
+    def start(self):
+        self.active = True
+        with lock:
+            pulse_trains.append(self)
+        self.thread = threading.Thread(target=self.run, name='PulseTrainThread-%s' % self.pin)
+        self.thread.daemon = True
+        self.clock.add_thread(self.thread)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with lock:
+            self.active = False
+            self.changed.set()
+            if self in pulse_trains:
+                pulse_trains.remove(self)
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    # Waits until the train has fired max_pulses or has been stopped
+    def join(self, timeout=None):
+        self.thread.join(timeout)
+
 
-def add_event_detect(x,y,callback=None):
-    pass
+# Starts driving the edge callbacks of a pin from a pulse train generator
+def start_pulse_train(x, intervals, gate_pin=None, max_pulses=None, clock=None):
+    return PulseTrain(x, intervals, gate_pin, max_pulses, clock).start()
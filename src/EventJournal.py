@@ -0,0 +1,288 @@
+# Compact binary journal of the recurring client events
+# Each event is a fixed 24 byte record, appended to size capped segment files. The oldest segments are deleted
+# beyond a maximum count, so the journal keeps a bounded history at a fraction of the bytes of the text log.
+# Records are buffered in memory and written in blocks, to keep the number of writes to the SD card low. The
+# buffer is also written every flush interval by a scheduled task, so that events do not stay in memory while no new
+# event arrives.
+#
+# Usage: python EventJournal.py [journal_dir] [--event valve_poll] [--since 1700000000] [--json] [--summary]
+import argparse
+import glob
+import json
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+
+import Clock
+import Scheduler
+import SprinklerUtils
+from SprinklerConfig import config
+
+logger = logging.getLogger(__name__)
+
+# Segment header: magic, version and record size
+HEADER = struct.Struct('<4sBxH')
+MAGIC = b'SPKJ'
+VERSION = 1
+# Record: time, event, code and three values whose meaning depends on the event
+RECORD = struct.Struct('<dBxhfff')
+SEGMENT_PATTERN = 'events-%010d.journal'
+
+# Events and the names of their code and values
+VALVE_POLL = 1
+VALVE_STATE = 2
+FLOW_INTERVAL = 3
+HTTP_REQUEST = 4
+FLOW_ANOMALY = 5
+EVENTS = {
+    VALVE_POLL: ('valve_poll', ('success', 'duration_ms', 'next_poll_sec', None)),
+    VALVE_STATE: ('valve_state', ('state', 'previous_state', 'pin', None)),
+    FLOW_INTERVAL: ('flow_interval', ('pin', 'volume', 'duration', 'pulses')),
+    HTTP_REQUEST: ('http_request', ('status', 'latency_ms', 'route', 'method')),
+    FLOW_ANOMALY: ('flow_anomaly', ('kind', 'rate', 'expected_rate', 'pin'))
+}
+EVENT_IDS = dict((name, event) for event, (name, _) in EVENTS.items())
+
+# API routes and methods are stored as their index. Status 0 means that the server could not be reached
+ROUTES = ['', '/valve', '/flow', '/flow/batch', '/zones/valve', '/zones/flow', '/schedule', '/schedule/runs']
+METHODS = ['GET', 'POST']
+# Flow anomaly kinds are stored as their index
+ANOMALY_KINDS = ['', 'leak', 'over_rate']
+
+
+# Appends event records to the segment files in a directory
+class EventJournal(object):
+    def __init__(self, journal_dir, segment_size=1048576, max_segments=16, flush_bytes=4096, flush_interval=60):
+        self.dir = journal_dir
+        self.segment_size = max(segment_size, HEADER.size + RECORD.size)
+        self.max_segments = max_segments
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.buffer = bytearray()
+        self.last_flush_time = Clock.now()
+        self.file = None
+        self.file_size = 0
+        self.flush_task = None
+        if not os.path.isdir(journal_dir):
+            os.makedirs(journal_dir)
+        segments = list_segments(journal_dir)
+        self.seq = segment_seq(segments[-1]) if segments else 0
+        if segments:
+            self.resume_segment(segments[-1])
+
+    # Continues writing the last segment, dropping a partially written record at its end
+    def resume_segment(self, path):
+        try:
+            with open(path, 'rb') as segment:
+                header = segment.read(HEADER.size)
+            valid = len(header) == HEADER.size and HEADER.unpack(header) == (MAGIC, VERSION, RECORD.size)
+        except (OSError, struct.error):
+            valid = False
+        if not valid:
+            logger.warning('Ignoring invalid journal segment %s', path)
+            return
+        size = os.path.getsize(path)
+        size -= (size - HEADER.size) % RECORD.size
+        self.file = open(path, 'r+b')
+        self.file.truncate(size)
+        self.file.seek(size)
+        self.file_size = size
+
+    # Closes the current segment and starts a new one, deleting the oldest segments beyond max_segments
+    def open_segment(self):
+        if self.file is not None:
+            self.file.close()
+        self.seq += 1
+        path = os.path.join(self.dir, SEGMENT_PATTERN % self.seq)
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+        self.file_size = HEADER.size
+        for old_path in list_segments(self.dir)[:-self.max_segments]:
+            os.remove(old_path)
+        logger.debug('Started journal segment %s', path)
+
+    # Appends an event. The record is written with the next flush
+    def record(self, event, code=0, a=0.0, b=0.0, c=0.0, event_time=None):
+        now = Clock.now()
+        with self.lock:
+            self.buffer += RECORD.pack(now if event_time is None else event_time, event, code, a, b, c)
+            if len(self.buffer) < self.flush_bytes and now - self.last_flush_time < self.flush_interval:
+                return
+        self.flush()
+
+    # Writes the buffered records, starting new segments as the current one fills up
+    def flush(self):
+        with self.lock:
+            data = bytes(self.buffer)
+            del self.buffer[:]
+            self.last_flush_time = Clock.now()
+            while data:
+                if self.file is None or self.file_size + RECORD.size > self.segment_size:
+                    self.open_segment()
+                room = (self.segment_size - self.file_size) // RECORD.size * RECORD.size
+                self.file.write(data[:room])
+                self.file_size += len(data[:room])
+                data = data[room:]
+            if self.file is not None:
+                self.file.flush()
+
+    # Starts writing the buffered records every flush interval
+    def start(self):
+        if self.flush_interval > 0:
+            self.flush_task = Scheduler.get_scheduler().schedule('EventJournal', self.flush_pending,
+                                                                 self.flush_interval, daemon=True)
+        return self
+
+    # Writes the buffered records if there are any
+    def flush_pending(self):
+        if self.buffer:
+            self.flush()
+
+    def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task.join()
+            self.flush_task = None
+        self.flush()
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def list_segments(journal_dir):
+    return sorted(glob.glob(os.path.join(journal_dir, SEGMENT_PATTERN.replace('%010d', '[0-9]' * 10))))
+
+
+def segment_seq(path):
+    return int(os.path.basename(path)[len('events-'):-len('.journal')])
+
+
+# Yields the records of a segment file as tuples of (time, event, code, a, b, c)
+def read_segment(path):
+    with open(path, 'rb') as segment:
+        header = segment.read(HEADER.size)
+        if len(header) < HEADER.size or HEADER.unpack(header) != (MAGIC, VERSION, RECORD.size):
+            logger.warning('Skipping invalid journal segment %s', path)
+            return
+        data = segment.read()
+    for record in RECORD.iter_unpack(data[:len(data) - len(data) % RECORD.size]):
+        yield record
+
+
+# Yields the records of all segments in a directory, oldest first
+def read_journal(journal_dir):
+    for path in list_segments(journal_dir):
+        for record in read_segment(path):
+            yield record
+
+
+# Converts a record into a dict with the field names of its event
+def decode(record):
+    event_time, event, code, a, b, c = record
+    name, fields = EVENTS.get(event, ('unknown_%d' % event, ('code', 'a', 'b', 'c')))
+    decoded = {'time': event_time, 'event': name}
+    for field, value in zip(fields, (code, a, b, c)):
+        if field is not None:
+            decoded[field] = value
+    if event == HTTP_REQUEST:
+        decoded['route'] = ROUTES[int(b)] if 0 <= int(b) < len(ROUTES) else ''
+        decoded['method'] = METHODS[int(c)] if 0 <= int(c) < len(METHODS) else ''
+    if event == FLOW_INTERVAL:
+        decoded['pulses'] = int(c)
+    if event == FLOW_ANOMALY:
+        decoded['kind'] = ANOMALY_KINDS[code] if 0 <= code < len(ANOMALY_KINDS) else ''
+        decoded['pin'] = int(c)
+    return decoded
+
+
+journal = None
+journal_lock = threading.Lock()
+
+
+# Returns the client wide journal, or None if the journal is disabled
+def get_journal():
+    global journal
+    if journal is None and config['JOURNAL_DIR']:
+        with journal_lock:
+            if journal is None:
+                journal = EventJournal(SprinklerUtils.get_abs_path(config['JOURNAL_DIR']),
+                                       config['JOURNAL_SEGMENT_SIZE'], config['JOURNAL_MAX_SEGMENTS'],
+                                       config['JOURNAL_FLUSH_BYTES'], config['JOURNAL_FLUSH_INTERVAL']).start()
+    return journal
+
+
+# Appends an event to the client wide journal if enabled
+def record(event, code=0, a=0.0, b=0.0, c=0.0):
+    event_journal = get_journal()
+    if event_journal is not None:
+        event_journal.record(event, code, a, b, c)
+
+
+# Records the outcome of a request to the server. Status is None if the server could not be reached
+def record_http_request(method, path, status, latency):
+    route = ROUTES.index(path) if path in ROUTES else 0
+    record(HTTP_REQUEST, status or 0, latency * 1000, route, METHODS.index(method) if method in METHODS else -1)
+
+
+# Writes the buffered events and closes the client wide journal
+def close_journal():
+    global journal
+    with journal_lock:
+        if journal is not None:
+            journal.close()
+            journal = None
+
+
+# Per event counts and averages of the values
+def summarize(records):
+    summary = {}
+    for record in records:
+        decoded = decode(record)
+        stats = summary.setdefault(decoded['event'], {'count': 0})
+        stats['count'] += 1
+        for field, value in decoded.items():
+            if field not in ('time', 'event') and isinstance(value, (int, float)):
+                stats[field + '_total'] = stats.get(field + '_total', 0) + value
+    for stats in summary.values():
+        for field in [field for field in stats if field.endswith('_total')]:
+            stats[field[:-len('_total')] + '_mean'] = stats.pop(field) / stats['count']
+    return summary
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Decodes the sprinkler client event journal')
+    parser.add_argument('journal_dir', nargs='?', help='Journal directory. Defaults to JOURNAL_DIR')
+    parser.add_argument('--event', choices=sorted(EVENT_IDS), help='Only shows this event')
+    parser.add_argument('--since', type=float, help='Only shows events after this unix time')
+    parser.add_argument('--json', action='store_true', help='One JSON object per line')
+    parser.add_argument('--summary', action='store_true', help='Only shows per event counts and means')
+    args = parser.parse_args(args)
+    journal_dir = args.journal_dir or (config['JOURNAL_DIR'] and SprinklerUtils.get_abs_path(config['JOURNAL_DIR']))
+    if not journal_dir:
+        parser.error('No journal directory given and JOURNAL_DIR is not configured')
+
+    records = (record for record in read_journal(journal_dir)
+               if (args.event is None or record[1] == EVENT_IDS[args.event]) and
+               (args.since is None or record[0] >= args.since))
+    if args.summary:
+        print(json.dumps(summarize(records), indent=2, sort_keys=True))
+        return
+    for record in records:
+        decoded = decode(record)
+        if args.json:
+            print(json.dumps(decoded, sort_keys=True))
+            continue
+        event_time = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(decoded.pop('time')))
+        event = decoded.pop('event')
+        print('%s %-14s %s' % (event_time, event, ' '.join(
+            '%s=%s' % (field, ('%.3f' % value) if isinstance(value, float) else value)
+            for field, value in sorted(decoded.items()))))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
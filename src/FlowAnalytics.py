@@ -0,0 +1,271 @@
+import bisect
+import logging
+import math
+import threading
+
+import Clock
+import ConfigSnapshot
+import EventJournal
+import Scheduler
+import SprinklerMetrics
+from GPIOWrapper import pins
+from SprinklerConfig import config
+
+logger = logging.getLogger(__name__)
+
+# Kinds of flow anomalies
+LEAK = 'leak'
+OVER_RATE = 'over_rate'
+
+
+# Exponentially weighted moving mean and variance
+class EwmaStats(object):
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.mean = None
+        self.variance = 0.0
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if self.mean is None:
+            self.mean = value
+            return
+        diff = value - self.mean
+        increment = self.alpha * diff
+        self.mean += increment
+        self.variance = (1 - self.alpha) * (self.variance + diff * increment)
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+
+# Streaming estimate of a quantile with the P-square algorithm (Jain and Chlamtac, 1985)
+# Keeps five markers whose heights are adjusted with a piecewise parabolic fit as values arrive, so memory is
+# constant regardless of how many values have been seen
+class P2Quantile(object):
+    def __init__(self, p):
+        self.p = p
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, value):
+        heights = self.heights
+        if len(heights) < 5:
+            bisect.insort(heights, value)
+            return
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = bisect.bisect_right(heights, value) - 1
+        positions = self.positions
+        for i in range(cell + 1, 5):
+            positions[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+        for i in range(1, 4):
+            offset = self.desired[i] - positions[i]
+            if (offset >= 1 and positions[i + 1] - positions[i] > 1) or \
+                    (offset <= -1 and positions[i - 1] - positions[i] < -1):
+                step = 1 if offset > 0 else -1
+                height = self.parabolic(i, step)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = heights[i] + step * (heights[i + step] - heights[i]) / (positions[i + step] - positions[i])
+                heights[i] = height
+                positions[i] += step
+
+    def parabolic(self, i, step):
+        q, n = self.heights, self.positions
+        return q[i] + step / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + step) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - step) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+
+    # Current estimate, or None if no values have been seen
+    def value(self):
+        if not self.heights:
+            return None
+        if len(self.heights) < 5:
+            return self.heights[min(int(round(self.p * (len(self.heights) - 1))), len(self.heights) - 1)]
+        return self.heights[2]
+
+
+# Streaming flow rate analytics and leak detection for a flow sensor
+# Samples the total pulse count of the pulse accumulator at a fixed interval, so the edge path is not touched, and
+# keeps moving rate statistics and quantile sketches in constant memory.
+# Raises an anomaly when water flows while the valve is closed (leak), or when the flow is above the expected rate
+# (over_rate) for FLOW_ANOMALY_SAMPLES consecutive samples. The samples are taken often enough to raise an anomaly
+# within FLOW_ANOMALY_LATENCY seconds, see sample_interval. The expected rate is FLOW_EXPECTED_RATE, or learned from
+# the flow while the valve is open. Anomalies are logged, journaled, counted in the metrics and passed to listeners.
+# Each sample reads its settings from one config snapshot
+class FlowAnalytics(ConfigSnapshot.SnapshotBound):
+    def __init__(self, pin, accumulator, clock=Clock.monotonic, k_table=None):
+        self.pin = pin
+        self.accumulator = accumulator
+        self.clock = clock
+        # K-factors by flow rate. PULSES_PER_LITRE is used for all flow rates if None
+        self.k_table = k_table
+        self.valve = None
+        alpha = self.bind()['FLOW_ANALYTICS_ALPHA']
+        # Statistics of the non-zero flow rates (litres/minute)
+        self.rate = EwmaStats(alpha)
+        self.quantiles = {50: P2Quantile(0.5), 95: P2Quantile(0.95)}
+        # Statistics of the flow rates while the valve is open, excluding anomalies
+        self.open_rate = EwmaStats(alpha)
+        self.last_total = accumulator.snapshot()[0]
+        self.last_time = clock()
+        self.last_rate = 0.0
+        self.valve_state = None
+        self.valve_state_time = self.last_time
+        self.streaks = {LEAK: 0, OVER_RATE: 0}
+        # Anomalies in progress by kind
+        self.anomalies = {}
+        self.listeners = []
+
+    # Calls listener with a dict describing each anomaly as it is raised
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    # Rate the flow is expected to stay under while the valve is open, or None if not known yet
+    def expected_rate(self):
+        if self.settings['FLOW_EXPECTED_RATE'] is not None:
+            return self.settings['FLOW_EXPECTED_RATE']
+        if self.open_rate.count < self.settings['FLOW_EXPECTED_RATE_WARMUP']:
+            return None
+        return self.open_rate.mean
+
+    # Takes a sample of the pulse count and updates the statistics and the anomalies
+    def sample(self, now=None):
+        now = self.clock() if now is None else now
+        settings = self.bind()
+        total = self.accumulator.snapshot()[0]
+        elapsed = now - self.last_time
+        if elapsed <= 0:
+            return
+        pulses = total - self.last_total
+        pulses_per_litre = settings['PULSES_PER_LITRE'] if self.k_table is None else \
+            self.k_table.pulses_per_litre(pulses, elapsed)
+        rate = pulses * 60.0 / (pulses_per_litre * elapsed)
+        self.last_total, self.last_time, self.last_rate = total, now, rate
+        if rate > 0:
+            self.rate.add(rate)
+            for quantile in self.quantiles.values():
+                quantile.add(rate)
+            SprinklerMetrics.FLOW_RATE_EWMA.labels(self.pin).set(self.rate.mean)
+
+        valve_state = self.valve.state if self.valve is not None else None
+        if valve_state != self.valve_state:
+            self.valve_state, self.valve_state_time = valve_state, now
+        settled = now - self.valve_state_time >= settings['FLOW_LEAK_GRACE_PERIOD']
+        leak = valve_state == pins.LOW and settled and rate >= settings['FLOW_LEAK_MIN_RATE']
+        expected = self.expected_rate()
+        over_rate = expected is not None and rate > expected * settings['FLOW_OVER_RATE_FACTOR']
+        self.check(LEAK, leak, rate, 0.0)
+        self.check(OVER_RATE, over_rate, rate, expected)
+        if valve_state == pins.HIGH and rate > 0 and not over_rate:
+            self.open_rate.add(rate)
+
+    # Raises or clears an anomaly of the given kind
+    def check(self, kind, anomalous, rate, expected):
+        if not anomalous:
+            self.streaks[kind] = 0
+            if self.anomalies.pop(kind, None) is not None:
+                logger.info('Flow anomaly %s at pin %d has cleared', kind, self.pin)
+            return
+        self.streaks[kind] += 1
+        if kind in self.anomalies or self.streaks[kind] < self.settings['FLOW_ANOMALY_SAMPLES']:
+            return
+        anomaly = {
+            'kind': kind,
+            'pin': self.pin,
+            'time': Clock.now(),
+            'rate': rate,
+            'expected_rate': expected,
+            'valve_state': self.valve_state
+        }
+        self.anomalies[kind] = anomaly
+        logger.warning('Flow anomaly %s at pin %d: %.2f litres/minute (expected %s)', kind, self.pin, rate,
+                       '%.2f' % expected if expected else 'none')
+        EventJournal.record(EventJournal.FLOW_ANOMALY, EventJournal.ANOMALY_KINDS.index(kind), rate, expected or 0.0,
+                            self.pin)
+        SprinklerMetrics.FLOW_ANOMALIES.labels(self.pin, kind).inc()
+        for listener in self.listeners:
+            try:
+                listener(anomaly)
+            except Exception:
+                logger.exception('Flow anomaly listener failed')
+
+    # Summary of the rate statistics
+    def stats(self):
+        stats = {
+            'rate': self.last_rate,
+            'mean': self.rate.mean,
+            'std': self.rate.std,
+            'samples': self.rate.count,
+            'expected_rate': self.expected_rate(),
+            'anomalies': sorted(self.anomalies)
+        }
+        for p, quantile in self.quantiles.items():
+            stats['p%d' % p] = quantile.value()
+        return stats
+
+
+# Samples the flow analytics of all flow sensors from a single scheduled task, so that each zone does not run a thread
+# of its own. The task runs while at least one flow analytics is added
+class AnalyticsSampler(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.analytics = []
+        self.task = None
+
+    def add(self, analytics):
+        with self.lock:
+            if analytics in self.analytics:
+                return
+            self.analytics.append(analytics)
+            if self.task is None:
+                self.task = Scheduler.get_scheduler().schedule('FlowAnalytics', self.sample,
+                                                               lambda: sample_interval(config))
+
+    # Stops sampling the given flow analytics. The task is stopped along with the last one
+    def remove(self, analytics):
+        with self.lock:
+            if analytics in self.analytics:
+                self.analytics.remove(analytics)
+            task = None
+            if not self.analytics:
+                task, self.task = self.task, None
+        if task is not None:
+            task.cancel()
+            task.join()
+
+    def sample(self):
+        with self.lock:
+            analytics_list = list(self.analytics)
+        for analytics in analytics_list:
+            try:
+                analytics.sample()
+            except Exception:
+                logger.exception('Flow analytics of pin %s failed to sample', analytics.pin)
+
+
+sampler = AnalyticsSampler()
+
+
+# Seconds between flow rate samples. FLOW_ANALYTICS_INTERVAL, shortened so that an anomaly is raised within
+# FLOW_ANOMALY_LATENCY seconds: The first sample after an anomaly starts may only partly cover it, and
+# FLOW_ANOMALY_SAMPLES more are needed to raise it
+def sample_interval(settings):
+    return min(settings['FLOW_ANALYTICS_INTERVAL'],
+               float(settings['FLOW_ANOMALY_LATENCY']) / (settings['FLOW_ANOMALY_SAMPLES'] + 1))
+
+
+# Returns the client wide analytics sampler
+def get_sampler():
+    return sampler
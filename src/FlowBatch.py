@@ -0,0 +1,114 @@
+import collections
+import itertools
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# In-memory queue of flow interval records waiting to be uploaded together
+# Has the same peek/commit interface as the flow outbox, but the records are not durable, so their pulses stay pending
+# in the pulse accumulator until the server has acknowledged them.
+# Memory is bounded by merging the two oldest records into one once max_records are pending, so no pulses are lost
+# while the server is unreachable, only the resolution of the oldest intervals.
+# Each record has a sequence number. Records handed out by the last peek are in flight and never merged, so commit
+# removes exactly the records the server has acknowledged, and the queue may exceed max_records by the records in flight
+class FlowBatch(object):
+    durable = False
+
+    def __init__(self, max_records):
+        self.max_records = max(max_records, 1)
+        self.lock = threading.Lock()
+        self.records = collections.deque()
+        self.next_seq = itertools.count()
+        # Sequence number of the last record in flight, or None if no upload is in progress
+        self.in_flight = None
+        self.merged = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    # Appends a recorded interval along with its flow rate summary, if any
+    def append(self, end_time, duration, volume, pulses, rate=None):
+        with self.lock:
+            record = {
+                'seq': next(self.next_seq),
+                'time': end_time,
+                'duration': duration,
+                'volume': volume,
+                'pulses': pulses
+            }
+            if rate is not None:
+                record['rate'] = rate
+            self.records.append(record)
+            while len(self.records) > self.max_records and self.merge_oldest():
+                pass
+
+    # Number of records at the start of the queue that are in flight. Must be called with the lock held
+    def count_in_flight(self):
+        if self.in_flight is None:
+            return 0
+        return sum(1 for _ in itertools.takewhile(lambda record: record['seq'] <= self.in_flight, self.records))
+
+    # Merges the two oldest records that are not in flight into one covering both intervals. Returns whether there
+    # were two to merge. Must be called with the lock held
+    def merge_oldest(self):
+        index = self.count_in_flight()
+        if len(self.records) - index < 2:
+            return False
+        first = self.records[index]
+        del self.records[index]
+        second = self.records[index]
+        second['duration'] += first['duration']
+        second['volume'] += first['volume']
+        second['pulses'] += first['pulses']
+        rate = merge_rates(first.get('rate'), second.get('rate'))
+        if rate is not None:
+            second['rate'] = rate
+        self.merged += 1
+        if self.merged == 1 or self.merged % 1000 == 0:
+            logger.warning('Flow batch is full. %d record(s) merged so far', self.merged)
+        return True
+
+    # End time of the oldest pending record, or None if there are none
+    def oldest_time(self):
+        with self.lock:
+            return self.records[0]['time'] if self.records else None
+
+    # Returns copies of up to max_records of the oldest pending records, without their sequence numbers,
+    # along with the sequence number of the first one, to be passed back to commit
+    # The returned records are in flight until the next commit or peek
+    def peek(self, max_records):
+        with self.lock:
+            peeked = list(itertools.islice(self.records, max_records))
+            if not peeked:
+                self.in_flight = None
+                return None, []
+            self.in_flight = peeked[-1]['seq']
+            records = [dict((key, value) for key, value in record.items() if key != 'seq') for record in peeked]
+            return peeked[0]['seq'], records
+
+    # Removes the records peeked from seq onwards after they have been saved at the server
+    # Returns the removed records, so the pulses of the returned records are exactly the ones the server has
+    # acknowledged
+    def commit(self, seq, num_records):
+        removed = []
+        with self.lock:
+            while self.records and len(removed) < num_records and seq <= self.records[0]['seq'] and \
+                    (self.in_flight is None or self.records[0]['seq'] <= self.in_flight):
+                removed.append(self.records.popleft())
+            self.in_flight = None
+        return removed
+
+
+# Combines the flow rate summaries of two consecutive intervals. Either may be None
+# Percentiles cannot be combined, so the merged summary only has the min, max and mean
+def merge_rates(first, second):
+    if first is None or second is None:
+        return second if first is None else first
+    samples = first['samples'] + second['samples']
+    return {
+        'min': min(first['min'], second['min']),
+        'max': max(first['max'], second['max']),
+        'mean': (first['mean'] * first['samples'] + second['mean'] * second['samples']) / samples,
+        'samples': samples
+    }
@@ -0,0 +1,318 @@
+# Flow sensor calibration
+# Hall effect flow sensors give fewer pulses per litre at low flow rates than at high ones, so a single K-factor
+# (pulses/litre) is only right for one flow rate. Calibration runs pass a known volume through the sensor while the
+# timestamp of every pulse is captured. A piecewise linear K-factor curve over the pulse rate is fitted to the runs by
+# least squares and emitted as a lookup table with one K-factor per pulse rate bucket. The flow sensor counts its
+# pulses by rate bucket as they arrive and reads each bucket at its K-factor. The error of the table is validated on
+# runs held out of the fit.
+#
+# Usage: python FlowCalibration.py capture runs.jsonl --volume 1 [--pin 38]
+#        python FlowCalibration.py fit runs.jsonl [--output ../data/flow-calibration.json] [--bucket-width 10]
+import argparse
+import array
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+
+import SprinklerUtils
+from SprinklerConfig import config
+
+logger = logging.getLogger(__name__)
+
+# Optional. Needed for fitting, readings fall back to plain Python without it
+numpy = SprinklerUtils.lazy_import('numpy')
+
+# Pulses over which the pulse rate at each pulse of a run is measured
+RATE_WINDOW = 8
+# Weight of the differences of the K-factor curve between neighbouring buckets, relative to the data
+# Keeps the curve smooth and fills the buckets without calibration data from their neighbours
+DEFAULT_SMOOTHING = 0.1
+DEFAULT_BUCKET_WIDTH = 10  # Pulses/second
+DEFAULT_BUCKETS = 20
+DEFAULT_FOLDS = 5
+
+
+# K-factors by pulse rate bucket
+# Bucket i covers the pulse rates [i * bucket_width, (i + 1) * bucket_width). Rates beyond the last bucket use it
+class KFactorTable(object):
+    def __init__(self, bucket_width, k_factors, validation=None):
+        if bucket_width <= 0 or not len(k_factors) or any(k <= 0 for k in k_factors):
+            raise ValueError('Invalid K-factor table: bucket width %s, K-factors %s' % (bucket_width, k_factors))
+        self.bucket_width = float(bucket_width)
+        self.k_factors = [float(k) for k in k_factors]
+        self.litres_per_pulse = [1.0 / k for k in self.k_factors]
+        self.last_bucket = len(self.k_factors) - 1
+        self.validation = validation
+
+    @staticmethod
+    def from_dict(data):
+        try:
+            return KFactorTable(data['bucket_width'], data['k_factors'], data.get('validation'))
+        except (KeyError, TypeError, AttributeError):
+            raise ValueError('Invalid K-factor table: %s' % data)
+
+    def to_dict(self):
+        return {'bucket_width': self.bucket_width, 'k_factors': self.k_factors, 'validation': self.validation}
+
+    # K-factor of the bucket of the given pulse rate
+    def k_factor(self, rate):
+        return self.k_factors[min(int(rate / self.bucket_width), self.last_bucket)]
+
+    # Litres of pulses counted by bucket
+    def counts_volume(self, counts):
+        return sum(count * litres for count, litres in zip(counts, self.litres_per_pulse))
+
+    # Pulse counts by bucket of the given pulse rates
+    def bucket_counts(self, rates):
+        if numpy is not None:
+            buckets = numpy.minimum((numpy.asarray(rates) / self.bucket_width).astype(int), self.last_bucket)
+            return numpy.bincount(buckets, minlength=len(self.k_factors)).tolist()
+        counts = [0] * len(self.k_factors)
+        for rate in rates:
+            counts[min(int(rate / self.bucket_width), self.last_bucket)] += 1
+        return counts
+
+    # K-factor for a reading of pulses over duration seconds, at the mean pulse rate of the reading
+    def pulses_per_litre(self, pulses, duration):
+        return self.k_factor(pulses / duration if duration > 0 else 0.0)
+
+    # Litres of the pulses of a calibration run at the given timestamps, each read at the K-factor of the pulse rate
+    # around it, the same way the runs are modelled when fitting
+    def volume(self, timestamps):
+        if len(timestamps) < 2:
+            return len(timestamps) / self.k_factor(0.0)
+        return self.counts_volume(self.bucket_counts(pulse_rates(timestamps)))
+
+
+# Pulse counts by rate bucket of a K-factor table, counted by the edge callback
+# Each edge measures the pulse rate over the RATE_WINDOW pulses before it and counts itself in the bucket of that rate,
+# so that a reading is read at the K-factors of its pulses from the counts of its buckets, at a cost independent of
+# the number of pulses. The rate trails the centred rate of the fit by a few pulses when the flow changes
+class PulseRateHistogram(object):
+    def __init__(self, table, clock=time.monotonic):
+        self.table = table
+        self.counts = array.array('q', [0]) * len(table.k_factors)
+        # Timestamps of the last RATE_WINDOW edges. Unused slots hold -inf, which gives the edges the lowest rate
+        self.recent = array.array('d', [float('-inf')]) * RATE_WINDOW
+        self.clock = clock
+        self._index = itertools.count()
+
+    # Returns an edge callback for the GPIO module that counts the edge in the bucket of its rate and then calls record
+    def make_edge_callback(self, record):
+        def edge_callback(_channel, record=record, index=self._index.__next__, recent=self.recent, counts=self.counts,
+                          clock=self.clock, scale=RATE_WINDOW / self.table.bucket_width, last=self.table.last_bucket):
+            now = clock()
+            slot = index() % RATE_WINDOW
+            span = now - recent[slot]
+            recent[slot] = now
+            counts[min(int(scale / span), last) if span > 0 else last] += 1
+            record()
+
+        return edge_callback
+
+    # Pulse counts by bucket since creation
+    def snapshot(self):
+        return self.counts[:]
+
+
+# Reads a K-factor table. Returns None if it cannot be read
+def load_k_table(path):
+    try:
+        with open(path, 'r') as table_file:
+            table = KFactorTable.from_dict(json.load(table_file))
+    except (IOError, OSError):
+        logger.error('Flow calibration %s could not be read. Using PULSES_PER_LITRE', path)
+        return None
+    except ValueError:
+        logger.exception('Flow calibration %s is invalid. Using PULSES_PER_LITRE', path)
+        return None
+    logger.info('Loaded flow calibration %s with %d bucket(s)', path, len(table.k_factors))
+    return table
+
+
+def save_k_table(path, table):
+    dir_path = os.path.dirname(path)
+    if dir_path and not os.path.isdir(dir_path):
+        os.makedirs(dir_path)
+    with open(path, 'w') as table_file:
+        json.dump(table.to_dict(), table_file, indent=2)
+
+
+# Records the timestamps of the pulses of a flow sensor while a calibration run is in progress
+class PulseRecorder(object):
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.timestamps = array.array('d')
+        self.recording = False
+
+    def edge_callback(self, _channel):
+        if self.recording:
+            self.timestamps.append(self.clock())
+
+    def start(self):
+        del self.timestamps[:]
+        self.recording = True
+
+    # Stops recording and returns the run of the given volume
+    def stop(self, volume):
+        self.recording = False
+        return make_run(volume, self.timestamps)
+
+
+# Calibration run of a known volume (litres). Timestamps are in seconds from the first pulse
+def make_run(volume, timestamps):
+    start = timestamps[0] if len(timestamps) else 0.0
+    return {'volume': volume, 'timestamps': [timestamp - start for timestamp in timestamps]}
+
+
+def load_runs(path):
+    with open(path, 'r') as runs_file:
+        return [json.loads(line) for line in runs_file if line.strip()]
+
+
+def append_run(path, run):
+    with open(path, 'a') as runs_file:
+        runs_file.write(json.dumps(run) + '\n')
+
+
+# Pulse rate (pulses/second) at each pulse of a run, measured over the RATE_WINDOW pulses around it
+# Needs at least 2 pulses. Falls back to plain Python on a device without numpy
+def pulse_rates(timestamps):
+    window = min(RATE_WINDOW, len(timestamps) - 1)
+    if numpy is None:
+        rates = [window / max(end - start, 1e-6) for start, end in zip(timestamps, timestamps[window:])]
+        return [rates[min(max(i - window // 2, 0), len(rates) - 1)] for i in range(len(timestamps))]
+    timestamps = numpy.asarray(timestamps, dtype=numpy.float64)
+    spans = numpy.maximum(timestamps[window:] - timestamps[:-window], 1e-6)
+    rates = window / spans
+    first = numpy.clip(numpy.arange(len(timestamps)) - window // 2, 0, len(rates) - 1)
+    return rates[first]
+
+
+# Weights of the pulses of a run on the knots of the K-factor curve, which are at the centres of the buckets
+# The curve is linear between the knots, so each pulse is shared between the two knots around its rate
+def knot_weights(rates, bucket_width, buckets):
+    if buckets == 1:
+        return numpy.array([float(len(rates))])
+    position = numpy.clip(rates / bucket_width - 0.5, 0, buckets - 1)
+    lower = numpy.minimum(position.astype(int), buckets - 2)
+    upper_share = position - lower
+    return numpy.bincount(lower, 1 - upper_share, buckets) + numpy.bincount(lower + 1, upper_share, buckets)
+
+
+# Fits the K-factors at the knots of the curve to the runs
+# The volume of a run is the sum over its pulses of the litres per pulse at their rate, which is linear in the litres
+# per pulse at the knots. All runs are solved at once as a least squares problem, weighted so that the relative error
+# of the runs is minimized
+def fit_k_factors(runs, bucket_width=DEFAULT_BUCKET_WIDTH, buckets=DEFAULT_BUCKETS, smoothing=DEFAULT_SMOOTHING):
+    if numpy is None:
+        raise RuntimeError('numpy is required to fit a flow calibration')
+    runs = [run for run in runs if len(run['timestamps']) >= 2 and run['volume'] > 0]
+    if not runs:
+        raise ValueError('No calibration runs with at least 2 pulses')
+    volumes = numpy.array([float(run['volume']) for run in runs])
+    weights = numpy.vstack([knot_weights(pulse_rates(run['timestamps']), bucket_width, buckets) for run in runs])
+    weights /= volumes[:, numpy.newaxis]
+    differences = numpy.diff(numpy.eye(buckets), axis=0) * smoothing * weights.sum(axis=1).mean()
+    solution = numpy.linalg.lstsq(numpy.vstack((weights, differences)),
+                                  numpy.concatenate((numpy.ones(len(runs)), numpy.zeros(buckets - 1))), rcond=None)[0]
+    if (solution <= 0).any():
+        raise ValueError('Calibration runs do not give a positive K-factor for every bucket')
+    return [float(k) for k in 1.0 / solution]
+
+
+# Relative volume error (%) of the table on the runs, reading each pulse at the K-factor of its rate bucket the way
+# the flow sensor does
+def volume_errors(table, runs):
+    return [(table.volume(run['timestamps']) - run['volume']) * 100.0 / run['volume'] for run in runs]
+
+
+def error_summary(errors):
+    errors = [abs(error) for error in errors]
+    return {'mean_abs_error_pct': sum(errors) / len(errors), 'max_abs_error_pct': max(errors)}
+
+
+# Validates the fit with k-fold cross validation. Each run is read with a table fitted to the runs of the other folds
+# Reports the errors of the tables, and of a single K-factor fitted to the same runs for comparison
+def cross_validate(runs, bucket_width, buckets, smoothing, folds=DEFAULT_FOLDS):
+    folds = min(folds, len(runs))
+    if folds < 2:
+        return None
+    table_errors, constant_errors = [], []
+    for fold in range(folds):
+        training = [run for i, run in enumerate(runs) if i % folds != fold]
+        held_out = [run for i, run in enumerate(runs) if i % folds == fold]
+        table = KFactorTable(bucket_width, fit_k_factors(training, bucket_width, buckets, smoothing))
+        k_factor = sum(len(run['timestamps']) for run in training) / sum(run['volume'] for run in training)
+        table_errors += volume_errors(table, held_out)
+        constant_errors += volume_errors(KFactorTable(bucket_width, [k_factor]), held_out)
+    validation = error_summary(table_errors)
+    validation.update(('constant_' + key, value) for key, value in error_summary(constant_errors).items())
+    validation.update({'runs': len(runs), 'folds': folds})
+    return validation
+
+
+# Fits the K-factor table to the runs and validates it
+def calibrate(runs, bucket_width=DEFAULT_BUCKET_WIDTH, buckets=DEFAULT_BUCKETS, smoothing=DEFAULT_SMOOTHING,
+              folds=DEFAULT_FOLDS):
+    runs = [run for run in runs if len(run['timestamps']) >= 2 and run['volume'] > 0]
+    k_factors = fit_k_factors(runs, bucket_width, buckets, smoothing)
+    validation = cross_validate(runs, bucket_width, buckets, smoothing, folds)
+    return KFactorTable(bucket_width, [round(k, 3) for k in k_factors], validation)
+
+
+# Interactively captures calibration runs of the given volume, appending each to the runs file
+# GPIO is only imported here, so that runs can be fitted on a machine other than the device
+def capture(runs_path, volume, pin):
+    from GPIOWrapper import pins
+    recorder = PulseRecorder()
+    pins.setmode(pins.BOARD)
+    pins.setup(pin, pins.IN, pull_up_down=pins.PUD_DOWN)
+    pins.add_event_detect(pin, pins.RISING, callback=recorder.edge_callback)
+    try:
+        while input('Press ENTER and let %s litre(s) flow, or q to quit: ' % volume).strip().lower() != 'q':
+            recorder.start()
+            input('Press ENTER once %s litre(s) have flowed: ' % volume)
+            run = recorder.stop(volume)
+            append_run(runs_path, run)
+            duration = run['timestamps'][-1] if run['timestamps'] else 0.0
+            print('Captured %d pulses in %.1f seconds' % (len(run['timestamps']), duration))
+    finally:
+        pins.cleanup()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Calibrates the flow sensor')
+    commands = parser.add_subparsers(dest='command', required=True)
+    capture_parser = commands.add_parser('capture', help='Captures calibration runs of a known volume')
+    capture_parser.add_argument('runs', help='File the runs are appended to')
+    capture_parser.add_argument('--volume', type=float, required=True, help='Litres passed through the sensor per run')
+    capture_parser.add_argument('--pin', type=int, default=config['FLOW_SENSOR_PIN'], help='Flow sensor pin')
+    fit_parser = commands.add_parser('fit', help='Fits a K-factor table to the captured runs')
+    fit_parser.add_argument('runs', help='File of the captured runs')
+    fit_parser.add_argument('--output', help='Table file. Defaults to FLOW_CALIBRATION_FILE')
+    fit_parser.add_argument('--bucket-width', type=float, default=DEFAULT_BUCKET_WIDTH, help='Pulses/second')
+    fit_parser.add_argument('--buckets', type=int, default=DEFAULT_BUCKETS)
+    fit_parser.add_argument('--smoothing', type=float, default=DEFAULT_SMOOTHING)
+    fit_parser.add_argument('--folds', type=int, default=DEFAULT_FOLDS, help='Folds of the cross validation')
+    args = parser.parse_args(args)
+
+    if args.command == 'capture':
+        if args.pin is None:
+            parser.error('No pin given and FLOW_SENSOR_PIN is not configured')
+        capture(args.runs, args.volume, args.pin)
+        return
+    table = calibrate(load_runs(args.runs), args.bucket_width, args.buckets, args.smoothing, args.folds)
+    output = args.output or (config['FLOW_CALIBRATION_FILE'] and
+                             SprinklerUtils.get_abs_path(config['FLOW_CALIBRATION_FILE']))
+    print(json.dumps(table.to_dict(), indent=2))
+    if output:
+        save_k_table(output, table)
+        print('Saved flow calibration to %s' % output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,147 @@
+import logging
+import os
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Fixed size record: end time of the interval, duration, volume, pulses
+RECORD = struct.Struct('<dffI')
+
+
+# Durable, append-only on-disk queue of flow interval records
+# Records are appended to a data file with a single write each. Drained records are not removed from the data file,
+# instead the index of the first pending record is kept in a small head file. Both files are truncated once everything
+# has been drained, so in the common case the SD card only sees the appends.
+# Disk usage is bounded by evicting the oldest records once max_records are pending.
+# With fsync, appends and compactions are synced to the card before they return, so a record survives a power cut as
+# soon as its pulses are reset. Without it the last records may be lost in exchange for fewer card writes. The head
+# file is never synced, since losing it only uploads some records again
+class FlowOutbox(object):
+    durable = True
+
+    def __init__(self, path, max_records, fsync=True):
+        self.path = path
+        self.head_path = path + '.head'
+        self.max_records = max_records
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.evicted = 0
+        # Number of records removed from the start of the data file since opening. Used to keep the sequence numbers
+        # handed out by peek valid across compactions
+        self.base = 0
+        dir_path = os.path.dirname(path)
+        if dir_path and not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        self.head = self.read_head()
+        self.total = self.read_total()
+        if self.head > self.total:
+            logger.error('Flow outbox head (%d) is beyond the last record (%d). Resetting head', self.head, self.total)
+            self.head = self.total
+        logger.debug('Flow outbox opened at %s with %d pending record(s)', path, len(self))
+
+    def __len__(self):
+        return self.total - self.head
+
+    # Reads the index of the first pending record
+    def read_head(self):
+        try:
+            with open(self.head_path, 'r') as head_file:
+                return int(head_file.read().strip() or 0)
+        except (IOError, OSError, ValueError):
+            return 0
+
+    # Number of complete records in the data file. A partially written trailing record is discarded
+    def read_total(self):
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return 0
+        total = size // RECORD.size
+        if size % RECORD.size:
+            logger.warning('Discarding partially written record at the end of flow outbox')
+            with open(self.path, 'r+b') as data_file:
+                data_file.truncate(total * RECORD.size)
+        return total
+
+    # Persists the index of the first pending record
+    def write_head(self):
+        tmp_path = self.head_path + '.tmp'
+        with open(tmp_path, 'w') as head_file:
+            head_file.write(str(self.head))
+        os.rename(tmp_path, self.head_path)
+
+    # Appends a recorded interval. The flow rate summary is not stored, as records have a fixed size
+    def append(self, end_time, duration, volume, pulses, rate=None):
+        record = RECORD.pack(end_time, duration, volume, pulses)
+        with self.lock:
+            if len(self) >= self.max_records:
+                self.evict(len(self) - self.max_records + 1)
+            with open(self.path, 'ab') as data_file:
+                data_file.write(record)
+                self.sync(data_file)
+            self.total += 1
+
+    # Writes the file to the card if fsync is enabled
+    def sync(self, data_file):
+        if self.fsync:
+            data_file.flush()
+            os.fsync(data_file.fileno())
+
+    # Drops the given number of oldest records. Must be called with the lock held
+    def evict(self, num_records):
+        logger.warning('Flow outbox is full. Evicting %d oldest record(s)', num_records)
+        self.evicted += num_records
+        self.head += num_records
+        if self.head >= self.max_records:
+            self.compact()
+        else:
+            self.write_head()
+
+    # Rewrites the data file with only the pending records. Must be called with the lock held
+    def compact(self):
+        with open(self.path, 'rb') as data_file:
+            data_file.seek(self.head * RECORD.size)
+            pending = data_file.read()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as tmp_file:
+            tmp_file.write(pending)
+            self.sync(tmp_file)
+        os.rename(tmp_path, self.path)
+        self.base += self.head
+        self.total -= self.head
+        self.head = 0
+        self.write_head()
+
+    # Returns up to max_records of the oldest pending records as dicts
+    # along with the sequence number of the first one, to be passed back to commit
+    def peek(self, max_records):
+        with self.lock:
+            seq = self.base + self.head
+            num_records = min(max_records, len(self))
+            if num_records == 0:
+                return seq, []
+            with open(self.path, 'rb') as data_file:
+                data_file.seek(self.head * RECORD.size)
+                data = data_file.read(num_records * RECORD.size)
+        records = []
+        for end_time, duration, volume, pulses in RECORD.iter_unpack(data):
+            records.append({
+                'time': end_time,
+                'duration': duration,
+                'volume': volume,
+                'pulses': pulses
+            })
+        return seq, records
+
+    # Removes the records peeked from seq onwards after they have been saved at the server
+    # Records evicted in the meantime are not removed twice
+    def commit(self, seq, num_records):
+        with self.lock:
+            self.head = max(self.head, min(seq + num_records - self.base, self.total))
+            if self.head == self.total:
+                with open(self.path, 'wb'):
+                    pass
+                self.base += self.total
+                self.head = self.total = 0
+            self.write_head()
@@ -0,0 +1,86 @@
+import array
+import itertools
+import time
+
+import SprinklerUtils
+
+# Optional. Imported on first use as it takes long to import on the device
+numpy = SprinklerUtils.lazy_import('numpy')
+
+RATE_PERCENTILES = [5, 50, 95]
+
+
+# Fixed size ring buffer of pulse timestamps backed by an array of doubles
+# Each edge stores its timestamp in the next slot, so no Python object is kept per pulse and memory stays bounded
+# regardless of runtime or flow rate. Once full, the oldest timestamps are overwritten.
+class PulseTimestampRing(object):
+    def __init__(self, capacity, clock=time.time):
+        size = 1
+        while size < capacity:
+            size *= 2
+        self.size = size
+        self.mask = size - 1
+        # Unused slots hold -inf so that they are never part of a window
+        self.timestamps = array.array('d', [float('-inf')]) * size
+        self.clock = clock
+        self._index = itertools.count()
+
+    # Returns an edge callback for the GPIO module that stores the timestamp of the edge and then calls record
+    def make_edge_callback(self, record):
+        def edge_callback(_channel, record=record, index=self._index.__next__, timestamps=self.timestamps,
+                          mask=self.mask, clock=self.clock):
+            timestamps[index() & mask] = clock()
+            record()
+
+        return edge_callback
+
+    # Returns the stored timestamps within [start, end) in ascending order
+    def window(self, start, end):
+        timestamps = self.timestamps[:]
+        if numpy is not None:
+            values = numpy.frombuffer(timestamps, dtype=numpy.float64)
+            values = values[(values >= start) & (values < end)]
+            values.sort()
+            return values
+        return sorted(timestamp for timestamp in timestamps if start <= timestamp < end)
+
+
+# Summarizes the flow rate (litres/minute) between consecutive pulses in the given window of pulse timestamps
+def summarize_rates(timestamps, pulses_per_litre):
+    if len(timestamps) < 2:
+        return None
+    if numpy is not None:
+        intervals = numpy.diff(numpy.asarray(timestamps, dtype=numpy.float64))
+        intervals = intervals[intervals > 0]
+        if not len(intervals):
+            return None
+        rates = 60.0 / (intervals * pulses_per_litre)
+        percentiles = numpy.percentile(rates, RATE_PERCENTILES)
+        summary = {
+            'min': float(rates.min()),
+            'max': float(rates.max()),
+            'mean': float(rates.mean())
+        }
+    else:
+        rates = sorted(60.0 / ((end - start) * pulses_per_litre)
+                       for start, end in zip(timestamps, timestamps[1:]) if end > start)
+        if not rates:
+            return None
+        percentiles = [percentile(rates, p) for p in RATE_PERCENTILES]
+        summary = {
+            'min': rates[0],
+            'max': rates[-1],
+            'mean': sum(rates) / len(rates)
+        }
+    for p, value in zip(RATE_PERCENTILES, percentiles):
+        summary['p%d' % p] = float(value)
+    summary['samples'] = len(rates)
+    return summary
+
+
+# Linearly interpolated percentile of sorted values, same as numpy's default
+def percentile(sorted_values, p):
+    position = (len(sorted_values) - 1) * p / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
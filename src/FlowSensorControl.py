@@ -1,128 +1,366 @@
+import gzip
+import json
 import logging
-import requests
 import threading
-import time
-
-from requests.auth import HTTPBasicAuth
 
+import Clock
+import ConfigSnapshot
+import EventJournal
+import FlowAnalytics
+import Scheduler
+import SprinklerMetrics
 import SprinklerUtils
+from FlowBatch import FlowBatch
+from FlowCalibration import PulseRateHistogram, load_k_table
+from FlowOutbox import FlowOutbox
+from FlowRateSeries import PulseTimestampRing, summarize_rates
 from GPIOWrapper import pins
-from SprinklerConfig import config
+from PulseCounter import PulseAccumulator
 
 logger = logging.getLogger(__name__)
 
+SprinklerApi = SprinklerUtils.lazy_import('SprinklerApi')
+
 
 # Sets up and polls the Flow Sensor
-# Starts in a separate thread for sending flow data to the server
-class FlowSensor(object):
-    def __init__(self):
-        pins.setup(config['FLOW_SENSOR_PIN'], pins.IN, pull_up_down=pins.PUD_DOWN)
-        pins.add_event_detect(config['FLOW_SENSOR_PIN'], pins.RISING, callback=lambda _: self.record_pulse())
-        logger.debug("Flow sensor has been configured at pin %d", config['FLOW_SENSOR_PIN'])
-        self.lock = threading.RLock()
-        self.pulses = 0
-        self.last_read_time = time.time()
+# Starts in a separate thread for sending flow data to the server. Each save flow process reads its settings from one
+# config snapshot
+class FlowSensor(ConfigSnapshot.SnapshotBound):
+    def __init__(self, pin=None, outbox_file=None, upload_mode=None):
+        settings = self.bind()
+        self.pin = settings['FLOW_SENSOR_PIN'] if pin is None else pin
+        self.accumulator = PulseAccumulator()
+        self.lock = threading.Lock()
+        self.clock = Clock.get_clock()
+        self.last_read_time = self.clock.time()
+        # Pulses of the records in the in-memory batch. They are only acknowledged once the server has saved them
+        self.batched_pulses = 0
+        self.outbox = None
+        outbox_file = settings['FLOW_OUTBOX_FILE'] if outbox_file is None else outbox_file
+        upload_mode = settings['FLOW_UPLOAD_MODE'] if upload_mode is None else upload_mode
+        if outbox_file:
+            self.outbox = FlowOutbox(SprinklerUtils.get_abs_path(outbox_file), settings['FLOW_OUTBOX_MAX_RECORDS'],
+                                     settings['FLOW_OUTBOX_FSYNC'])
+        elif upload_mode == 'batch':
+            self.outbox = FlowBatch(settings['FLOW_BATCH_MAX_PENDING'])
+        # K-factors by flow rate. PULSES_PER_LITRE is used for all flow rates if None
+        self.k_table = None
+        if settings['FLOW_CALIBRATION_FILE']:
+            self.k_table = load_k_table(SprinklerUtils.get_abs_path(settings['FLOW_CALIBRATION_FILE']))
+        self.rate_series = None
+        self.edge_callback = self.accumulator.edge_callback
+        if settings['FLOW_RATE_SERIES_SIZE']:
+            self.rate_series = PulseTimestampRing(settings['FLOW_RATE_SERIES_SIZE'], clock=self.clock.time)
+            self.edge_callback = self.rate_series.make_edge_callback(self.accumulator.edge_callback)
+        # Pulse counts by K-factor bucket, and the counts up to the last reading
+        self.rate_histogram = None
+        self.read_counts = None
+        if self.k_table is not None:
+            self.rate_histogram = PulseRateHistogram(self.k_table, clock=self.clock.monotonic)
+            self.edge_callback = self.rate_histogram.make_edge_callback(self.edge_callback)
+            self.read_counts = self.rate_histogram.snapshot()
+        pins.setup(self.pin, pins.IN, pull_up_down=pins.PUD_DOWN)
+        pins.add_event_detect(self.pin, pins.RISING, callback=self.edge_callback)
+        # Pulses are read from the accumulator when collected, so that the edge path is not instrumented
+        SprinklerMetrics.FLOW_PULSES.labels(self.pin).set_function(lambda: self.accumulator.snapshot()[0])
+        self.analytics = None
+        if settings['FLOW_ANALYTICS_INTERVAL']:
+            self.analytics = FlowAnalytics.FlowAnalytics(self.pin, self.accumulator, clock=self.clock.monotonic,
+                                                         k_table=self.k_table)
+        logger.debug("Flow sensor has been configured at pin %d", self.pin)
         self.process_loop = None
         self.active = False
 
     # Records a pulse from the flow sensor
+    # The GPIO module calls the accumulator directly, this is meant for callers other than the GPIO module
     def record_pulse(self):
-        with self.lock:
-            self.pulses += 1
-        if self.pulses % 100 == 0:
-            logger.debug('Recorded pulse. Curr pulses: %d', self.pulses)
+        self.edge_callback(self.pin)
+
+    # Lets the analytics tell flow while the valve is closed apart from flow while it is open
+    def attach_valve(self, valve):
+        if self.analytics is not None:
+            self.analytics.valve = valve
+
+    # Starts sampling the flow rate for the analytics, along with the other flow sensors
+    def start_analytics(self):
+        if self.analytics is not None:
+            FlowAnalytics.get_sampler().add(self.analytics)
+
+    def stop_analytics(self):
+        if self.analytics is not None:
+            FlowAnalytics.get_sampler().remove(self.analytics)
+
+    # Number of pulses recorded but not yet saved at the server
+    @property
+    def pulses(self):
+        return self.accumulator.pending
+
+    @pulses.setter
+    def pulses(self, pulses):
+        self.accumulator.set_pending(pulses)
 
     # Records the flow data and sends it to the server
     def save_flow_process(self):
+        return SprinklerUtils.run_steps(self.save_flow_steps(), FlowSensor)
+
+    # Steps of the save flow process, yielding the server calls. See SprinklerUtils.run_steps
+    def save_flow_steps(self):
         logger.debug('Starting save flow process')
+        self.bind()
+        recorded_data = self.prepare_flow_data()
+        if self.outbox is not None:
+            if not self.is_upload_due():
+                return False
+            return (yield from self.drain_outbox_steps())
+        if recorded_data is None:
+            return False
+        send_success = yield 'send_flow_data', (recorded_data['volume'], recorded_data['duration'],
+                                                recorded_data.get('rate'))
+        return self.complete_save(send_success, recorded_data)
+
+    # Records the current flow data and returns it if it satisfies the thresholds for saving
+    # If the outbox is enabled, the data is moved to the outbox and the pulses are reset as soon as they are durably stored
+    # In batch mode, the data is moved to the in-memory batch and its pulses are held until the server has saved it
+    def prepare_flow_data(self):
         recorded_data = self.read_flow_data()
-        thresholds_satisfied = FlowSensor.are_thresholds_satisfied(recorded_data)
-        if not thresholds_satisfied:
+        if not self.are_thresholds_satisfied(recorded_data):
             logger.debug(
                 "Flow volume (%.2f) and duration (%.2f) do not satisfy the thresholds for saving (%.2f, %.2f). " + \
-                "Skipping save", recorded_data['volume'], recorded_data['duration'], config['MIN_FLOW_VOLUME_FOR_SAVE'],
-                config['MAX_FLOW_DURATION_FOR_SAVE'])
-            return False
-        send_success = FlowSensor.send_flow_data(recorded_data['volume'], recorded_data['duration'])
+                "Skipping save", recorded_data['volume'], recorded_data['duration'],
+                self.settings['MIN_FLOW_VOLUME_FOR_SAVE'], self.settings['MAX_FLOW_DURATION_FOR_SAVE'])
+            return None
+        if self.outbox is not None:
+            self.outbox.append(recorded_data['new_time'], recorded_data['duration'], recorded_data['volume'],
+                               recorded_data['recorded_pulses'], recorded_data.get('rate'))
+            if self.outbox.durable:
+                self.reset_flow_data(recorded_data)
+                self.record_interval(recorded_data)
+            else:
+                self.hold_flow_data(recorded_data)
+        return recorded_data
+
+    # Completes the save flow process once the flow data has been sent to the server
+    def complete_save(self, send_success, recorded_data):
         if not send_success:
             logger.error('Save flow process failed as flow data could not be saved at the server')
+            SprinklerMetrics.FLOW_SAVES.labels('failure').inc()
             return False
         self.reset_flow_data(recorded_data)
+        self.record_interval(recorded_data)
         return True
 
+    # Records a flow interval that has been saved in the event journal and the metrics
+    def record_interval(self, recorded_data):
+        EventJournal.record(EventJournal.FLOW_INTERVAL, self.pin, recorded_data['volume'], recorded_data['duration'],
+                            recorded_data['recorded_pulses'])
+        SprinklerMetrics.FLOW_SAVES.labels('success').inc()
+        SprinklerMetrics.FLOW_VOLUME.labels(self.pin).inc(recorded_data['volume'])
+        if recorded_data['duration'] > 0:
+            SprinklerMetrics.FLOW_RATE.labels(self.pin).set(recorded_data['volume'] * 60 / recorded_data['duration'])
+
+    # Whether the pending records should be uploaded now. The outbox is drained on every cycle, while the in-memory
+    # batch waits until it is full or its oldest record is FLOW_BATCH_MAX_LATENCY seconds old
+    def is_upload_due(self):
+        if not len(self.outbox):
+            return False
+        if self.outbox.durable:
+            return True
+        if len(self.outbox) >= self.settings['FLOW_BATCH_MAX_RECORDS']:
+            return True
+        oldest_time = self.outbox.oldest_time()
+        if oldest_time is not None and self.clock.time() - oldest_time >= self.settings['FLOW_BATCH_MAX_LATENCY']:
+            return True
+        logger.debug('Holding %d flow record(s) for a batch upload', len(self.outbox))
+        return False
+
+    # Max records per upload
+    def upload_batch_size(self):
+        return self.settings['FLOW_OUTBOX_BATCH_SIZE'] if self.outbox.durable else \
+            self.settings['FLOW_BATCH_MAX_RECORDS']
+
+    # Uploads all pending records in the outbox in batches. Stops at the first failure
+    def drain_outbox(self):
+        return SprinklerUtils.run_steps(self.drain_outbox_steps(), FlowSensor)
+
+    def drain_outbox_steps(self):
+        while len(self.outbox):
+            seq, records = self.outbox.peek(self.upload_batch_size())
+            send_success = yield 'send_flow_batch', (records,)
+            if not send_success:
+                logger.error('Failed to drain flow outbox. %d record(s) pending', len(self.outbox))
+                return False
+            self.commit_records(seq, records)
+        logger.debug('Flow outbox has been drained')
+        return True
+
+    # Removes records saved at the server from the outbox
+    # Records of the in-memory batch have their pulses acknowledged only now
+    def commit_records(self, seq, records):
+        committed = self.outbox.commit(seq, len(records))
+        if self.outbox.durable:
+            return
+        pulses = sum(record['pulses'] for record in committed)
+        with self.lock:
+            self.accumulator.acknowledge(pulses)
+            self.batched_pulses -= pulses
+        for record in committed:
+            self.record_interval({'volume': record['volume'], 'duration': record['duration'],
+                                  'recorded_pulses': record['pulses']})
+
+    # Moves the last interval into the in-memory batch when stopping
+    # Returns whether records of the in-memory batch are waiting to be uploaded
+    def prepare_final_batch(self):
+        if self.outbox is None or self.outbox.durable:
+            return False
+        self.prepare_flow_data()
+        return len(self.outbox) > 0
+
+    # Runs the save flow process once
+    def save_cycle(self):
+        success = self.save_flow_process()
+        logger.debug('Update loop completed with status %s', success)
+
     # Starts the flow data update client
     def start(self):
-        def keep_updating():
-            logger.debug('Starting process loop for Flow Sensor')
-            while self.active:
-                success = self.save_flow_process()
-                logger.debug('Update loop completed with status %s. Sleeping for %d second(s)', success,
-                             config['FLOW_DATA_SAVE_INTERVAL'])
-                time.sleep(config['FLOW_DATA_SAVE_INTERVAL'])
-            logger.debug('Ending process loop for Flow Sensor')
-
         logger.info("Starting Flow Sensor")
+        settings = self.bind()
         self.active = True
-        self.process_loop = threading.Thread(target=keep_updating, name='FlowSensorThread')
-        self.process_loop.start()
+        self.process_loop = Scheduler.get_scheduler().schedule(
+            'FlowSensor', self.save_cycle, lambda: self.settings['FLOW_DATA_SAVE_INTERVAL'],
+            settings['LOOP_MISSED_TICKS'], settings['FLOW_DATA_SAVE_JITTER'])
+        self.start_analytics()
         logger.info("Flow Sensor has been started")
 
-    # Starts the flow data update client
+    # Stops the flow data update client. A save flow process in progress is completed
     def stop(self):
         logger.info("Stopping Flow Sensor")
         self.active = False
+        self.process_loop.cancel()
         self.process_loop.join()
+        self.stop_analytics()
+        self.bind()
+        if self.prepare_final_batch():
+            logger.info('Uploading %d batched flow record(s) before stopping', len(self.outbox))
+            self.drain_outbox()
         logger.info("Flow Sensor has been stopped")
 
     # Checks whether the recorded flow data satisfies the thresholds for being sent to the server
-    @staticmethod
-    def are_thresholds_satisfied(recorded_data):
-        return recorded_data['volume'] >= config['MIN_FLOW_VOLUME_FOR_SAVE'] or \
-               recorded_data['duration'] >= config['MAX_FLOW_DURATION_FOR_SAVE']
+    def are_thresholds_satisfied(self, recorded_data):
+        return recorded_data['volume'] >= self.settings['MIN_FLOW_VOLUME_FOR_SAVE'] or \
+               recorded_data['duration'] >= self.settings['MAX_FLOW_DURATION_FOR_SAVE']
 
     # Records the current flow data
     def read_flow_data(self):
         logger.debug('Recording flow data')
-        new_time = time.time()
-        pulses = self.pulses
-        duration = new_time - self.last_read_time
-        volume = float(pulses) / config['PULSES_PER_LITRE']
+        with self.lock:
+            new_time = self.clock.time()
+            _, pending = self.accumulator.snapshot()
+            pulses = pending - self.batched_pulses
+            duration = new_time - self.last_read_time
+            rate_counts = self.rate_histogram.snapshot() if self.rate_histogram is not None else None
+        timestamps = None
+        if self.rate_series is not None:
+            timestamps = self.rate_series.window(self.last_read_time, new_time)
+        pulses_per_litre = self.pulses_per_litre(pulses, duration, rate_counts)
+        volume = float(pulses) / pulses_per_litre
         recorded_data = {
             'new_time': new_time,
             'recorded_pulses': pulses,
             'volume': volume,
             'duration': duration
         }
+        if timestamps is not None:
+            recorded_data['rate'] = summarize_rates(timestamps, pulses_per_litre)
+        if rate_counts is not None:
+            recorded_data['rate_counts'] = rate_counts
         logger.debug('Flow data recorded: %s', recorded_data)
         return recorded_data
 
+    # K-factor (pulses/litre) for a reading of pulses over duration seconds
+    # With the pulse counts by rate bucket, each pulse is read at the K-factor of the flow rate it arrived at, so a
+    # reading with mixed flow rates is not read at its mean rate
+    def pulses_per_litre(self, pulses, duration, rate_counts=None):
+        if self.k_table is None:
+            return self.settings['PULSES_PER_LITRE']
+        if pulses and rate_counts is not None:
+            counts = [count - read_count for count, read_count in zip(rate_counts, self.read_counts)]
+            read_pulses = sum(counts)
+            if read_pulses > 0:
+                return read_pulses / self.k_table.counts_volume(counts)
+        return self.k_table.pulses_per_litre(pulses, duration)
+
     # Resets the flow data when it has been successfully recorded by the server
     def reset_flow_data(self, recorded_data):
         logger.debug('Resetting flow data. Before reset pulses:%d, last_read_time:%s', self.pulses, self.last_read_time)
         with self.lock:
-            self.pulses -= recorded_data['recorded_pulses']
+            self.accumulator.acknowledge(recorded_data['recorded_pulses'])
             self.last_read_time = recorded_data['new_time']
+            self.read_counts = recorded_data.get('rate_counts', self.read_counts)
         logger.debug('Flow data has been reset. After reset pulses:%d, last_read_time:%s', self.pulses,
                      self.last_read_time)
 
+    # Moves the flow data into the in-memory batch. The next interval starts now, but the pulses stay pending
+    def hold_flow_data(self, recorded_data):
+        with self.lock:
+            self.batched_pulses += recorded_data['recorded_pulses']
+            self.last_read_time = recorded_data['new_time']
+            self.read_counts = recorded_data.get('rate_counts', self.read_counts)
+        logger.debug('Flow data has been batched. Batched pulses:%d, pending batch records:%d', self.batched_pulses,
+                     len(self.outbox))
+
     # Sends the recorded flow data to the server
     @staticmethod
-    def send_flow_data(volume, duration):
-        api = SprinklerUtils.get_server_api_base() + '/flow'
-        flow_info = {
-            'volume': volume,
-            'duration': duration
-        }
+    def send_flow_data(volume, duration, rate=None):
+        flow_info = FlowSensor.flow_info(volume, duration, rate)
         logger.debug('Sending flow data to server: %s', flow_info)
         try:
-            resp = requests.post(api, json=flow_info, auth=HTTPBasicAuth('API_KEY', config['PRODUCT_KEY']))
-        except requests.ConnectionError:
+            resp = SprinklerApi.get_api_client().post('/flow', json=flow_info)
+        except SprinklerApi.REQUEST_ERRORS:
             logger.exception("Error occurred while sending flow data to server")
             return None
+        return FlowSensor.read_send_result(resp, 'flow data')
+
+    # Flow info sent to the server. The flow rate summary is only included if available
+    @staticmethod
+    def flow_info(volume, duration, rate=None):
+        flow_info = {
+            'volume': volume,
+            'duration': duration
+        }
+        if rate is not None:
+            flow_info['rate'] = rate
+        return flow_info
+
+    # Reads the result of sending flow data from the server response
+    @staticmethod
+    def read_send_result(resp, description):
         if resp.status_code == 200:
-            logger.debug('Sent flow data to server successfully')
+            logger.debug('Sent %s to server successfully', description)
             return True
         else:
-            logger.error("Request to send flow data failed with status %s", resp.status_code)
+            logger.error("Request to send %s failed with status %s", description, resp.status_code)
             logger.debug("Failed response: Reason: %s, Text: %s", resp.reason, resp.text)
             return False
+
+    # Sends a batch of recorded flow records to the server
+    @staticmethod
+    def send_flow_batch(records):
+        logger.debug('Sending %d flow record(s) to server', len(records))
+        try:
+            resp = SprinklerApi.get_api_client().post('/flow/batch', **FlowSensor.flow_batch_request_args(records))
+        except SprinklerApi.REQUEST_ERRORS:
+            logger.exception("Error occurred while sending flow records to server")
+            return None
+        return FlowSensor.read_send_result(resp, 'flow records')
+
+    # Request arguments for uploading a batch of flow records. The body is gzip compressed if configured
+    @staticmethod
+    def flow_batch_request_args(records):
+        payload = {'records': records}
+        if ConfigSnapshot.current()['FLOW_BATCH_COMPRESSION'] != 'gzip':
+            return {'json': payload}
+        body = gzip.compress(json.dumps(payload, separators=(',', ':')).encode('utf8'), mtime=0)
+        return {
+            'data': body,
+            'headers': {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+        }
@@ -0,0 +1,397 @@
+import base64
+import gzip
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import Clock
+import SprinklerMetrics
+import SprinklerUtils
+from FlowSensorControl import FlowSensor
+from SprinklerConfig import config
+from ValveControl import Valve
+
+logger = logging.getLogger(__name__)
+
+SprinklerApi = SprinklerUtils.lazy_import('SprinklerApi')
+
+# Routes of the zone and schedule modes. Their requests are not coalesced but passed through to the server one by one
+PASS_THROUGH_ROUTES = frozenset([
+    ('GET', '/zones/valve'), ('POST', '/zones/valve'), ('POST', '/zones/flow'), ('GET', '/schedule'),
+    ('POST', '/schedule/runs')
+])
+# Routes served to the devices, as label values of the request metrics. Other paths are counted as other
+DEVICE_ROUTES = ('/valve', '/flow', '/flow/batch') + tuple(sorted(set(path for _, path in PASS_THROUGH_ROUTES)))
+
+
+# Product key of the device sending the request, from its basic auth header. None if missing or malformed
+def device_key(header):
+    if not header or not header.startswith('Basic '):
+        return None
+    try:
+        credentials = base64.b64decode(header[len('Basic '):]).decode('utf8')
+    except ValueError:
+        return None
+    user, _, key = credentials.partition(':')
+    return key if user == 'API_KEY' and key else None
+
+
+def is_valid_flow(data):
+    return isinstance(data, dict) and all(
+        isinstance(data.get(key), (int, float)) and data[key] >= 0 for key in ('volume', 'duration'))
+
+
+# Whether an entry of an upstream valve sync names a device and has either its valve info or an error
+def is_valid_device_entry(entry):
+    return isinstance(entry, dict) and isinstance(entry.get('device'), str) and \
+        ('error' in entry or isinstance(entry.get('valve'), dict))
+
+
+# Seconds a device asks its long poll to be held for. Raises ValueError unless it is a finite number, not negative
+def parse_wait(value):
+    wait = float(value)
+    if not 0 <= wait < float('inf'):
+        raise ValueError('Invalid wait: %s' % value)
+    return wait
+
+
+# Request of a device that is held until the upstream request carrying it has completed, so that the device learns
+# whether the server has got it the same way as when talking to the server directly
+class ForwardedItem(object):
+    def __init__(self, device, payload):
+        self.device = device
+        self.payload = payload
+        self.done = threading.Event()
+        self.success = False
+
+    def complete(self, success):
+        self.success = success
+        self.done.set()
+
+
+# Serves the API of the server to the devices on the LAN
+class GatewayRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        logger.debug('Gateway: ' + fmt, *args)
+
+    def do_GET(self):
+        self.handle_device('GET')
+
+    def do_POST(self):
+        self.handle_device('POST')
+
+    def handle_device(self, method):
+        url = urlsplit(self.path)
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            status, resp = 400, {'error': 'Invalid Content-Length'}
+        else:
+            status, resp = self.handle_body(method, url, self.rfile.read(length) if length else b'')
+        route = url.path if url.path in DEVICE_ROUTES else 'other'
+        SprinklerMetrics.GATEWAY_REQUESTS.labels(method, route, status).inc()
+        body = json.dumps(resp).encode('utf8') if status != 304 else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if length < 0:
+            # The body of the request cannot be skipped without its length, so the connection cannot be reused
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Decodes the body of a request and passes the request on to the gateway
+    def handle_body(self, method, url, body):
+        try:
+            if body and self.headers.get('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+            data = json.loads(body.decode('utf8')) if body else None
+        except (EOFError, OSError, ValueError):
+            return 400, {'error': 'Invalid JSON'}
+        return self.server.gateway.handle(method, url.path, dict(parse_qsl(url.query)), data,
+                                          device_key(self.headers.get('Authorization')))
+
+
+# Gateway mode: lets the devices on a LAN share the upstream connection of this client
+# The devices point SERVER_IP and SERVER_PORT at the gateway instead of the server and keep talking the same API.
+# Valve states are answered from a cache, which is refreshed for all devices with a single upstream request every
+# GATEWAY_SYNC_INTERVAL seconds, so the devices can poll or long poll the gateway as often as they like. Valve
+# acknowledgements and flow records are held until the next upstream sync, which carries those of all devices in a
+# single request each. A device request waking up the sync waits GATEWAY_COALESCE_DELAY seconds for the requests of
+# the other devices to join it. The held requests are answered with the result of the upstream request, so a device
+# still reverts its valve or keeps its flow data if the server has not got it.
+# The requests of devices in the zone or schedule mode are passed through to the server with their own credentials
+class Gateway(object):
+    def __init__(self, host=None, port=None):
+        host = config['GATEWAY_HOST'] if host is None else host
+        port = config['GATEWAY_PORT'] if port is None else port
+        self.clock = Clock.get_clock()
+        self.lock = threading.Lock()
+        # Notified when the valve infos have been synced, for the devices waiting for them
+        self.valves_synced = threading.Condition(self.lock)
+        # Latest valve info of each device by product key. None until fetched from the server
+        self.valves = {}
+        # Devices the server does not know
+        self.rejected = set()
+        # Valve acknowledgements and flow records waiting for the next upstream sync
+        self.acks = []
+        self.records = []
+        # Whether the last valve sync has succeeded. The cached valve infos are not served otherwise
+        self.synced = False
+        self.wakeup = threading.Event()
+        self.active = False
+        self.thread = None
+        self.routes = {
+            ('GET', '/valve'): self.get_valve,
+            ('POST', '/valve'): self.post_valve,
+            ('POST', '/flow'): self.post_flow,
+            ('POST', '/flow/batch'): self.post_flow_batch
+        }
+        self.httpd = ThreadingHTTPServer((host, port), GatewayRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.gateway = self
+        self.server_thread = None
+        SprinklerMetrics.GATEWAY_DEVICES.set_function(lambda: len(self.valves))
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    # Answers a request of a device. Returns the status and the JSON response
+    def handle(self, method, path, query, data, device):
+        if device is None:
+            return 401, {'error': 'Unauthorized'}
+        route = self.routes.get((method, path))
+        if route is None and (method, path) not in PASS_THROUGH_ROUTES:
+            return 404, {'error': 'Not found'}
+        if not self.active:
+            return 503, {'error': 'Gateway is stopping'}
+        if route is None:
+            return Gateway.pass_through(method, path, query, data, device)
+        self.add_device(device)
+        return route(device, data, query)
+
+    # Starts syncing the valve state of a device
+    def add_device(self, device):
+        with self.lock:
+            if device in self.valves:
+                return
+            logger.info('Device %s... has connected to the gateway', device[:4])
+            self.valves[device] = None
+        self.wakeup.set()
+
+    # Returns the valve info of the device. Holds a long poll (wait and state given) until the version (or the state
+    # if no version is given) differs or wait elapses, and answers not modified if the device has the version already
+    # A piggybacked acknowledgement is forwarded to the server first
+    def get_valve(self, device, _data, query):
+        wait = None
+        if 'wait' in query and 'state' in query:
+            try:
+                wait = parse_wait(query['wait'])
+            except ValueError:
+                return 400, {'error': 'Invalid wait'}
+        if 'ack' in query:
+            try:
+                ack = {'version': int(query['ack'])}
+            except ValueError:
+                return 400, {'error': 'Invalid acknowledgement'}
+            if not self.forward(self.acks, device, ack):
+                return 502, {'error': 'Server could not be notified'}
+        with self.lock:
+            self.valves_synced.wait_for(lambda: not self.active or device in self.rejected or
+                                        self.valves.get(device) is not None, config['GATEWAY_FORWARD_TIMEOUT'])
+            if device in self.rejected:
+                return 401, {'error': 'Unauthorized'}
+            if not self.synced or self.valves.get(device) is None:
+                return 503, {'error': 'Server is not available'}
+            if wait is not None:
+                key = 'version' if 'version' in query else 'state'
+                self.valves_synced.wait_for(
+                    lambda: not self.active or str(self.valves[device].get(key)) != query[key], wait)
+            valve_info = self.valves[device]
+            if 'version' in query and query['version'] == str(valve_info.get('version')):
+                return 304, None
+            return 200, valve_info
+
+    def post_valve(self, device, data, _query):
+        if not isinstance(data, dict) or data.get('state') not in (0, 1):
+            return 400, {'error': 'Invalid valve info'}
+        if not self.forward(self.acks, device, data):
+            return 502, {'error': 'Server could not be notified'}
+        return 200, {}
+
+    def post_flow(self, device, data, _query):
+        if not is_valid_flow(data):
+            return 400, {'error': 'Invalid flow info'}
+        if not self.forward(self.records, device, [data]):
+            return 502, {'error': 'Flow data could not be saved at the server'}
+        return 200, {}
+
+    def post_flow_batch(self, device, data, _query):
+        records = data.get('records') if isinstance(data, dict) else None
+        if not isinstance(records, list) or not all(is_valid_flow(record) for record in records):
+            return 400, {'error': 'Invalid flow records'}
+        if not self.forward(self.records, device, records):
+            return 502, {'error': 'Flow records could not be saved at the server'}
+        return 200, {'saved': len(records)}
+
+    # Queues the payload of a device for the next upstream sync and waits for it. Returns whether the server got it
+    def forward(self, queue, device, payload):
+        item = ForwardedItem(device, payload)
+        with self.lock:
+            queue.append(item)
+        self.wakeup.set()
+        if item.done.wait(config['GATEWAY_FORWARD_TIMEOUT']):
+            return item.success
+        with self.lock:
+            if item in queue:
+                queue.remove(item)
+        logger.error('Request of device %s... was not forwarded to the server in time', device[:4])
+        return False
+
+    # Sends the queued flow records and acknowledgements of all devices and refreshes their valve states
+    def sync_cycle(self):
+        with self.lock:
+            records, self.records = self.records, []
+        if records:
+            payload = [dict(record, device=item.device) for item in records for record in item.payload]
+            send_success = False
+            try:
+                send_success = Gateway.send_device_flow(payload)
+            finally:
+                for item in records:
+                    item.complete(send_success)
+        return self.sync_valves()
+
+    def sync_valves(self):
+        with self.lock:
+            acks, self.acks = self.acks, []
+            devices = [{'device': device, 'version': Valve.valve_version(valve_info)}
+                       for device, valve_info in self.valves.items() if device not in self.rejected]
+        if not devices and not acks:
+            return True
+        synced = None
+        try:
+            synced = Gateway.sync_device_valves(devices, [dict(item.payload, device=item.device) for item in acks])
+        finally:
+            # The devices are answered even if the sync has failed unexpectedly
+            for item in acks:
+                item.complete(synced is not None)
+        with self.lock:
+            self.synced = synced is not None
+            for entry in synced or []:
+                if 'error' in entry:
+                    logger.warning('Server rejected device %s...: %s', entry['device'][:4], entry['error'])
+                    self.rejected.add(entry['device'])
+                elif entry.get('device') in self.valves:
+                    self.valves[entry['device']] = entry['valve']
+            self.valves_synced.notify_all()
+        return synced is not None
+
+    # Syncs with the server every GATEWAY_SYNC_INTERVAL seconds, or shortly after a device request has to be forwarded
+    def keep_syncing(self):
+        logger.debug('Starting gateway sync loop')
+        while self.active:
+            if self.clock.wait(self.wakeup, config['GATEWAY_SYNC_INTERVAL']) and self.active:
+                # Lets the requests of the other devices join the upstream requests
+                self.clock.sleep(config['GATEWAY_COALESCE_DELAY'])
+            self.wakeup.clear()
+            if not self.active:
+                break
+            try:
+                success = self.sync_cycle()
+                logger.debug('Gateway sync completed with status %s', success)
+            except Exception:
+                logger.exception('Gateway sync failed')
+        logger.debug('Ending gateway sync loop')
+
+    def start(self):
+        logger.info('Starting Gateway')
+        self.active = True
+        self.thread = threading.Thread(target=self.keep_syncing, name='GatewaySyncThread')
+        self.clock.add_thread(self.thread)
+        self.thread.start()
+        self.server_thread = threading.Thread(target=self.httpd.serve_forever, name='GatewayServerThread')
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        logger.info('Gateway has been started at port %d', self.port)
+        return self
+
+    # Stops serving the devices. Requests still waiting to be forwarded are answered with an error
+    def stop(self):
+        logger.info('Stopping Gateway')
+        with self.lock:
+            self.active = False
+            self.valves_synced.notify_all()
+            pending, self.acks, self.records = self.acks + self.records, [], []
+        for item in pending:
+            item.complete(False)
+        self.wakeup.set()
+        self.thread.join()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.server_thread.join()
+        logger.info('Gateway has been stopped')
+
+    # Sends the acknowledgements of the devices to the server and fetches the valve infos that are newer than the
+    # given versions. Returns the entries of the devices with a new valve info or an error, or None if the request
+    # failed
+    @staticmethod
+    def sync_device_valves(devices, acks):
+        logger.debug('Syncing valve states of %d device(s) with %d acknowledgement(s)', len(devices), len(acks))
+        try:
+            resp = SprinklerApi.get_api_client().post('/gateway/valve', json={'devices': devices, 'acks': acks})
+        except SprinklerApi.REQUEST_ERRORS:
+            logger.exception("Error occurred while syncing device valve states with server")
+            return None
+        if resp.status_code == 200:
+            try:
+                data = resp.json()
+            except ValueError:
+                data = None
+            entries = data.get('devices', []) if isinstance(data, dict) else None
+            if not isinstance(entries, list) or not all(is_valid_device_entry(entry) for entry in entries):
+                logger.error('Device valve info received is invalid')
+                return None
+            logger.debug('Fetched device valve info from server: %s', entries)
+            return entries
+        else:
+            logger.error("Request to sync device valve states failed with status %s", resp.status_code)
+            logger.debug("Failed response: Reason: %s, Text: %s", resp.reason, resp.text)
+            return None
+
+    # Passes a request of a device through to the server with the credentials of the device, and answers the device
+    # with the response of the server
+    @staticmethod
+    def pass_through(method, path, query, data, device):
+        logger.debug('Passing %s %s of device %s... through to the server', method, path, device[:4])
+        try:
+            resp = SprinklerApi.get_api_client().request(method, path, params=query or None, json=data,
+                                                         auth=('API_KEY', device))
+        except SprinklerApi.REQUEST_ERRORS:
+            logger.exception("Error occurred while passing %s %s through to server", method, path)
+            return 502, {'error': 'Server is not available'}
+        if resp.status_code == 304:
+            return 304, None
+        try:
+            return resp.status_code, resp.json() if resp.content else {}
+        except ValueError:
+            logger.error("Response to %s %s passed through is not valid JSON", method, path)
+            return 502, {'error': 'Invalid response from server'}
+
+    # Sends the flow records of the devices to the server in a single batch
+    @staticmethod
+    def send_device_flow(records):
+        logger.debug('Sending %d device flow record(s) to server', len(records))
+        try:
+            resp = SprinklerApi.get_api_client().post('/gateway/flow', **FlowSensor.flow_batch_request_args(records))
+        except SprinklerApi.REQUEST_ERRORS:
+            logger.exception("Error occurred while sending device flow records to server")
+            return False
+        return FlowSensor.read_send_result(resp, 'device flow records')
@@ -0,0 +1,48 @@
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import SprinklerMetrics
+
+logger = logging.getLogger(__name__)
+
+
+# Serves the metrics at /metrics
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, fmt, *args):
+        logger.debug('Metrics endpoint: ' + fmt, *args)
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = SprinklerMetrics.registry.expose().encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# Local HTTP endpoint for scraping the metrics in the Prometheus text format
+class MetricsServer(object):
+    def __init__(self, host, port):
+        self.httpd = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='MetricsServerThread')
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info('Metrics endpoint has been started at port %d', self.port)
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
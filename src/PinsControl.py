@@ -12,6 +12,14 @@ class PinsController(object):
         assert pins.getmode() == PINS_MODE
         self.logger.info("Pins have been initialized. Mode: %d", PINS_MODE)
 
+    # Sets up the valve pins as outputs and drives them low, so that the valves stay closed while the client starts
+    def close_valves(self, valve_pins):
+        for pin in valve_pins:
+            if pin is not None:
+                pins.setup(pin, pins.OUT)
+                pins.output(pin, pins.LOW)
+        self.logger.info("Valves have been closed. Pins: %s", valve_pins)
+
     # Resets the GPIO pins
     def clean_up(self):
         pins.cleanup()
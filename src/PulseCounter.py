@@ -0,0 +1,51 @@
+import functools
+import itertools
+import threading
+
+
+# Counts pulses from the GPIO callback thread with near constant cost per edge
+# Each edge only advances a C level counter which is atomic under the GIL, so no lock is taken and no
+# Python frame is executed on the edge path.
+# Readers take a plain lock among themselves and probe the counter to obtain a snapshot.
+# Each probe advances the counter by one, which is compensated by keeping track of the number of probes.
+class PulseAccumulator(object):
+    def __init__(self):
+        self._edges = itertools.count()
+        self._probes = 0
+        self._acknowledged = 0
+        self._lock = threading.Lock()
+        # Edge callback for the GPIO module. The channel passed by GPIO ends up as the (unused) default of next()
+        # as the counter is never exhausted
+        self.edge_callback = functools.partial(next, self._edges)
+
+    # Records a single pulse
+    def record_pulse(self):
+        next(self._edges)
+
+    # Total number of pulses recorded since creation. Must be called with the lock held
+    def _total(self):
+        total = next(self._edges) - self._probes
+        self._probes += 1
+        return total
+
+    # Returns the total number of pulses recorded and the number of pulses not yet acknowledged
+    def snapshot(self):
+        with self._lock:
+            total = self._total()
+            return total, total - self._acknowledged
+
+    # Number of pulses that have not been acknowledged yet
+    @property
+    def pending(self):
+        return self.snapshot()[1]
+
+    # Acknowledges the given number of pulses so that they are no longer pending
+    # Pulses recorded after the snapshot they were read from remain pending
+    def acknowledge(self, pulses):
+        with self._lock:
+            self._acknowledged += pulses
+
+    # Overrides the number of pending pulses
+    def set_pending(self, pulses):
+        with self._lock:
+            self._acknowledged = self._total() - pulses
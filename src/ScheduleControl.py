@@ -0,0 +1,343 @@
+import json
+import logging
+import os
+import threading
+
+import Clock
+import ConfigSnapshot
+import Scheduler
+import SprinklerUtils
+from GPIOWrapper import pins
+
+logger = logging.getLogger(__name__)
+
+SprinklerApi = SprinklerUtils.lazy_import('SprinklerApi')
+
+# Seconds between the runs of a recurring schedule entry
+# Start times are epoch seconds, so daily runs keep the same UTC time of day
+RECURRENCE_PERIODS = {'once': None, 'daily': 24 * 3600, 'weekly': 7 * 24 * 3600}
+# Longest the executor waits before checking the schedule again, so that wall clock adjustments are picked up
+MAX_WAIT = 60
+
+
+# Irrigation schedule downloaded from the server
+# Each entry opens the valve of a zone (None for the single valve of the device) for duration seconds from start,
+# optionally recurring daily or weekly. The version is assigned by the server and changes with every update
+# If the zones of the device are given, a schedule with an entry for another zone is invalid
+class IrrigationSchedule(object):
+    def __init__(self, version, entries, zones=None):
+        self.version = version
+        self.entries = [IrrigationSchedule.validate_entry(entry, zones) for entry in entries]
+
+    # Creates a schedule from its JSON representation. Raises ValueError if it is invalid
+    @staticmethod
+    def from_dict(data, zones=None):
+        if not isinstance(data, dict) or 'version' not in data or not isinstance(data.get('entries', []), list):
+            raise ValueError('Invalid schedule: %s' % data)
+        return IrrigationSchedule(data['version'], data.get('entries', []), zones)
+
+    def to_dict(self):
+        return {'version': self.version, 'entries': self.entries}
+
+    @staticmethod
+    def validate_entry(entry, zones=None):
+        if not isinstance(entry, dict):
+            raise ValueError('Invalid schedule entry: %s' % entry)
+        zone = entry.get('zone')
+        if not is_valid_key(entry.get('id')) or not is_valid_key(zone):
+            raise ValueError('Invalid schedule entry id or zone: %s' % entry)
+        if zones is not None and zone not in zones:
+            raise ValueError('Schedule entry for unknown zone: %s' % zone)
+        recurrence = entry.get('recurrence', 'once')
+        if recurrence not in RECURRENCE_PERIODS:
+            raise ValueError('Invalid schedule entry recurrence: %s' % recurrence)
+        try:
+            start = float(entry['start'])
+            duration = float(entry['duration'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('Invalid schedule entry times: %s' % entry)
+        if duration <= 0:
+            raise ValueError('Invalid schedule entry duration: %s' % duration)
+        return {
+            'id': entry.get('id'),
+            'zone': zone,
+            'start': start,
+            'duration': duration,
+            'recurrence': recurrence
+        }
+
+    # Start of the latest run of the entry at or before the given time, or None if it has not started yet
+    @staticmethod
+    def last_start(entry, at):
+        if at < entry['start']:
+            return None
+        period = RECURRENCE_PERIODS[entry['recurrence']]
+        if period is None:
+            return entry['start']
+        return entry['start'] + (at - entry['start']) // period * period
+
+    # Start of the first run of the entry after the given time, or None if it does not run again
+    @staticmethod
+    def next_start(entry, after):
+        if after < entry['start']:
+            return entry['start']
+        period = RECURRENCE_PERIODS[entry['recurrence']]
+        if period is None:
+            return None
+        return IrrigationSchedule.last_start(entry, after) + period
+
+    # Runs in progress at the given time as (entry, start, end)
+    def active_runs(self, at):
+        runs = []
+        for entry in self.entries:
+            start = IrrigationSchedule.last_start(entry, at)
+            if start is not None and at < start + entry['duration']:
+                runs.append((entry, start, start + entry['duration']))
+        return runs
+
+    # Time of the next start or end of a run after the given time, or None if nothing is scheduled anymore
+    def next_transition(self, at):
+        times = []
+        for entry in self.entries:
+            start = IrrigationSchedule.last_start(entry, at)
+            if start is not None and at < start + entry['duration']:
+                times.append(start + entry['duration'])
+            next_start = IrrigationSchedule.next_start(entry, at)
+            if next_start is not None:
+                times.append(next_start)
+        return min(times) if times else None
+
+
+# Whether a value can identify a schedule entry or a zone. Runs are tracked by them, so they have to be hashable
+def is_valid_key(value):
+    return value is None or isinstance(value, (int, str)) and not isinstance(value, bool)
+
+
+# Reads the cached schedule for the given zones. Returns None if there is none or it cannot be read
+def load_schedule(path, zones=None):
+    try:
+        with open(path, 'r') as cache_file:
+            schedule = IrrigationSchedule.from_dict(json.load(cache_file), zones)
+    except (IOError, OSError):
+        return None
+    except ValueError:
+        logger.exception('Ignoring invalid cached schedule at %s', path)
+        return None
+    logger.info('Loaded cached schedule version %s with %d entries', schedule.version, len(schedule.entries))
+    return schedule
+
+
+# Caches the schedule. The file is replaced atomically so that a power loss never leaves a partial schedule
+def save_schedule(path, schedule):
+    dir_path = os.path.dirname(path)
+    if dir_path and not os.path.isdir(dir_path):
+        os.makedirs(dir_path)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as cache_file:
+        json.dump(schedule.to_dict(), cache_file)
+        cache_file.flush()
+        os.fsync(cache_file.fileno())
+    os.replace(tmp_path, path)
+
+
+# Operates the valves according to the irrigation schedule without contacting the server
+# The schedule is cached on the device and only downloaded again when the server has a new version. Valves are
+# opened and closed by a local thread at the scheduled times, and what has been done is reported to the server
+# afterwards. Starts in separate threads for executing the schedule and for syncing with the server.
+# Each cycle reads its settings from one config snapshot
+class ScheduleExecutor(ConfigSnapshot.SnapshotBound):
+    def __init__(self, valves, cache_file=None):
+        # Valves by zone. The single valve of the device is zone None
+        self.valves = valves
+        cache_file = self.bind()['SCHEDULE_CACHE_FILE'] if cache_file is None else cache_file
+        self.cache_path = SprinklerUtils.get_abs_path(cache_file)
+        self.lock = threading.Lock()
+        self.clock = Clock.get_clock()
+        self.changed = threading.Event()
+        self.schedule = load_schedule(self.cache_path, self.valves)
+        # Reports of the runs in progress by (entry id, zone, start)
+        self.active_runs = {}
+        # Reports of the completed runs not yet sent to the server
+        self.reports = []
+        self.thread = None
+        self.sync_loop = None
+        self.active = False
+
+    # Brings the valves in line with the schedule at the given time
+    # Returns the time at which the valves have to be updated next, or None if nothing is scheduled anymore
+    def execute_cycle(self, now=None):
+        now = self.clock.time() if now is None else now
+        self.bind()
+        schedule = self.schedule
+        due = {}
+        if schedule is not None:
+            for entry, start, end in schedule.active_runs(now):
+                due[(entry['id'], entry['zone'], start)] = (entry, start, end)
+        for key in list(self.active_runs):
+            if key not in due:
+                self.finish_run(key, now)
+        for key, (entry, start, end) in due.items():
+            if key not in self.active_runs:
+                self.start_run(key, entry, start, end, now)
+        return schedule.next_transition(now) if schedule is not None else None
+
+    def start_run(self, key, entry, start, end, now):
+        valve = self.valves.get(entry['zone'])
+        if valve is None:
+            logger.warning('Ignoring schedule entry %s for unknown zone %s', entry['id'], entry['zone'])
+        else:
+            logger.info('Starting scheduled run of entry %s in zone %s until %s', entry['id'], entry['zone'], end)
+        success = valve is not None and valve.update(pins.HIGH)
+        self.active_runs[key] = {
+            'id': entry['id'],
+            'zone': entry['zone'],
+            'planned_start': start,
+            'planned_end': end,
+            'started': now,
+            'ended': None,
+            'success': bool(success)
+        }
+
+    def finish_run(self, key, now):
+        report = self.active_runs.pop(key)
+        valve = self.valves.get(report['zone'])
+        # Overlapping runs keep the valve open until the last one has ended
+        if valve is not None and not any(run['zone'] == report['zone'] for run in self.active_runs.values()):
+            logger.info('Ending scheduled run of entry %s in zone %s', report['id'], report['zone'])
+            report['success'] = valve.update(pins.LOW) and report['success']
+        report['ended'] = now
+        with self.lock:
+            self.reports.append(report)
+            if len(self.reports) > self.settings['SCHEDULE_MAX_REPORTS']:
+                logger.warning('Dropping oldest schedule run report as it could not be sent to the server')
+                del self.reports[0]
+
+    # Executes the schedule until stopped, waking up at the scheduled times or when the schedule changes
+    # The runs in progress are ended whenever the executor ends, so that it never leaves a valve open behind
+    def keep_executing(self):
+        logger.debug('Starting schedule executor')
+        try:
+            while self.active:
+                next_time = self.execute_tick()
+                timeout = MAX_WAIT if next_time is None else min(max(next_time - self.clock.time(), 0), MAX_WAIT)
+                self.clock.wait(self.changed, timeout)
+                self.changed.clear()
+        finally:
+            self.end_runs(self.clock.time())
+        logger.debug('Ending schedule executor')
+
+    # Runs one cycle of the executor. If it fails, the runs in progress are ended and the cycle is retried after
+    # MAX_WAIT seconds or a schedule update
+    def execute_tick(self):
+        try:
+            return self.execute_cycle()
+        except Exception:
+            logger.exception('Failed to execute the schedule. Ending the runs in progress')
+            self.end_runs(self.clock.time())
+            return None
+
+    # Ends all runs in progress and closes their valves
+    def end_runs(self, now):
+        for key in list(self.active_runs):
+            self.finish_run(key, now)
+
+    # Replaces the schedule. Runs that are no longer scheduled are ended right away
+    def update_schedule(self, schedule):
+        self.schedule = schedule
+        try:
+            save_schedule(self.cache_path, schedule)
+        except (IOError, OSError):
+            logger.exception('Failed to cache schedule at %s', self.cache_path)
+        logger.info('Schedule has been updated to version %s with %d entries', schedule.version,
+                    len(schedule.entries))
+        self.changed.set()
+
+    # Downloads the schedule if the server has a new version and sends the reports of the completed runs
+    def sync_cycle(self):
+        schedule = ScheduleExecutor.get_schedule(self.schedule.version if self.schedule is not None else None,
+                                                 self.valves)
+        if schedule is not None:
+            self.update_schedule(schedule)
+        self.send_reports()
+
+    # Sends the reports of the completed runs to the server. Returns whether all have been sent
+    def send_reports(self):
+        with self.lock:
+            reports = list(self.reports)
+        if not reports:
+            return True
+        if not ScheduleExecutor.send_runs(reports):
+            return False
+        with self.lock:
+            # Reports may have been dropped or added in the meantime
+            self.reports = [report for report in self.reports if not any(report is sent for sent in reports)]
+        return True
+
+    # Starts executing the cached schedule and syncing with the server
+    def start(self):
+        logger.info('Starting Schedule Executor')
+        self.active = True
+        for valve in self.valves.values():
+            valve.active = True
+        self.thread = threading.Thread(target=self.keep_executing, name='ScheduleExecutorThread')
+        self.clock.add_thread(self.thread)
+        self.thread.start()
+        self.sync_loop = Scheduler.get_scheduler().schedule(
+            'ScheduleSync', self.sync_cycle, lambda: ConfigSnapshot.current()['SCHEDULE_SYNC_INTERVAL'],
+            self.settings['LOOP_MISSED_TICKS'])
+        logger.info('Schedule Executor has been started')
+
+    # Stops the executor, ends the runs in progress and closes all valves
+    def stop(self):
+        logger.info('Stopping Schedule Executor')
+        self.active = False
+        self.changed.set()
+        self.thread.join()
+        self.sync_loop.cancel()
+        self.sync_loop.join()
+        self.end_runs(self.clock.time())
+        for valve in self.valves.values():
+            valve.active = False
+            valve.update(pins.LOW)
+        self.send_reports()
+        logger.info('Schedule Executor has been stopped')
+
+    # Fetches the schedule for the given zones from the server unless the server still has the given version
+    # Returns None if the schedule is unchanged or could not be fetched
+    @staticmethod
+    def get_schedule(version=None, zones=None):
+        logger.debug('Fetching schedule from server. Cached version: %s', version)
+        params = {'version': version} if version is not None else None
+        try:
+            resp = SprinklerApi.get_api_client().get('/schedule', params=params)
+        except SprinklerApi.REQUEST_ERRORS:
+            logger.exception("Error occurred while fetching schedule from server")
+            return None
+        if resp.status_code == 304:
+            logger.debug('Schedule version %s is up to date', version)
+            return None
+        if resp.status_code != 200:
+            logger.error("Request to obtain schedule failed with status %s", resp.status_code)
+            logger.debug("Failed response: Reason: %s, Text: %s", resp.reason, resp.text)
+            return None
+        try:
+            return IrrigationSchedule.from_dict(resp.json(), zones)
+        except ValueError:
+            logger.exception('Schedule received is invalid')
+            return None
+
+    # Reports completed runs to the server
+    @staticmethod
+    def send_runs(reports):
+        logger.debug('Sending %d schedule run report(s) to server', len(reports))
+        try:
+            resp = SprinklerApi.get_api_client().post('/schedule/runs', json={'runs': reports})
+        except SprinklerApi.REQUEST_ERRORS:
+            logger.exception("Error occurred while sending schedule run reports to server")
+            return False
+        if resp.status_code == 200:
+            logger.debug('Sent schedule run reports to server successfully')
+            return True
+        logger.error("Request to send schedule run reports failed with status %s", resp.status_code)
+        logger.debug("Failed response: Reason: %s, Text: %s", resp.reason, resp.text)
+        return False
@@ -0,0 +1,127 @@
+import logging
+import random
+import threading
+
+import Clock
+import SprinklerMetrics
+
+logger = logging.getLogger(__name__)
+
+MISSED_TICK_POLICIES = ('skip', 'catch_up')
+# A task further behind than this many ticks is re-anchored at the current time instead of catching up
+MAX_CATCH_UP_TICKS = 10
+
+
+# Runs a piece of work repeatedly at a fixed rate in its own thread
+# Ticks are laid out on a monotonic grid (start + n * interval) instead of sleeping for the interval after each run,
+# so slow runs do not make the period drift. If a run takes longer than the interval, the missed ticks are either
+# skipped ('skip') or run back to back ('catch_up').
+# If the work returns a number, it is used as the interval from the current tick to the next one. Zero runs the
+# work again immediately and restarts the grid from there.
+# An optional jitter delays each run by a random fraction of up to jitter seconds, without moving the grid.
+# Waiting is done on an event, so cancelling a task takes effect immediately, except for a run in progress.
+# Time is read and waited for with the client wide clock unless another clock is given
+class ScheduledTask(object):
+    def __init__(self, name, work, interval, policy='skip', jitter=0.0, clock=None, seed=None):
+        if policy not in MISSED_TICK_POLICIES:
+            raise ValueError('Invalid missed tick policy: %s' % policy)
+        self.name = name
+        self.work = work
+        self.interval = interval
+        self.policy = policy
+        self.jitter = jitter
+        self.clock = Clock.get_clock() if clock is None else clock
+        self.random = random.Random(seed)
+        self.cancelled = threading.Event()
+        self.thread = None
+        self.runs = 0
+        self.skipped = 0
+        self.next_tick = None
+
+    def get_interval(self):
+        return self.interval() if callable(self.interval) else self.interval
+
+    # Moves the next tick to after the current time according to the missed tick policy
+    def advance(self, interval):
+        now = self.clock.monotonic()
+        if interval <= 0:
+            # Runs again immediately and restarts the schedule from there
+            self.next_tick = now
+            return
+        self.next_tick += interval
+        if self.next_tick > now:
+            return
+        missed = int((now - self.next_tick) // interval) + 1
+        if self.policy == 'skip':
+            self.next_tick += missed * interval
+            self.skipped += missed
+            logger.debug('Task %s skipped %d tick(s)', self.name, missed)
+        elif missed > MAX_CATCH_UP_TICKS:
+            logger.debug('Task %s is %d tick(s) behind. Restarting its schedule', self.name, missed)
+            self.next_tick = now
+            self.skipped += missed
+
+    def run(self):
+        logger.debug('Starting scheduled task %s', self.name)
+        self.next_tick = self.clock.monotonic()
+        while not self.cancelled.is_set():
+            offset = self.random.uniform(0, self.jitter) if self.jitter else 0
+            if self.clock.wait(self.cancelled, max(self.next_tick + offset - self.clock.monotonic(), 0)):
+                break
+            SprinklerMetrics.LOOP_DRIFT.labels(self.name).observe(
+                max(self.clock.monotonic() - self.next_tick - offset, 0))
+            try:
+                interval = self.work()
+            except Exception:
+                logger.exception('Scheduled task %s failed', self.name)
+                interval = None
+            self.runs += 1
+            self.advance(self.get_interval() if interval is None else interval)
+        logger.debug('Ending scheduled task %s', self.name)
+
+    def start(self, daemon=False):
+        self.thread = threading.Thread(target=self.run, name=self.name + 'Thread')
+        self.thread.daemon = daemon
+        self.clock.add_thread(self.thread)
+        self.thread.start()
+        return self
+
+    # Stops the task. A run in progress is completed
+    def cancel(self):
+        self.cancelled.set()
+
+    # Waits for the task to stop. Returns whether it has stopped
+    def join(self, timeout=None):
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+
+# Creates and keeps track of the scheduled tasks of the client
+class Scheduler(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tasks = []
+
+    # Starts running work at the given interval (seconds, or a function returning seconds) in a new thread
+    def schedule(self, name, work, interval, policy='skip', jitter=0.0, daemon=False):
+        task = ScheduledTask(name, work, interval, policy, jitter)
+        with self.lock:
+            self.tasks = [t for t in self.tasks if t.thread.is_alive()] + [task.start(daemon)]
+        return task
+
+    # Cancels all tasks and waits for them to stop
+    def stop(self, timeout=None):
+        with self.lock:
+            tasks, self.tasks = self.tasks, []
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            task.join(timeout)
+
+
+scheduler = Scheduler()
+
+
+# Returns the client wide scheduler
+def get_scheduler():
+    return scheduler
@@ -1,41 +1,120 @@
 import logging
 import signal
-import time
+import sys
+import threading
 
-import SprinklerLogging
-from FlowSensorControl import FlowSensor
-from PinsControl import PinsController
-from ValveControl import Valve
+import StartupProfile
 
 # App entry point
-active = True
+# The valves are closed before anything else is set up, so that they are in a safe state while the rest of the client
+# starts. Modules that are only needed to talk to the server, such as requests, are imported on first use
+startup = StartupProfile.get_profile()
+
+with startup.phase('gpio'):
+    from PinsControl import PinsController
+    from SprinklerConfig import config
+
+    pins_controller = PinsController()
+    # Malformed zones are skipped here and reported by the zone manager
+    valve_pins = [zone['VALVE_PIN'] for zone in config['ZONES'] if isinstance(zone, dict) and 'VALVE_PIN' in zone]
+    pins_controller.close_valves(valve_pins or [config['VALVE_PIN']])
 
 # Configure logging
-SprinklerLogging.configure_logging()
+with startup.phase('logging'):
+    import SprinklerLogging
+
+    SprinklerLogging.configure_logging()
 
 logger = logging.getLogger(__name__)
 
-# Start components
-pins_controller = PinsController()
-valve = Valve()
-valve.start()
-flow_sensor = FlowSensor()
-flow_sensor.start()
+with startup.phase('imports'):
+    import ConfigSnapshot
+    import EventJournal
+    import SprinklerMetrics
+    from FlowSensorControl import FlowSensor
+    from ScheduleControl import ScheduleExecutor
+    from SprinklerUtils import lazy_import
+    from ValveControl import Valve
+    from ZoneControl import ZoneManager
+
+    SprinklerApi = lazy_import('SprinklerApi')
+    Gateway = lazy_import('Gateway')
+
+# Set once the components have been stopped
+stopped = threading.Event()
+
+SprinklerMetrics.start_exporters()
+
+# Gateway mode: the other devices on the LAN talk to the server through this client
+gateway = None
+if config['GATEWAY_PORT'] is not None:
+    with startup.phase('gateway'):
+        gateway = Gateway.Gateway().start()
+
+# Asyncio runtime: All components run on a single event loop until interrupted
+if config['RUNTIME_MODE'] == 'asyncio' and config['ZONES']:
+    logger.warning('Asyncio runtime does not support zones. Using the threaded runtime')
+elif config['RUNTIME_MODE'] == 'asyncio' and config['VALVE_COMMAND_MODE'] == 'schedule':
+    logger.warning('Asyncio runtime does not support the schedule mode. Using the threaded runtime')
+elif config['RUNTIME_MODE'] == 'asyncio':
+    with startup.phase('asyncio_imports'):
+        import SprinklerAsync
+
+    with startup.phase('components'):
+        flow_sensor = FlowSensor()
+        valve = Valve(flow_sensor=flow_sensor)
+        ConfigSnapshot.start_watching()
+    startup.report()
+    SprinklerAsync.run(valve, flow_sensor)
+    ConfigSnapshot.stop_watching()
+    if gateway is not None:
+        gateway.stop()
+    pins_controller.clean_up()
+    SprinklerApi.get_api_client().close()
+    EventJournal.close_journal()
+    SprinklerMetrics.stop_exporters()
+    sys.exit(0)
+
+# Threaded runtime: Start components
+with startup.phase('components'):
+    if config['ZONES']:
+        zone_manager = ZoneManager()
+        components = [zone_manager]
+        if config['VALVE_COMMAND_MODE'] == 'schedule':
+            components.append(ScheduleExecutor(dict((zone.id, zone.valve) for zone in zone_manager.zones.values())))
+    else:
+        flow_sensor = FlowSensor()
+        valve = Valve(flow_sensor=flow_sensor)
+        if config['VALVE_COMMAND_MODE'] == 'schedule':
+            components = [ScheduleExecutor({None: valve}), flow_sensor]
+        else:
+            components = [valve, flow_sensor]
+    for component in components:
+        component.start()
+    # Settings changed in the config file are applied while the components keep running
+    ConfigSnapshot.start_watching()
+startup.report()
 
 
 # Cleanup
 def cleanup(sig_num, stack_frame):
     logger.info('Interrupted by sig_num %d. Cleaning up before exit', sig_num)
-    valve.stop()
-    flow_sensor.stop()
+    ConfigSnapshot.stop_watching()
+    for component in components:
+        component.stop()
+    if gateway is not None:
+        gateway.stop()
     pins_controller.clean_up()
-    global active
-    active = False
+    SprinklerApi.get_api_client().close()
+    EventJournal.close_journal()
+    SprinklerMetrics.stop_exporters()
+    stopped.set()
 
 signals = [signal.SIGINT, signal.SIGTERM]
 for s in signals:
     signal.signal(s, cleanup)
 
 logger.debug('Keeping the main thread alive')
-while active:
-    time.sleep(10)
\ No newline at end of file
+# Waiting on an event instead of sleeping lets the process exit as soon as the signal handler has cleaned up
+while not stopped.wait(10):
+    pass
@@ -0,0 +1,258 @@
+import logging
+import socket
+import threading
+import time
+
+import requests
+import urllib3
+import urllib3.connection
+import urllib3.connectionpool
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+
+import CircuitBreaker
+import ConfigSnapshot
+import EventJournal
+import SprinklerMetrics
+import SprinklerUtils
+from SprinklerConfig import config
+
+logger = logging.getLogger(__name__)
+
+# Bytes read at a time from a response body. The call deadline is checked in between
+BODY_CHUNK_SIZE = 4096
+
+
+# Raised instead of calling the server while the circuit breaker is open
+class CircuitOpenError(requests.ConnectionError):
+    pass
+
+
+# Raised when a call has not completed within its deadline
+class DeadlineExceeded(requests.Timeout):
+    pass
+
+
+# Errors raised by the API client when the server could not be reached
+REQUEST_ERRORS = (requests.ConnectionError, requests.Timeout)
+# Settings the base url, auth, timeouts and circuit breaker of the API client are built from
+SERVER_SETTINGS = ('SERVER_DNS', 'SERVER_PROTOCOL', 'SERVER_IP', 'SERVER_PORT', 'PRODUCT_KEY', 'SERVER_CONNECT_TIMEOUT',
+                   'SERVER_READ_TIMEOUT', 'SERVER_BREAKER_THRESHOLD', 'SERVER_BREAKER_OPEN_TIME',
+                   'SERVER_BREAKER_MAX_OPEN_TIME', 'SERVER_BREAKER_JITTER')
+
+
+# Sockets of the requests waiting for their response, by thread, so that the waits can be aborted from other threads
+waiting_sockets = {}
+
+
+# Connection that registers its socket while waiting for the response
+class AbortableConnection(object):
+    def getresponse(self, *args, **kwargs):
+        thread_id = threading.get_ident()
+        waiting_sockets[thread_id] = self.sock
+        try:
+            return super(AbortableConnection, self).getresponse(*args, **kwargs)
+        finally:
+            waiting_sockets.pop(thread_id, None)
+
+
+class AbortableHTTPConnection(AbortableConnection, urllib3.connection.HTTPConnection):
+    pass
+
+
+class AbortableHTTPSConnection(AbortableConnection, urllib3.connection.HTTPSConnection):
+    pass
+
+
+class AbortableHTTPConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+    ConnectionCls = AbortableHTTPConnection
+
+
+class AbortableHTTPSConnectionPool(urllib3.connectionpool.HTTPSConnectionPool):
+    ConnectionCls = AbortableHTTPSConnection
+
+
+# Transport adapter whose requests can be aborted while waiting for their response. See abort_request
+class AbortableHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': AbortableHTTPConnectionPool,
+                                                   'https': AbortableHTTPSConnectionPool}
+
+
+# Aborts the request the given thread is waiting for the response of, e.g. a long poll that would hold up a shutdown
+# The request fails with a ConnectionError. Returns whether a request was waiting
+def abort_request(thread):
+    sock = waiting_sockets.get(thread.ident)
+    if sock is None:
+        return False
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    return True
+
+
+# Client wide API client for communicating with the server
+# Keeps the connections alive in a pool so that each update cycle does not open a new TCP/TLS connection
+# The base url and auth are built once and only rebuilt when a config snapshot with other server settings is taken
+# Every call has a deadline for its total duration, and all calls share a circuit breaker so that the components stop
+# calling a failing server until a probe shows that it has recovered
+class ApiClient(object):
+    def __init__(self):
+        self.session = requests.Session()
+        adapter = AbortableHTTPAdapter(pool_connections=1, pool_maxsize=config['SERVER_POOL_SIZE'])
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.server_settings = None
+        self.api_base = None
+        self.auth = None
+        self.timeout = None
+        self.breaker = None
+        self.deadline = None
+        self.probe_path = None
+        self.bind()
+
+    # Binds the base url, auth, timeouts and deadline from the current config snapshot
+    # They are only built again when the server settings of a new snapshot differ, so that calls do not read the config
+    def bind(self):
+        snapshot = ConfigSnapshot.current()
+        if snapshot is self.snapshot:
+            return
+        server_settings = tuple(snapshot[key] for key in SERVER_SETTINGS)
+        with self.lock:
+            if server_settings != self.server_settings:
+                self.api_base = SprinklerUtils.get_server_api_base(snapshot)
+                self.auth = HTTPBasicAuth('API_KEY', snapshot['PRODUCT_KEY'])
+                self.timeout = (snapshot['SERVER_CONNECT_TIMEOUT'], snapshot['SERVER_READ_TIMEOUT'])
+                # A new server starts with a closed breaker
+                self.breaker = CircuitBreaker.CircuitBreaker(
+                    snapshot['SERVER_BREAKER_THRESHOLD'], snapshot['SERVER_BREAKER_OPEN_TIME'],
+                    snapshot['SERVER_BREAKER_MAX_OPEN_TIME'], snapshot['SERVER_BREAKER_JITTER'])
+                self.server_settings = server_settings
+                logger.debug('API client has been bound to %s', self.api_base)
+            self.deadline = snapshot['SERVER_CALL_DEADLINE']
+            self.probe_path = snapshot['SERVER_BREAKER_PROBE_PATH']
+            self.snapshot = snapshot
+
+    # Sends a request to the given path relative to the server api base
+    # Raises CircuitOpenError without sending it if the circuit breaker is open, or if it is due for a probe and the
+    # server has not recovered yet. The deadline defaults to SERVER_CALL_DEADLINE seconds
+    def request(self, method, path, deadline=None, **kwargs):
+        self.bind()
+        self.check_breaker()
+        return self.send(method, path, deadline, **kwargs)
+
+    # Asks the circuit breaker for permission to call the server, probing the server if it is due
+    def check_breaker(self):
+        permit = self.breaker.acquire()
+        if permit == CircuitBreaker.REJECT:
+            raise CircuitOpenError('Server calls are paused after repeated failures')
+        if permit == CircuitBreaker.PROBE:
+            logger.info('Probing whether the server has recovered')
+            try:
+                resp = self.send('GET', self.probe_path, **self.probe_request_args())
+            except REQUEST_ERRORS:
+                resp = None
+            if not is_server_healthy(resp):
+                raise CircuitOpenError('Server has not recovered yet')
+
+    # Request arguments for probing the server. Probes only wait for the connect timeout
+    def probe_request_args(self):
+        connect_timeout = self.timeout[0]
+        return {'deadline': 2 * connect_timeout, 'timeout': (connect_timeout, connect_timeout)}
+
+    # Sends a request regardless of the circuit breaker and records its outcome
+    # The outcome and the latency are recorded in the event journal, the metrics and the circuit breaker
+    # The request is authenticated with the product key of this client unless other auth is given
+    def send(self, method, path, deadline=None, **kwargs):
+        deadline = self.deadline if deadline is None else deadline
+        kwargs.setdefault('auth', self.auth)
+        kwargs['timeout'] = normalize_timeout(kwargs.pop('timeout', None), self.timeout, deadline)
+        start_time = time.time()
+        resp = None
+        try:
+            # The body is streamed so that it can be read within the deadline
+            resp = self.session.request(method, self.api_base + path, stream=True, **kwargs)
+            read_body(resp, start_time + deadline)
+            return resp
+        finally:
+            status = resp.status_code if resp is not None else None
+            record_request(method, path, status, time.time() - start_time)
+            self.breaker.record(is_server_healthy(resp))
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, json=None, **kwargs):
+        return self.request('POST', path, json=json, **kwargs)
+
+    # Closes all pooled connections
+    def close(self):
+        self.session.close()
+
+
+# Reads the whole body of a streamed response into it. Raises DeadlineExceeded if the body is still incomplete at
+# deadline_time, e.g. because a half-open connection trickles it, which the per-read timeout alone does not catch
+def read_body(resp, deadline_time):
+    read = getattr(resp.raw, 'read1', resp.raw.read)
+    chunks = []
+    try:
+        while True:
+            chunk = read(BODY_CHUNK_SIZE, decode_content=True)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            if time.time() > deadline_time:
+                raise DeadlineExceeded('Response of %s was not received within the deadline' % resp.url)
+    except urllib3.exceptions.ReadTimeoutError as e:
+        resp.close()
+        raise requests.ReadTimeout(e)
+    except urllib3.exceptions.HTTPError as e:
+        resp.close()
+        raise requests.ConnectionError(e)
+    except Exception:
+        resp.close()
+        raise
+    # Same as what requests does when the body is accessed, so that the response behaves as if it was not streamed
+    resp._content = b''.join(chunks)
+    resp._content_consumed = True
+    resp.close()
+
+
+# Normalises a timeout as accepted by requests to a (connect, read) tuple capped at the deadline
+# None uses the default timeout of the client, a single number applies to both, and None in a tuple (no timeout)
+# leaves only the deadline
+def normalize_timeout(timeout, default, deadline):
+    if timeout is None:
+        timeout = default
+    elif not isinstance(timeout, (tuple, list)):
+        timeout = (timeout, timeout)
+    return tuple(deadline if value is None else min(value, deadline) for value in timeout)
+
+
+# Whether a response shows that the server is reachable and working. Client errors do not count against the server
+def is_server_healthy(resp):
+    return resp is not None and resp.status_code < 500
+
+
+# Records the outcome of a request to the server. Status is None if the server could not be reached
+def record_request(method, path, status, latency):
+    EventJournal.record_http_request(method, path, status, latency)
+    SprinklerMetrics.observe_request(method, path, status, latency)
+
+
+api_client = None
+api_client_lock = threading.Lock()
+
+
+# Returns the client wide API client, creating it on first use
+def get_api_client():
+    global api_client
+    if api_client is None:
+        with api_client_lock:
+            if api_client is None:
+                api_client = ApiClient()
+    return api_client
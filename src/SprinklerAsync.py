@@ -0,0 +1,371 @@
+import asyncio
+import base64
+import concurrent.futures
+import functools
+import heapq
+import itertools
+import json
+import logging
+import signal
+import threading
+
+import CircuitBreaker
+import Clock
+import ConfigSnapshot
+import FlowAnalytics
+import SprinklerApi
+import SprinklerMetrics
+import SprinklerUtils
+from FlowSensorControl import FlowSensor
+from GPIOWrapper import pins
+from SprinklerConfig import config
+from ValveControl import Valve
+
+# Optional. Only imported if ASYNC_HTTP_CLIENT selects it, as it takes about 10 MB on top of requests
+aiohttp = SprinklerUtils.lazy_import('aiohttp')
+
+logger = logging.getLogger(__name__)
+
+SIGNALS = [signal.SIGINT, signal.SIGTERM]
+# Threads running the requests of the shared API client. The valve and the flow loop have one call pending at most
+EXECUTOR_WORKERS = 2
+
+
+# Fully read response exposing the same attributes as the requests responses read by the components
+class AsyncResponse(object):
+    def __init__(self, status_code, reason, text):
+        self.status_code = status_code
+        self.reason = reason
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+# Non-blocking API client for the asyncio runtime
+# By default the requests of the shared API client are run in a thread pool of EXECUTOR_WORKERS threads, which is
+# shared by all components instead of one thread per component. With ASYNC_HTTP_CLIENT = 'aiohttp', the requests are
+# sent by aiohttp on the event loop instead
+class AsyncApiClient(object):
+    def __init__(self):
+        self.api_client = SprinklerApi.get_api_client()
+        self.session = None
+        self.executor = None
+        self.auth = None
+        self.bound_auth = None
+        self.use_aiohttp = config['ASYNC_HTTP_CLIENT'] == 'aiohttp'
+        if self.use_aiohttp and aiohttp is None:
+            logger.warning('aiohttp is not installed. Running the server calls in a thread pool')
+            self.use_aiohttp = False
+        if self.use_aiohttp:
+            self.errors = (aiohttp.ClientError, asyncio.TimeoutError, SprinklerApi.CircuitOpenError)
+        else:
+            self.errors = SprinklerApi.REQUEST_ERRORS
+
+    async def request(self, method, path, params=None, json=None, timeout=None, data=None, headers=None,
+                      deadline=None):
+        if not self.use_aiohttp:
+            return await self.request_in_executor(method, path, params, json, timeout, data, headers, deadline)
+        self.api_client.bind()
+        await self.check_breaker()
+        return await self.send(method, path, params, json, timeout, data, headers, deadline)
+
+    # Same as ApiClient.check_breaker
+    async def check_breaker(self):
+        permit = self.api_client.breaker.acquire()
+        if permit == CircuitBreaker.REJECT:
+            raise SprinklerApi.CircuitOpenError('Server calls are paused after repeated failures')
+        if permit == CircuitBreaker.PROBE:
+            logger.info('Probing whether the server has recovered')
+            try:
+                resp = await self.send('GET', self.api_client.probe_path,
+                                       **self.api_client.probe_request_args())
+            except self.errors:
+                resp = None
+            if not SprinklerApi.is_server_healthy(resp):
+                raise SprinklerApi.CircuitOpenError('Server has not recovered yet')
+
+    # Same as ApiClient.send
+    async def send(self, method, path, params=None, json=None, timeout=None, data=None, headers=None, deadline=None):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=config['SERVER_POOL_SIZE'])
+            self.session = aiohttp.ClientSession(connector=connector)
+        if self.bound_auth is not self.api_client.auth:
+            credentials = '%s:%s' % (self.api_client.auth.username, self.api_client.auth.password)
+            self.auth = {'Authorization': 'Basic ' + base64.b64encode(credentials.encode('utf8')).decode('ascii')}
+            self.bound_auth = self.api_client.auth
+        deadline = self.api_client.deadline if deadline is None else deadline
+        connect_timeout, read_timeout = SprinklerApi.normalize_timeout(timeout, self.api_client.timeout, deadline)
+        if params is not None:
+            params = dict((key, str(value)) for key, value in params.items())
+        if headers is not None:
+            headers = dict(headers, **self.auth)
+        start_time = Clock.now()
+        response = None
+        try:
+            async with self.session.request(
+                    method, self.api_client.api_base + path, params=params, json=json, data=data,
+                    headers=headers or self.auth,
+                    timeout=aiohttp.ClientTimeout(total=deadline, sock_connect=connect_timeout,
+                                                  sock_read=read_timeout)) as resp:
+                text = await resp.text()
+                response = AsyncResponse(resp.status, resp.reason, text)
+                return response
+        finally:
+            status = response.status_code if response is not None else None
+            SprinklerApi.record_request(method, path, status, Clock.now() - start_time)
+            self.api_client.breaker.record(SprinklerApi.is_server_healthy(response))
+
+    async def request_in_executor(self, method, path, params, json, timeout, data=None, headers=None, deadline=None):
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS,
+                                                                  thread_name_prefix='AsyncApiThread')
+        kwargs = {'params': params, 'json': json, 'data': data, 'headers': headers, 'deadline': deadline}
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        call = functools.partial(self.api_client.request, method, path, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+
+    async def get(self, path, **kwargs):
+        return await self.request('GET', path, **kwargs)
+
+    async def post(self, path, json=None, **kwargs):
+        return await self.request('POST', path, json=json, **kwargs)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+
+# Wakes a sleep of the runtime unless it has been cancelled
+def wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+# Sleeps of the coroutines of the runtime on a clock other than the system clock, e.g. the virtual clock of the tests
+# and simulations, which only knows about threads
+# One thread waits on the clock for the earliest sleep, but only once all loops of the runtime sleep, so that the clock
+# sees the event loop as a thread that is blocked on it while it has nothing to do. Due sleeps are woken on the loop
+class ClockWaiter(object):
+    def __init__(self, loop, clock, loops):
+        self.loop = loop
+        self.clock = clock
+        self.loops = loops
+        # Heap of the deadline, a sequence number and the future of each pending sleep
+        self.sleepers = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        # Set to end a wait on the clock when the waiter is closed
+        self.closing = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='AsyncClockThread', daemon=True)
+        clock.add_thread(self.thread)
+        self.thread.start()
+
+    # Returns a future that is done once seconds have passed on the clock
+    def sleep(self, seconds):
+        future = self.loop.create_future()
+        with self.condition:
+            if self.closing.is_set():
+                future.set_result(None)
+                return future
+            heapq.heappush(self.sleepers, (self.clock.time() + max(seconds, 0), next(self.sequence), future))
+            self.condition.notify()
+        return future
+
+    def run(self):
+        with self.condition:
+            while not self.closing.is_set():
+                if len(self.sleepers) < self.loops:
+                    self.condition.wait()
+                    continue
+                deadline = self.sleepers[0][0]
+                self.condition.release()
+                try:
+                    self.clock.wait(self.closing, deadline - self.clock.time())
+                finally:
+                    self.condition.acquire()
+                now = self.clock.time()
+                while self.sleepers and self.sleepers[0][0] <= now:
+                    self.loop.call_soon_threadsafe(wake, heapq.heappop(self.sleepers)[2])
+
+    # Wakes all pending sleeps and ends the thread. Must be called on the loop
+    def close(self):
+        with self.condition:
+            self.closing.set()
+            self.condition.notify()
+            for _, _, future in self.sleepers:
+                wake(future)
+            del self.sleepers[:]
+        self.thread.join()
+
+
+# Runs the valve and the flow sensor as coroutines on a single event loop
+# The component logic is shared with the threaded mode through the steps of their processes, see
+# SprinklerUtils.run_steps. Only the server calls and the sleeps are awaited. Flow sensor pulses keep being counted by
+# the pulse accumulator directly in the GPIO thread, as hopping into the loop on every edge would cost a loop wakeup
+# per pulse. The loops sleep on the client wide clock, with asyncio timers for the system clock
+class AsyncRuntime(object):
+    def __init__(self, valve, flow_sensor, api=None):
+        self.valve = valve
+        self.flow_sensor = flow_sensor
+        self.api = api or AsyncApiClient()
+        self.clock = Clock.get_clock()
+        self.clock_waiter = None
+        self.loop = None
+        self.stopping = None
+
+    # Sleeps for the given seconds unless the runtime is stopped. Returns whether the runtime is still active
+    async def sleep(self, seconds):
+        if self.clock_waiter is not None:
+            await self.clock_waiter.sleep(seconds)
+            return not self.stopping.is_set()
+        try:
+            await asyncio.wait_for(self.stopping.wait(), max(seconds, 0))
+        except asyncio.TimeoutError:
+            pass
+        return not self.stopping.is_set()
+
+    # Same as SprinklerUtils.run_steps, with the server calls made by the awaited methods of the runtime
+    async def run_steps(self, steps):
+        result = None
+        try:
+            while True:
+                name, args = steps.send(result)
+                result = await getattr(self, name)(*args)
+        except StopIteration as e:
+            return e.value
+
+    async def get_valve_info(self, wait=None, known_state=None, known_info=None, ack_version=None):
+        logger.debug('Fetching valve state from serve')
+        request_args = Valve.valve_info_request_args(wait, known_state, Valve.valve_version(known_info), ack_version)
+        try:
+            resp = await self.api.get('/valve', **request_args)
+        except self.api.errors:
+            logger.exception("Error occurred while fetching valve state from server")
+            return None
+        return Valve.read_valve_info(resp, known_info)
+
+    async def send_success(self, valve_info):
+        logger.debug('Sending valve state update success to server: %s', valve_info)
+        try:
+            resp = await self.api.post('/valve', json=valve_info)
+        except self.api.errors:
+            logger.exception("Error occurred while sending valve state update success to server")
+            return None
+        return Valve.read_send_success(resp)
+
+    async def valve_loop(self):
+        logger.debug('Starting process loop for Valve')
+        long_poll = self.valve.bind()['VALVE_COMMAND_MODE'] == 'long_poll'
+        while True:
+            start_time = self.clock.time()
+            try:
+                interval = await self.run_steps(self.valve.poll_steps(long_poll))
+            except Exception:
+                logger.exception('Error occurred in the process loop for Valve')
+                interval = self.valve.settings['VALVE_STATE_POLL_INTERVAL']
+            # Same as the scheduler of the threaded runtime, the interval counts from the start of the poll
+            if not await self.sleep(start_time + interval - self.clock.time()):
+                break
+            if not long_poll:
+                SprinklerMetrics.observe_loop_drift('Valve', start_time, interval)
+        logger.debug('Ending process loop for Valve')
+
+    async def send_flow_data(self, volume, duration, rate=None):
+        flow_info = FlowSensor.flow_info(volume, duration, rate)
+        logger.debug('Sending flow data to server: %s', flow_info)
+        try:
+            resp = await self.api.post('/flow', json=flow_info)
+        except self.api.errors:
+            logger.exception("Error occurred while sending flow data to server")
+            return None
+        return FlowSensor.read_send_result(resp, 'flow data')
+
+    async def send_flow_batch(self, records):
+        logger.debug('Sending %d flow record(s) to server', len(records))
+        try:
+            resp = await self.api.post('/flow/batch', **FlowSensor.flow_batch_request_args(records))
+        except self.api.errors:
+            logger.exception("Error occurred while sending flow records to server")
+            return None
+        return FlowSensor.read_send_result(resp, 'flow records')
+
+    async def flow_loop(self):
+        logger.debug('Starting process loop for Flow Sensor')
+        while True:
+            start_time = self.clock.time()
+            try:
+                success = await self.run_steps(self.flow_sensor.save_flow_steps())
+                logger.debug('Update loop completed with status %s', success)
+            except Exception:
+                logger.exception('Error occurred in the process loop for Flow Sensor')
+            interval = self.flow_sensor.bind()['FLOW_DATA_SAVE_INTERVAL']
+            if not await self.sleep(start_time + interval - self.clock.time()):
+                break
+            SprinklerMetrics.observe_loop_drift('FlowSensor', start_time, interval)
+        logger.debug('Ending process loop for Flow Sensor')
+
+    # Samples the flow rate for the analytics. Sampling only reads the pulse accumulator, so it runs on the loop
+    async def analytics_loop(self):
+        logger.debug('Starting flow analytics loop')
+        while await self.sleep(FlowAnalytics.sample_interval(ConfigSnapshot.current())):
+            try:
+                self.flow_sensor.analytics.sample()
+            except Exception:
+                logger.exception('Error occurred in the flow analytics loop')
+        logger.debug('Ending flow analytics loop')
+
+    # Stops the runtime. Can be called from any thread
+    def stop(self, sig_num=None):
+        if sig_num is not None:
+            logger.info('Interrupted by sig_num %d. Cleaning up before exit', sig_num)
+        self.loop.call_soon_threadsafe(self.stopping.set)
+
+    # Runs the components until stopped by a signal or a call to stop
+    async def run(self, handle_signals=True):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        if handle_signals:
+            for sig_num in SIGNALS:
+                self.loop.add_signal_handler(sig_num, self.stop, sig_num)
+        logger.info('Starting asyncio runtime. Non-blocking HTTP: %s',
+                    'aiohttp' if self.api.use_aiohttp else 'thread pool')
+        self.valve.active = self.flow_sensor.active = True
+        tasks = [
+            self.loop.create_task(self.valve_loop(), name='Valve'),
+            self.loop.create_task(self.flow_loop(), name='FlowSensor')
+        ]
+        if self.flow_sensor.analytics is not None:
+            tasks.append(self.loop.create_task(self.analytics_loop(), name='FlowAnalytics'))
+        if not isinstance(self.clock, Clock.SystemClock):
+            self.clock_waiter = ClockWaiter(self.loop, self.clock, len(tasks))
+        try:
+            await self.stopping.wait()
+        finally:
+            logger.info('Stopping asyncio runtime')
+            self.valve.active = self.flow_sensor.active = False
+            if self.clock_waiter is not None:
+                self.clock_waiter.close()
+            for task in tasks:
+                task.cancel()
+            for task, result in zip(tasks, await asyncio.gather(*tasks, return_exceptions=True)):
+                if isinstance(result, Exception):
+                    logger.error('Task %s of the asyncio runtime has failed', task.get_name(), exc_info=result)
+            self.valve.update(pins.LOW)
+            self.flow_sensor.bind()
+            if self.flow_sensor.prepare_final_batch():
+                logger.info('Uploading %d batched flow record(s) before stopping', len(self.flow_sensor.outbox))
+                await self.run_steps(self.flow_sensor.drain_outbox_steps())
+            await self.api.close()
+            if handle_signals:
+                for sig_num in SIGNALS:
+                    self.loop.remove_signal_handler(sig_num)
+            logger.info('Asyncio runtime has been stopped')
+
+
+# Runs the components on a new event loop until interrupted
+def run(valve, flow_sensor):
+    asyncio.run(AsyncRuntime(valve, flow_sensor).run())
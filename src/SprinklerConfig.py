@@ -1,5 +1,36 @@
+import itertools
+
+
+# Settings dict that counts its changes, so that snapshots of it are only taken again after it has changed
+# See ConfigSnapshot
+class ConfigDict(dict):
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.versions = itertools.count(1)
+        self.version = 0
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.version = next(self.versions)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.version = next(self.versions)
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self.version = next(self.versions)
+
+
 # All
-config = {}
+config = ConfigDict()
+
+# Config
+config_file_config = {
+    'CONFIG_FILE': None,  # JSON settings applied over the private overrides, relative to src. Reloaded when changed
+    'CONFIG_RELOAD_INTERVAL': 5  # Seconds between checks of the config file for changes
+}
+config.update(config_file_config)
 
 # Product
 product_config = {
@@ -12,10 +43,63 @@ server_config = {
     'SERVER_DNS': None,
     'SERVER_PROTOCOL': 'http://',
     'SERVER_IP': None,
-    'SERVER_PORT': None
+    'SERVER_PORT': None,
+    'SERVER_CONNECT_TIMEOUT': 5,  # Seconds
+    'SERVER_READ_TIMEOUT': 15,  # Seconds
+    'SERVER_POOL_SIZE': 4,  # Max pooled keep-alive connections
+    'SERVER_CALL_DEADLINE': 30,  # Seconds. Max total duration of a call, including reading a slowly sent response
+    'SERVER_BREAKER_THRESHOLD': 5,  # Consecutive failed calls that stop calls to the server. Disabled if 0
+    'SERVER_BREAKER_OPEN_TIME': 10,  # Seconds calls are stopped for. Doubles after each failed probe
+    'SERVER_BREAKER_MAX_OPEN_TIME': 300,  # Seconds
+    'SERVER_BREAKER_JITTER': 0.2,  # Fraction the stop time is randomly varied by
+    'SERVER_BREAKER_PROBE_PATH': '/valve'  # Requested with GET to probe whether the server has recovered
 }
 config.update(server_config)
 
+# Runtime
+runtime_config = {
+    # threaded/asyncio. Asyncio runs the valve and the flow sensor on one event loop, but takes about 2 MB more memory
+    # and a little more CPU than threaded, which stays the default. See benchmarks/RuntimeFootprintBenchmark.py
+    'RUNTIME_MODE': 'threaded',
+    # executor/aiohttp. Asyncio runtime: The server calls run in a small thread pool, or on aiohttp from
+    # requirements-optional.txt, which takes about 10 MB more memory
+    'ASYNC_HTTP_CLIENT': 'executor',
+    'LOOP_MISSED_TICKS': 'skip'  # skip/catch_up. What the update loops do with runs missed while a run was too slow
+}
+config.update(runtime_config)
+
+# Logging
+logging_config = {
+    'LOG_MODE': 'direct',  # direct/queued. Queued hands the records to a background writer thread
+    # DEBUG/INFO/WARNING/ERROR. Level of the log file. The per-cycle DEBUG lines are covered by the event journal and
+    # cost an SD card write each
+    'LOG_FILE_LEVEL': 'INFO',
+    'LOG_QUEUE_SIZE': 10000,  # Max records waiting to be written
+    'LOG_QUEUE_OVERFLOW': 'drop_new',  # drop_new/drop_old. Records dropped when the queue is full
+    'LOG_QUEUE_BATCH_SIZE': 200,  # Max records formatted and written together
+    'LOG_QUEUE_FLUSH_INTERVAL': 0.5  # Seconds between writes unless a batch is full or a warning is logged
+}
+config.update(logging_config)
+
+# Event Journal
+journal_config = {
+    'JOURNAL_DIR': None,  # Binary event journal directory, relative to src. Disabled if None
+    'JOURNAL_SEGMENT_SIZE': 1048576,  # Bytes per segment file
+    'JOURNAL_MAX_SEGMENTS': 16,  # Oldest segments are deleted beyond this
+    'JOURNAL_FLUSH_BYTES': 4096,  # Buffered bytes written together
+    'JOURNAL_FLUSH_INTERVAL': 60  # Max seconds an event stays buffered
+}
+config.update(journal_config)
+
+# Metrics
+metrics_config = {
+    'METRICS_HOST': '127.0.0.1',
+    'METRICS_PORT': None,  # Serves the metrics at /metrics in the Prometheus text format. Disabled if None
+    'METRICS_SNAPSHOT_FILE': None,  # Periodic snapshot of the metrics, relative to src. Disabled if None
+    'METRICS_SNAPSHOT_INTERVAL': 60  # Seconds
+}
+config.update(metrics_config)
+
 # Pins
 gpio_config = {
     'FORCE_DUMMY_GPIO': False
@@ -25,7 +109,16 @@ config.update(gpio_config)
 # Valve
 valve_config = {
     'VALVE_PIN': None,  # todo: test init
-    'VALVE_STATE_POLL_INTERVAL': 10  # Seconds
+    'VALVE_STATE_POLL_INTERVAL': 10,  # Seconds
+    'VALVE_POLL_JITTER': 0,  # Max seconds each poll is randomly delayed by, to spread the polls of many devices
+    'VALVE_COMMAND_MODE': 'poll',  # poll/long_poll/schedule. Schedule runs the cached irrigation schedule locally
+    'VALVE_LONG_POLL_TIMEOUT': 60,  # Seconds the server may hold a long poll
+    'VALVE_ACK_MODE': 'post',  # post/piggyback. Piggyback acknowledges a state change with the next fetch
+    'VALVE_POLL_ADAPTIVE': False,  # Adapts the poll interval to activity instead of VALVE_STATE_POLL_INTERVAL
+    'VALVE_POLL_MIN_INTERVAL': 2,  # Seconds. Used while the valve is in use
+    'VALVE_POLL_MAX_INTERVAL': 120,  # Seconds. Reached while the device is idle
+    'VALVE_POLL_ACTIVE_PERIOD': 300,  # Seconds after the last activity to keep polling at the min interval
+    'VALVE_POLL_BACKOFF_FACTOR': 2
 }
 config.update(valve_config)
 
@@ -33,15 +126,79 @@ config.update(valve_config)
 flow_config = {
     'FLOW_SENSOR_PIN': None,  # todo: test init
     'PULSES_PER_LITRE': 365,
+    # K-factor table from FlowCalibration.py, relative to src. PULSES_PER_LITRE if None. Applied per pulse rate, with
+    # the pulses counted by rate bucket as they arrive
+    'FLOW_CALIBRATION_FILE': None,
     'FLOW_DATA_SAVE_INTERVAL': 10,  # Seconds
+    'FLOW_DATA_SAVE_JITTER': 0,  # Max seconds each save is randomly delayed by
     'MIN_FLOW_VOLUME_FOR_SAVE': 0.1,  # Litres
-    'MAX_FLOW_DURATION_FOR_SAVE': 3600  # Seconds
+    'MAX_FLOW_DURATION_FOR_SAVE': 3600,  # Seconds
+    'FLOW_RATE_SERIES_SIZE': 0,  # Pulse timestamps kept for flow rate summaries. Disabled if 0
+    'FLOW_OUTBOX_FILE': None,  # On-disk outbox for flow records, relative to src. Disabled if None
+    'FLOW_OUTBOX_MAX_RECORDS': 100000,  # Oldest records are evicted beyond this
+    'FLOW_OUTBOX_BATCH_SIZE': 100,  # Max records per upload when draining the outbox
+    'FLOW_OUTBOX_FSYNC': True,  # Sync each record to the card. If False, a power cut may lose the last records
+    'FLOW_UPLOAD_MODE': 'single',  # single/batch. Batch keeps the records in memory and uploads them together
+    'FLOW_BATCH_MAX_RECORDS': 30,  # Batch mode: Records per upload. An upload is due once this many are pending
+    'FLOW_BATCH_MAX_LATENCY': 300,  # Batch mode: Seconds. An upload is due once the oldest record is this old
+    'FLOW_BATCH_MAX_PENDING': 10000,  # Batch mode: Oldest records are merged beyond this while uploads fail
+    'FLOW_BATCH_COMPRESSION': None,  # gzip/None. Compression of the batch uploads, including outbox drains
+    # Max seconds between flow rate samples for on-device leak detection, e.g. 1. Disabled if None. All flow sensors
+    # are sampled from one task, more often if needed for FLOW_ANOMALY_LATENCY
+    'FLOW_ANALYTICS_INTERVAL': None,
+    'FLOW_ANALYTICS_ALPHA': 0.1,  # Weight of the newest sample in the moving rate statistics
+    'FLOW_ANOMALY_SAMPLES': 2,  # Consecutive anomalous samples that raise an anomaly
+    # Seconds. Max time from the start of an anomaly until it is raised. The flow is sampled at least every
+    # FLOW_ANOMALY_LATENCY / (FLOW_ANOMALY_SAMPLES + 1) seconds, e.g. every 1/3 second by default
+    'FLOW_ANOMALY_LATENCY': 1,
+    'FLOW_LEAK_MIN_RATE': 0.5,  # Litres/minute. Flow at or above this while the valve is closed is a leak
+    'FLOW_LEAK_GRACE_PERIOD': 5,  # Seconds after a valve state change before flow with the valve closed is a leak
+    'FLOW_EXPECTED_RATE': None,  # Litres/minute. Max normal flow. Learned from the flow while the valve is open if None
+    'FLOW_EXPECTED_RATE_WARMUP': 20,  # Samples of open valve flow before the learned expected rate is used
+    'FLOW_OVER_RATE_FACTOR': 1.5  # Flow above the expected rate by this factor is an anomaly
 }
 config.update(flow_config)
 
+# Zones
+zone_config = {
+    # Operates several zones in one process if not empty. Each zone is a dict with ID, VALVE_PIN and FLOW_SENSOR_PIN
+    'ZONES': []
+}
+config.update(zone_config)
+
+# Irrigation Schedule
+schedule_config = {
+    'SCHEDULE_CACHE_FILE': '../data/schedule.json',  # Cached irrigation schedule, relative to src
+    'SCHEDULE_SYNC_INTERVAL': 300,  # Seconds between checks for a new schedule version
+    'SCHEDULE_MAX_REPORTS': 1000  # Run reports kept while they cannot be sent. Oldest are dropped beyond this
+}
+config.update(schedule_config)
+
+# Gateway
+gateway_config = {
+    # Serves the server API to the other devices on the LAN at this port, which point SERVER_IP and SERVER_PORT at
+    # this device. Valve and flow requests are coalesced, zone and schedule requests are passed through.
+    # Disabled if None
+    'GATEWAY_PORT': None,
+    'GATEWAY_HOST': '0.0.0.0',
+    'GATEWAY_SYNC_INTERVAL': 10,  # Seconds between upstream syncs of the valve states of all devices
+    'GATEWAY_COALESCE_DELAY': 0.05,  # Seconds a sync woken by a device request waits for those of the other devices
+    'GATEWAY_FORWARD_TIMEOUT': 30  # Seconds a device request waits for being forwarded to the server
+}
+config.update(gateway_config)
+
+# Defaults before any overrides
+defaults = dict(config)
+
 # Private Overrides
 try:
     from PrivateConfig import config as private_config
 except ImportError:
     private_config = {}
 config.update(private_config)
+
+# File Overrides
+if config['CONFIG_FILE']:
+    import ConfigSnapshot
+
+    ConfigSnapshot.load_config_file()
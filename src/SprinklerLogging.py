@@ -1,5 +1,15 @@
+import collections
 import logging.config
+import logging.handlers
 import json, os
+import threading
+
+from SprinklerConfig import config
+
+OVERFLOW_POLICIES = ('drop_new', 'drop_old')
+
+# Queue handler installed on the root logger in queued mode
+queue_handler = None
 
 
 # Creates the log directory if it does not exist
@@ -17,6 +27,171 @@ def handle_relative_paths(log_dict):
     file_handler['filename'] = os.path.join(dir_path, file_handler['filename'])
 
 
+# Sets the level of the log file, and lets the root logger drop the records below the level of every handler before
+# they are created
+def apply_log_levels(log_dict):
+    log_dict['handlers']['file_handler']['level'] = config['LOG_FILE_LEVEL']
+    levels = [logging.getLevelName(handler['level']) for handler in log_dict['handlers'].values()]
+    log_dict['root']['level'] = min(levels) if levels else logging.DEBUG
+
+
+# Handler that only appends the records to a bounded in-memory queue
+# A single background writer formats the queued records and passes them in batches to the target handlers, so the
+# threads that log never format messages or touch the disk. The writer is woken up when a batch is full or a
+# warning is logged, otherwise every flush interval.
+# As messages are formatted later by the writer, arguments that are mutated after logging may be logged with the
+# mutated value.
+class QueuedLogHandler(logging.Handler):
+    def __init__(self, handlers, max_size=10000, overflow='drop_new', batch_size=200, flush_interval=0.5):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Invalid log queue overflow policy: %s' % overflow)
+        super(QueuedLogHandler, self).__init__(min(handler.level for handler in handlers) if handlers else 0)
+        self.handlers = handlers
+        self.max_size = max_size
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.records = collections.deque()
+        # Guards the queue and the counters. Not the handler lock, which logging.shutdown holds while closing
+        self.queue_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.enqueued = 0
+        self.dropped = 0
+        self.reported_dropped = 0
+        self.written = 0
+        self.batches = 0
+        self.max_depth = 0
+        self.writer = None
+        self.active = False
+
+    def handle(self, record):
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
+
+    # Called by the logging threads
+    def emit(self, record):
+        with self.queue_lock:
+            depth = len(self.records)
+            if depth >= self.max_size:
+                self.dropped += 1
+                if self.overflow == 'drop_new':
+                    return
+                self.records.popleft()
+            else:
+                depth += 1
+                self.max_depth = max(self.max_depth, depth)
+            self.records.append(record)
+            self.enqueued += 1
+        if depth >= self.batch_size or record.levelno >= logging.WARNING:
+            self.wakeup.set()
+
+    # Returns the number of records enqueued, dropped, written and waiting, the batches written and the max queue depth
+    def stats(self):
+        with self.queue_lock:
+            return {
+                'enqueued': self.enqueued,
+                'dropped': self.dropped,
+                'written': self.written,
+                'pending': len(self.records),
+                'batches': self.batches,
+                'max_depth': self.max_depth
+            }
+
+    # Takes up to batch_size records from the queue, followed by a warning if records have been dropped since the
+    # last batch
+    def take_batch(self):
+        records = []
+        with self.queue_lock:
+            while len(records) < self.batch_size and self.records:
+                records.append(self.records.popleft())
+            dropped = self.dropped - self.reported_dropped
+            self.reported_dropped = self.dropped
+        if dropped:
+            records.append(logging.makeLogRecord({
+                'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING', 'threadName': 'LogWriterThread',
+                'msg': '%d log record(s) dropped as the log queue was full', 'args': (dropped,)}))
+        return records
+
+    # Writes the records to the handler. Stream handlers get the whole batch in one write and one flush
+    @staticmethod
+    def write_batch(handler, records):
+        records = [record for record in records if record.levelno >= handler.level and handler.filter(record)]
+        if not records:
+            return
+        if not isinstance(handler, logging.StreamHandler):
+            for record in records:
+                handler.handle(record)
+            return
+        handler.acquire()
+        try:
+            if isinstance(handler, logging.handlers.BaseRotatingHandler) and handler.shouldRollover(records[0]):
+                handler.doRollover()
+            if handler.stream is None:
+                handler.stream = handler._open()
+            handler.stream.write(''.join(handler.format(record) + handler.terminator for record in records))
+            handler.flush()
+        except Exception:
+            handler.handleError(records[0])
+        finally:
+            handler.release()
+
+    # Writes all queued records
+    def write_pending(self):
+        while True:
+            records = self.take_batch()
+            if not records:
+                return
+            for handler in self.handlers:
+                QueuedLogHandler.write_batch(handler, records)
+            with self.queue_lock:
+                self.written += len(records)
+                self.batches += 1
+
+    def write_loop(self):
+        while self.active:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.write_pending()
+        self.write_pending()
+
+    # Starts the background writer
+    def start(self):
+        self.active = True
+        self.writer = threading.Thread(target=self.write_loop, name='LogWriterThread')
+        self.writer.daemon = True
+        self.writer.start()
+
+    # Writes the remaining records and stops the background writer
+    def stop(self):
+        if not self.active:
+            return
+        self.active = False
+        self.wakeup.set()
+        self.writer.join()
+
+    def close(self):
+        self.stop()
+        for handler in self.handlers:
+            handler.close()
+        super(QueuedLogHandler, self).close()
+
+
+# Moves the handlers of the root logger behind a queued log handler
+def install_queue_handler():
+    global queue_handler
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    queue_handler = QueuedLogHandler(handlers, config['LOG_QUEUE_SIZE'], config['LOG_QUEUE_OVERFLOW'],
+                                     config['LOG_QUEUE_BATCH_SIZE'], config['LOG_QUEUE_FLUSH_INTERVAL'])
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    # The remaining records are written when the handler is closed by logging.shutdown at exit
+    queue_handler.start()
+
+
 # Configures application wide logging from JSON file
 def configure_logging():
     create_log_dir()
@@ -25,6 +200,9 @@ def configure_logging():
     with open(log_config_file, 'r') as log_file:
         log_dict = json.load(log_file)
         handle_relative_paths(log_dict)
+        apply_log_levels(log_dict)
         logging.config.dictConfig(log_dict)
+        if config['LOG_MODE'] == 'queued':
+            install_queue_handler()
         logger = logging.getLogger(__name__)
-        logger.info("Logging has been configured")
+        logger.info("Logging has been configured. Mode: %s", config['LOG_MODE'])
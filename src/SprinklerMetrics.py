@@ -0,0 +1,278 @@
+import bisect
+import logging
+import os
+import threading
+
+import Clock
+import SprinklerUtils
+from SprinklerConfig import config
+
+logger = logging.getLogger(__name__)
+
+# Only imported if the metrics endpoint is enabled, as the HTTP server modules take long to import
+MetricsEndpoint = SprinklerUtils.lazy_import('MetricsEndpoint')
+
+# Upper bounds (seconds) of the latency and loop drift histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+DRIFT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+
+# Monotonically increasing value
+class Counter(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0.0
+        self.function = None
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    # Reads the value from the function when collected instead, for values that are already counted elsewhere
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self, name, labels):
+        return [(name, labels, self.function() if self.function is not None else self.value)]
+
+
+# Value that can go up and down
+class Gauge(Counter):
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+# Counts of observed values in fixed buckets, with their sum
+class Histogram(object):
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            samples.append((name + '_bucket', labels + (('le', format_value(bound)),), cumulative))
+        samples.append((name + '_sum', labels, total))
+        samples.append((name + '_count', labels, cumulative))
+        return samples
+
+
+# A named metric with one child metric per combination of label values
+# Metrics without labels can be used directly, e.g. family.inc()
+class MetricFamily(object):
+    def __init__(self, name, help_text, metric_type, label_names, factory):
+        self.name = name
+        self.help = help_text
+        self.type = metric_type
+        self.label_names = tuple(label_names)
+        self.factory = factory
+        self.lock = threading.Lock()
+        self.children = {}
+        # Children by the label values as passed, so that repeated lookups skip converting them to strings
+        self.lookup = {}
+        if not self.label_names:
+            self.default = self.labels()
+
+    def labels(self, *values):
+        child = self.lookup.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError('Metric %s expects labels %s' % (self.name, self.label_names))
+            with self.lock:
+                child = self.children.setdefault(tuple(str(value) for value in values), self.factory())
+                self.lookup[values] = child
+        return child
+
+    def __getattr__(self, attr):
+        if attr == 'default':
+            raise AttributeError(attr)
+        return getattr(self.default, attr)
+
+    # Lines of the family in the Prometheus text format
+    def expose(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.type)]
+        for values, child in sorted(self.children.items()):
+            for name, labels, value in child.samples(self.name, tuple(zip(self.label_names, values))):
+                if labels:
+                    label_text = ','.join('%s="%s"' % (label, escape(value)) for label, value in labels)
+                    lines.append('%s{%s} %s' % (name, label_text, format_value(value)))
+                else:
+                    lines.append('%s %s' % (name, format_value(value)))
+        return lines
+
+
+# Collection of the client metrics
+class MetricsRegistry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.families = {}
+
+    def register(self, name, help_text, metric_type, label_names, factory):
+        with self.lock:
+            if name not in self.families:
+                self.families[name] = MetricFamily(name, help_text, metric_type, label_names, factory)
+            return self.families[name]
+
+    def counter(self, name, help_text, label_names=()):
+        return self.register(name, help_text, 'counter', label_names, Counter)
+
+    def gauge(self, name, help_text, label_names=()):
+        return self.register(name, help_text, 'gauge', label_names, Gauge)
+
+    def histogram(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        return self.register(name, help_text, 'histogram', label_names, lambda: Histogram(tuple(buckets)))
+
+    # All metrics in the Prometheus text exposition format
+    def expose(self):
+        with self.lock:
+            families = sorted(self.families.items())
+        lines = []
+        for _, family in families:
+            lines.extend(family.expose())
+        return '\n'.join(lines) + '\n'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return '%d' % value
+    return repr(float(value))
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+registry = MetricsRegistry()
+
+# Server communication
+HTTP_REQUESTS = registry.counter('sprinkler_http_requests_total', 'Requests sent to the server by result status',
+                                 ['method', 'route', 'status'])
+HTTP_DURATION = registry.histogram('sprinkler_http_request_duration_seconds', 'Latency of the requests to the server',
+                                   ['method', 'route'])
+
+SERVER_BREAKER_STATE = registry.gauge('sprinkler_server_breaker_state',
+                                      'Circuit breaker state of the server calls: 0 closed, 1 half-open, 2 open')
+SERVER_BREAKER_TRANSITIONS = registry.counter('sprinkler_server_breaker_transitions_total',
+                                              'Circuit breaker state changes by new state', ['state'])
+SERVER_BREAKER_REJECTED = registry.counter('sprinkler_server_breaker_rejected_total',
+                                           'Calls rejected without contacting the server while the breaker was open')
+
+# Valve
+VALVE_UPDATES = registry.counter('sprinkler_valve_updates_total', 'Valve update processes by result', ['result'])
+VALVE_UPDATE_DURATION = registry.histogram('sprinkler_valve_update_duration_seconds',
+                                           'Duration of the valve update processes, including long polls')
+VALVE_STATE = registry.gauge('sprinkler_valve_state', 'Current valve state', ['pin'])
+VALVE_STATE_CHANGES = registry.counter('sprinkler_valve_state_changes_total', 'Valve state changes', ['pin'])
+
+# Flow Sensor
+FLOW_PULSES = registry.counter('sprinkler_flow_pulses_total', 'Pulses counted by the flow sensor', ['pin'])
+FLOW_SAVES = registry.counter('sprinkler_flow_saves_total', 'Save flow processes with data to save by result',
+                              ['result'])
+FLOW_VOLUME = registry.counter('sprinkler_flow_volume_litres_total', 'Volume of the saved flow intervals', ['pin'])
+FLOW_RATE = registry.gauge('sprinkler_flow_rate_litres_per_minute', 'Mean flow rate of the last saved interval',
+                           ['pin'])
+FLOW_RATE_EWMA = registry.gauge('sprinkler_flow_rate_ewma_litres_per_minute',
+                                'Moving average of the sampled non-zero flow rates', ['pin'])
+FLOW_ANOMALIES = registry.counter('sprinkler_flow_anomalies_total', 'Flow anomalies raised on the device by kind',
+                                  ['pin', 'kind'])
+
+# Startup
+STARTUP_SECONDS = registry.gauge('sprinkler_startup_seconds',
+                                 'Duration of the startup phases, and time from the process start to the milestones',
+                                 ['kind', 'name'])
+
+# Gateway
+GATEWAY_REQUESTS = registry.counter('sprinkler_gateway_requests_total',
+                                    'Requests of the LAN devices answered by the gateway by result status',
+                                    ['method', 'route', 'status'])
+GATEWAY_DEVICES = registry.gauge('sprinkler_gateway_devices', 'Devices whose valve state is synced by the gateway')
+
+# Update loops
+LOOP_DRIFT = registry.histogram('sprinkler_loop_drift_seconds',
+                                'Delay of the update loop runs behind their schedule', ['loop'], DRIFT_BUCKETS)
+
+
+# Records the outcome of a request to the server. Status is None if the server could not be reached
+def observe_request(method, path, status, latency):
+    HTTP_REQUESTS.labels(method, path, status if status is not None else 'error').inc()
+    HTTP_DURATION.labels(method, path).observe(latency)
+
+
+# Records how much a loop run is behind its schedule, given that the previous run started at start_time
+def observe_loop_drift(loop, start_time, interval):
+    LOOP_DRIFT.labels(loop).observe(max(Clock.now() - start_time - interval, 0))
+
+
+# Periodically writes the metrics in the Prometheus text format to a file, e.g. for the node exporter textfile
+# collector. The file is replaced atomically so that readers never see a partial snapshot
+class MetricsSnapshotWriter(object):
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def write(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as snapshot_file:
+            snapshot_file.write(registry.expose())
+        os.replace(tmp_path, self.path)
+
+    def keep_writing(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.write()
+            except OSError:
+                logger.exception('Failed to write metrics snapshot to %s', self.path)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.keep_writing, name='MetricsSnapshotThread')
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info('Writing metrics snapshots to %s every %s second(s)', self.path, self.interval)
+        return self
+
+    # Stops writing and writes a final snapshot
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        self.write()
+
+
+exporters = []
+
+
+# Starts the metrics endpoint and the snapshot writer if configured
+def start_exporters():
+    if config['METRICS_PORT'] is not None:
+        exporters.append(MetricsEndpoint.MetricsServer(config['METRICS_HOST'], config['METRICS_PORT']).start())
+    if config['METRICS_SNAPSHOT_FILE']:
+        path = SprinklerUtils.get_abs_path(config['METRICS_SNAPSHOT_FILE'])
+        exporters.append(MetricsSnapshotWriter(path, config['METRICS_SNAPSHOT_INTERVAL']).start())
+
+
+def stop_exporters():
+    while exporters:
+        exporters.pop().stop()
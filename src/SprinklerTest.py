@@ -1,18 +1,60 @@
+import asyncio
+import base64
+import contextlib
+import gzip
+import http.client
+import io
+import itertools
+import json
 import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
 import threading
 import time
 import unittest
+import unittest.mock
+import urllib.request
 
-from SprinklerConfig import config
+import requests
 
-# Common config changes
+from SprinklerConfig import config, defaults
+
+# Common config changes. The pins are set here so that the suite does not depend on a PrivateConfig
 config['FORCE_DUMMY_GPIO'] = True
+config['VALVE_PIN'] = 40
+config['FLOW_SENSOR_PIN'] = 38
 config['PRODUCT_KEY'] = '$(2#2Da$131s&*f4!x'
 
 from GPIOWrapper import pins
 from ValveControl import Valve
+from ZoneControl import ZoneManager
+import CircuitBreaker
+import Clock
+import ConfigSnapshot
+import DummyGPIO
+import Gateway
+import EventJournal
+import FlowAnalytics
+import FlowCalibration
+from AdaptivePolling import AdaptivePollScheduler
+from FlowBatch import FlowBatch
+from FlowOutbox import FlowOutbox
+import FlowRateSeries
 from FlowSensorControl import FlowSensor
+from PulseCounter import PulseAccumulator
+import ScheduleControl
+import Scheduler
+import SprinklerApi
+import SprinklerAsync
 import SprinklerLogging
+import SprinklerMetrics
+import SprinklerUtils
+import StartupProfile
+import StubServer
 
 SprinklerLogging.configure_logging()
 logger = logging.getLogger(__name__)
@@ -24,13 +66,34 @@ class TestUtils(object):
     def configure_server_down():
         config['SERVER_DNS'] = None
         config['SERVER_IP'] = 'localhost'
-        config['SERVER_PORT'] = 9999
+        config['SERVER_PORT'] = StubServer.unused_port()
 
     @staticmethod
     def configure_invalid_product_key():
         invalid_product_key = 'invalid_key'
         config['PRODUCT_KEY'] = invalid_product_key
 
+    @staticmethod
+    def configure_stub_server(stub):
+        config['SERVER_DNS'] = None
+        config['SERVER_PROTOCOL'] = 'http://'
+        config['SERVER_IP'] = 'localhost'
+        config['SERVER_PORT'] = stub.port
+
+
+# Local stand-in for the server, shared by the whole module so that the suite runs without network access
+stub_server = None
+
+
+def setUpModule():
+    global stub_server
+    stub_server = StubServer.StubServer(config['PRODUCT_KEY']).start()
+    TestUtils.configure_stub_server(stub_server)
+
+
+def tearDownModule():
+    stub_server.stop()
+
 
 # Tests config initialization
 class ConfigTest(unittest.TestCase):
@@ -47,6 +110,476 @@ class ConfigTest(unittest.TestCase):
             self.assertIsNotNone(config['SERVER_IP'])
 
 
+# Tests the queued logging mode
+class QueuedLoggingTest(unittest.TestCase):
+    def setUp(self):
+        self.stream = io.StringIO()
+        self.target = logging.StreamHandler(self.stream)
+        self.target.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+        self.threads = []
+        self.target.addFilter(lambda record: self.threads.append(threading.current_thread().name) or True)
+        self.logger = logging.getLogger('QueuedLoggingTest')
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+        self.handler = None
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+
+    def add_handler(self, **kwargs):
+        self.handler = SprinklerLogging.QueuedLogHandler([self.target], **kwargs)
+        self.logger.addHandler(self.handler)
+        return self.handler
+
+    def test_1_written_by_background_writer(self):
+        handler = self.add_handler(batch_size=10, flush_interval=10)
+        for i in range(25):
+            self.logger.debug('Record %d', i)
+        self.assertEqual(self.stream.getvalue(), '')
+        handler.start()
+        handler.stop()
+        self.assertEqual(self.stream.getvalue().splitlines(), ['DEBUG Record %d' % i for i in range(25)])
+        self.assertEqual(set(self.threads), {'LogWriterThread'})
+        stats = handler.stats()
+        self.assertEqual(stats['written'], 25)
+        self.assertEqual(stats['pending'], 0)
+        self.assertEqual(stats['batches'], 3)
+
+    def test_2_warning_wakes_up_writer(self):
+        handler = self.add_handler(flush_interval=10)
+        handler.start()
+        self.logger.debug('Debug')
+        self.logger.warning('Warning')
+        deadline = time.time() + 2
+        while handler.stats()['written'] < 2 and time.time() < deadline:
+            time.sleep(0.001)
+        self.assertEqual(self.stream.getvalue().splitlines(), ['DEBUG Debug', 'WARNING Warning'])
+
+    def test_3_drop_new(self):
+        handler = self.add_handler(max_size=5, overflow='drop_new')
+        for i in range(8):
+            self.logger.info('Record %d', i)
+        handler.start()
+        handler.stop()
+        lines = self.stream.getvalue().splitlines()
+        self.assertEqual(lines[:5], ['INFO Record %d' % i for i in range(5)])
+        self.assertEqual(lines[5], 'WARNING 3 log record(s) dropped as the log queue was full')
+        self.assertEqual(handler.stats()['dropped'], 3)
+        self.assertEqual(handler.stats()['max_depth'], 5)
+
+    def test_4_drop_old(self):
+        handler = self.add_handler(max_size=5, overflow='drop_old')
+        for i in range(8):
+            self.logger.info('Record %d', i)
+        handler.start()
+        handler.stop()
+        lines = self.stream.getvalue().splitlines()
+        self.assertEqual(lines[:5], ['INFO Record %d' % i for i in range(3, 8)])
+        self.assertEqual(handler.stats()['dropped'], 3)
+
+    def test_5_invalid_overflow_policy(self):
+        self.handler = logging.NullHandler()
+        self.assertRaises(ValueError, SprinklerLogging.QueuedLogHandler, [self.target], overflow='block')
+
+
+# Tests the dummy GPIO module used as a hardware simulator
+class DummyGPIOTest(unittest.TestCase):
+    def setUp(self):
+        self.valve = Valve()
+        self.flow = FlowSensor()
+        self.trains = []
+
+    def tearDown(self):
+        for train in self.trains:
+            train.stop()
+
+    def start_train(self, intervals, **kwargs):
+        train = DummyGPIO.start_pulse_train(config['FLOW_SENSOR_PIN'], intervals, **kwargs)
+        self.trains.append(train)
+        return train
+
+    def test_1_pin_state(self):
+        self.assertEqual(DummyGPIO.input(config['VALVE_PIN']), DummyGPIO.LOW)
+        self.valve.update(DummyGPIO.HIGH)
+        self.assertEqual(DummyGPIO.input(config['VALVE_PIN']), DummyGPIO.HIGH)
+        self.valve.update(DummyGPIO.LOW)
+        self.assertEqual(DummyGPIO.input(config['VALVE_PIN']), DummyGPIO.LOW)
+
+    def test_2_fire_edges(self):
+        DummyGPIO.fire_edges(config['FLOW_SENSOR_PIN'], 500)
+        self.assertEqual(self.flow.pulses, 500)
+
+    def test_3_high_rate_pulse_train(self):
+        rate = 20000
+        train = self.start_train(DummyGPIO.constant_rate(rate))
+        time.sleep(0.5)
+        train.stop()
+        self.assertEqual(self.flow.pulses, train.fired)
+        self.assertTrue(train.fired > 0.8 * rate * 0.5)
+        self.assertTrue(train.fired <= rate * 0.5 * 1.2)
+
+    def test_4_max_pulses(self):
+        train = self.start_train(DummyGPIO.constant_rate(10000), max_pulses=1000)
+        train.join(5)
+        self.assertEqual(self.flow.pulses, 1000)
+
+    def test_5_flow_tied_to_valve(self):
+        train = self.start_train(DummyGPIO.constant_rate(1000), gate_pin=config['VALVE_PIN'])
+        time.sleep(0.1)
+        self.assertEqual(train.fired, 0)
+        self.valve.update(DummyGPIO.HIGH)
+        time.sleep(0.1)
+        self.valve.update(DummyGPIO.LOW)
+        time.sleep(0.01)
+        fired = train.fired
+        self.assertTrue(fired > 50)
+        time.sleep(0.1)
+        self.assertEqual(train.fired, fired)
+
+    def test_6_deterministic_generators(self):
+        first = list(itertools.islice(DummyGPIO.jitter(DummyGPIO.constant_rate(100), 0.1, seed=7), 100))
+        second = list(itertools.islice(DummyGPIO.jitter(DummyGPIO.constant_rate(100), 0.1, seed=7), 100))
+        self.assertEqual(first, second)
+        self.assertTrue(all(0.009 <= interval <= 0.011 for interval in first))
+        burst = list(itertools.islice(DummyGPIO.bursts(100, 0.05, 1), 10))
+        self.assertEqual(burst[:4], [0.01] * 4)
+        self.assertAlmostEqual(burst[4], 1.01)
+
+
+# Tests the immutable config snapshots and the hot reload of the config file
+class ConfigSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.config_backup = config.copy()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'config.json')
+        self.watcher = ConfigSnapshot.ConfigFileWatcher(self.path)
+        self.file_time = time.time()
+
+    def tearDown(self):
+        self.watcher.stop()
+        config.update(self.config_backup)
+        shutil.rmtree(self.dir)
+
+    # Writes the config file with a new modification time, so that the change is seen regardless of the resolution of
+    # the file system timestamps
+    def write_config(self, settings):
+        with open(self.path, 'w') as config_file:
+            config_file.write(settings if isinstance(settings, str) else json.dumps(settings))
+        self.file_time += 1
+        os.utime(self.path, (self.file_time, self.file_time))
+
+    def test_1_snapshot(self):
+        snapshot = ConfigSnapshot.current()
+        self.assertIs(ConfigSnapshot.current(), snapshot)
+        self.assertEqual(snapshot['PULSES_PER_LITRE'], config['PULSES_PER_LITRE'])
+        self.assertRaises(AttributeError, setattr, snapshot, 'version', 0)
+        with self.assertRaises(TypeError):
+            snapshot.values['PULSES_PER_LITRE'] = 1
+
+        config['PULSES_PER_LITRE'] = 400
+        changed = ConfigSnapshot.current()
+        self.assertIsNot(changed, snapshot)
+        self.assertEqual((changed['PULSES_PER_LITRE'], snapshot['PULSES_PER_LITRE']),
+                         (400, self.config_backup['PULSES_PER_LITRE']))
+        self.assertIs(ConfigSnapshot.current(), changed)
+
+    def test_2_validate(self):
+        self.assertEqual(ConfigSnapshot.validate({'VALVE_STATE_POLL_INTERVAL': 2.5, 'SERVER_IP': '10.0.0.2',
+                                                  'FLOW_BATCH_COMPRESSION': None, 'ZONES': []}), [])
+        self.assertEqual(ConfigSnapshot.validate({
+            'UNKNOWN': 1,
+            'VALVE_STATE_POLL_INTERVAL': '10',
+            'VALVE_POLL_ADAPTIVE': 1,
+            'FLOW_BATCH_MAX_LATENCY': -1,
+            'RUNTIME_MODE': 'forked',
+            'SERVER_PROTOCOL': None
+        }), [
+            'FLOW_BATCH_MAX_LATENCY must not be negative',
+            'RUNTIME_MODE must be one of threaded, asyncio',
+            'SERVER_PROTOCOL must be a str',
+            'Unknown setting UNKNOWN',
+            'VALVE_POLL_ADAPTIVE must be true or false',
+            'VALVE_STATE_POLL_INTERVAL must be a number'
+        ])
+        self.assertEqual(ConfigSnapshot.validate([]), ['Config file must contain a JSON object'])
+
+    def test_3_reload(self):
+        interval = config['VALVE_STATE_POLL_INTERVAL']
+        self.write_config({'VALVE_STATE_POLL_INTERVAL': 3, 'FLOW_DATA_SAVE_INTERVAL': 20})
+        version = config.version
+        self.assertTrue(self.watcher.check())
+        # All settings of the file are applied in one update
+        self.assertEqual(config.version, version + 1)
+        self.assertEqual((config['VALVE_STATE_POLL_INTERVAL'], config['FLOW_DATA_SAVE_INTERVAL']), (3, 20))
+        self.assertFalse(self.watcher.check())
+
+        # Invalid files are ignored as a whole
+        self.write_config({'VALVE_STATE_POLL_INTERVAL': 4, 'FLOW_DATA_SAVE_INTERVAL': 'often'})
+        self.assertFalse(self.watcher.check())
+        self.write_config('{"VALVE_STATE_POLL_INTERVAL": ')
+        self.assertFalse(self.watcher.check())
+        self.assertEqual(config['VALVE_STATE_POLL_INTERVAL'], 3)
+
+        # Settings removed from the file go back to the values they replaced
+        self.write_config({'FLOW_DATA_SAVE_INTERVAL': 20})
+        self.assertTrue(self.watcher.check())
+        self.assertEqual((config['VALVE_STATE_POLL_INTERVAL'], config['FLOW_DATA_SAVE_INTERVAL']), (interval, 20))
+
+    def test_4_restart_settings(self):
+        self.write_config({'VALVE_COMMAND_MODE': 'long_poll'})
+        self.assertFalse(self.watcher.check())
+        self.assertEqual(config['VALVE_COMMAND_MODE'], self.config_backup['VALVE_COMMAND_MODE'])
+        self.assertTrue(self.watcher.load(restart=True))
+        self.assertEqual(config['VALVE_COMMAND_MODE'], 'long_poll')
+
+    def test_5_live_reload(self):
+        config['CONFIG_RELOAD_INTERVAL'] = 0.01
+        client = SprinklerApi.ApiClient()
+        breaker = client.breaker
+        self.watcher.start()
+        self.write_config({'SERVER_CALL_DEADLINE': 12, 'SERVER_READ_TIMEOUT': 7})
+        deadline = time.time() + 5
+        while config['SERVER_READ_TIMEOUT'] != 7 and time.time() < deadline:
+            time.sleep(0.01)
+        client.bind()
+        self.assertEqual((client.deadline, client.timeout[1]), (12, 7))
+        self.assertIsNot(client.breaker, breaker)
+
+    # Settings with a None default are typed as well, and intervals must be greater than 0
+    def test_6_validate_nullable_and_positive(self):
+        self.assertEqual(sorted(key for key, value in defaults.items() if value is None and
+                                key not in ConfigSnapshot.CHOICES), sorted(ConfigSnapshot.NULLABLE_TYPES))
+        self.assertTrue(ConfigSnapshot.POSITIVE_SETTINGS <= set(defaults))
+        self.assertEqual(ConfigSnapshot.validate({'VALVE_PIN': None, 'FLOW_EXPECTED_RATE': 2.5, 'SERVER_PORT': '8080',
+                                                  'FLOW_BATCH_MAX_LATENCY': 0}), [])
+        self.assertEqual(ConfigSnapshot.validate({
+            'VALVE_PIN': '40',
+            'FLOW_ANALYTICS_INTERVAL': True,
+            'JOURNAL_DIR': 1,
+            'VALVE_STATE_POLL_INTERVAL': 0,
+            'CONFIG_RELOAD_INTERVAL': 0.0,
+            'FLOW_EXPECTED_RATE': -1
+        }), [
+            'CONFIG_RELOAD_INTERVAL must be greater than 0',
+            'FLOW_ANALYTICS_INTERVAL must be a number',
+            'FLOW_EXPECTED_RATE must be greater than 0',
+            'JOURNAL_DIR must be a str',
+            'VALVE_PIN must be a whole number',
+            'VALVE_STATE_POLL_INTERVAL must be greater than 0'
+        ])
+
+    # A component keeps the settings of the cycle in progress, and a changed config applies from its next cycle
+    def test_7_bound_per_cycle(self):
+        flow = FlowSensor()
+        flow.pulses = 730
+        config['PULSES_PER_LITRE'] = 100
+        self.assertEqual(flow.read_flow_data()['volume'], 730.0 / self.config_backup['PULSES_PER_LITRE'])
+        self.assertEqual(flow.bind()['PULSES_PER_LITRE'], 100)
+        self.assertEqual(flow.read_flow_data()['volume'], 7.3)
+
+
+# Tests the client wide API client
+class ApiClientTest(unittest.TestCase):
+    def setUp(self):
+        self.config_backup = config.copy()
+
+    def tearDown(self):
+        config.update(self.config_backup)
+
+    def test_1_shared_client(self):
+        self.assertIs(SprinklerApi.get_api_client(), SprinklerApi.get_api_client())
+
+    def test_2_bound_to_config(self):
+        client = SprinklerApi.ApiClient()
+        self.assertEqual(client.api_base, SprinklerUtils.get_server_api_base())
+        self.assertEqual(client.auth.password, config['PRODUCT_KEY'])
+        self.assertEqual(client.timeout, (config['SERVER_CONNECT_TIMEOUT'], config['SERVER_READ_TIMEOUT']))
+
+    def test_3_rebinds_on_config_change(self):
+        client = SprinklerApi.ApiClient()
+        auth = client.auth
+        client.bind()
+        self.assertIs(client.auth, auth)
+        TestUtils.configure_server_down()
+        TestUtils.configure_invalid_product_key()
+        client.bind()
+        self.assertEqual(client.api_base, 'http://localhost:%d' % config['SERVER_PORT'])
+        self.assertEqual(client.auth.password, 'invalid_key')
+
+
+# Tests the circuit breaker and its backoff with a fake clock
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.breaker = CircuitBreaker.CircuitBreaker(3, 10, 35, clock=lambda: self.now)
+
+    def fail(self, count):
+        for _ in range(count):
+            self.assertEqual(self.breaker.acquire(), CircuitBreaker.ALLOW)
+            self.breaker.record(False)
+
+    def test_1_backoff(self):
+        backoff = CircuitBreaker.ExponentialBackoff(1, 10)
+        self.assertEqual([backoff.next_delay() for _ in range(6)], [1, 2, 4, 8, 10, 10])
+        backoff.reset()
+        self.assertEqual(backoff.next_delay(), 1)
+        backoff = CircuitBreaker.ExponentialBackoff(10, 100, jitter=0.2, seed=1)
+        delays = [backoff.next_delay() for _ in range(20)]
+        self.assertTrue(all(8 <= delay <= 120 for delay in delays))
+        self.assertNotEqual(delays[-1], delays[-2])
+
+    def test_2_opens_after_threshold(self):
+        self.fail(2)
+        self.breaker.record(True)
+        self.fail(2)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.fail(1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(self.breaker.acquire(), CircuitBreaker.REJECT)
+        self.assertEqual(self.breaker.remaining_open_time(), 10)
+
+    def test_3_probe(self):
+        self.fail(3)
+        self.now = 10.0
+        self.assertEqual(self.breaker.acquire(), CircuitBreaker.PROBE)
+        # Only one caller probes
+        self.assertEqual(self.breaker.acquire(), CircuitBreaker.REJECT)
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(self.breaker.remaining_open_time(), 20)
+        self.now = 30.0
+        self.assertEqual(self.breaker.acquire(), CircuitBreaker.PROBE)
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.remaining_open_time(), 35)
+        self.now = 65.0
+        self.assertEqual(self.breaker.acquire(), CircuitBreaker.PROBE)
+        self.breaker.record(True)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(self.breaker.acquire(), CircuitBreaker.ALLOW)
+        # The open time starts over once the server has recovered
+        self.fail(3)
+        self.assertEqual(self.breaker.remaining_open_time(), 10)
+
+    def test_4_disabled(self):
+        breaker = CircuitBreaker.CircuitBreaker(0, 10, 35)
+        for _ in range(10):
+            breaker.record(False)
+        self.assertEqual(breaker.acquire(), CircuitBreaker.ALLOW)
+
+
+# Tests the deadlines and the circuit breaker of the API client against the stub server
+class ApiClientResilienceTest(unittest.TestCase):
+    def setUp(self):
+        self.config_backup = config.copy()
+        config['SERVER_BREAKER_THRESHOLD'] = 3
+        config['SERVER_BREAKER_OPEN_TIME'] = 0.1
+        config['SERVER_BREAKER_JITTER'] = 0
+        self.stub = stub_server
+        self.stub.reset()
+        self.client = SprinklerApi.ApiClient()
+
+    def tearDown(self):
+        self.client.close()
+        config.update(self.config_backup)
+        self.stub.reset()
+
+    def test_1_deadline(self):
+        self.stub.set_latency(0.5)
+        start_time = time.time()
+        with self.assertRaises(SprinklerApi.REQUEST_ERRORS):
+            self.client.get('/valve', deadline=0.1)
+        self.assertTrue(time.time() - start_time < 0.4)
+        # The stub server completes the abandoned request before the next one is answered
+        while not self.stub.requests:
+            time.sleep(0.01)
+        self.stub.set_latency(0)
+        self.assertEqual(self.client.get('/valve', deadline=1).json()['state'], 0)
+
+    def test_2_breaker_opens_and_recovers(self):
+        self.stub.inject_fault('GET', '/valve', 503, count=4)
+        for _ in range(3):
+            self.assertEqual(self.client.get('/valve').status_code, 503)
+        self.assertEqual(self.client.breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(SprinklerMetrics.SERVER_BREAKER_STATE.value, 2)
+        with self.assertRaises(SprinklerApi.CircuitOpenError):
+            self.client.post('/flow', json={'volume': 1, 'duration': 10})
+        self.assertEqual(len(self.stub.requests), 3)
+        time.sleep(0.1)
+        # The probe still fails, so the call is not sent
+        with self.assertRaises(SprinklerApi.CircuitOpenError):
+            self.client.post('/flow', json={'volume': 1, 'duration': 10})
+        self.assertEqual(len(self.stub.requests), 4)
+        time.sleep(0.2)
+        resp = self.client.post('/flow', json={'volume': 1, 'duration': 10})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.stub.requests[4:], [('GET', '/valve'), ('POST', '/flow')])
+        self.assertEqual(self.client.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(SprinklerMetrics.SERVER_BREAKER_STATE.value, 0)
+
+    def test_3_client_errors_do_not_open(self):
+        self.stub.inject_fault('POST', '/valve', 400, count=5)
+        for _ in range(5):
+            self.assertEqual(self.client.post('/valve', json={}).status_code, 400)
+        self.assertEqual(self.client.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_4_components_fail_fast(self):
+        TestUtils.configure_server_down()
+        for _ in range(3):
+            self.assertIsNone(Valve.get_valve_info())
+        start_time = time.time()
+        self.assertIsNone(Valve.get_valve_info())
+        self.assertIsNone(FlowSensor.send_flow_data(10, 20))
+        self.assertTrue(time.time() - start_time < 0.05)
+        TestUtils.configure_stub_server(self.stub)
+        self.assertIsNotNone(Valve.get_valve_info())
+
+    # Scalar and None timeouts, as accepted by requests, are normalised and capped at the deadline
+    def test_5_timeout_forms(self):
+        self.assertEqual(SprinklerApi.normalize_timeout(None, (3, 5), 4), (3, 4))
+        self.assertEqual(SprinklerApi.normalize_timeout(2, (3, 5), 4), (2, 2))
+        self.assertEqual(SprinklerApi.normalize_timeout((None, 10), (3, 5), 4), (4, 4))
+        for timeout in (2, (1, None), None):
+            self.assertEqual(self.client.get('/valve', timeout=timeout).status_code, 200)
+
+
+# Tests the latency, fault injection and request recording of the stub server
+class StubServerTest(unittest.TestCase):
+    def setUp(self):
+        stub_server.reset()
+
+    def tearDown(self):
+        stub_server.reset()
+
+    def test_1_request_log(self):
+        Valve.get_valve_info()
+        FlowSensor.send_flow_data(10, 20)
+        self.assertEqual(stub_server.requests, [('GET', '/valve'), ('POST', '/flow')])
+        request = stub_server.request_log[1]
+        self.assertEqual(request.status, 200)
+        self.assertEqual(request.data['volume'], 10)
+        self.assertEqual(request.data['duration'], 20)
+
+    def test_2_latency(self):
+        stub_server.set_latency(0.2)
+        start_time = time.time()
+        self.assertIsNotNone(Valve.get_valve_info())
+        self.assertTrue(time.time() - start_time >= 0.2)
+
+    def test_3_error_status(self):
+        stub_server.inject_fault('GET', '/valve', 503, count=2)
+        self.assertIsNone(Valve.get_valve_info())
+        self.assertIsNone(Valve.get_valve_info())
+        self.assertIsNotNone(Valve.get_valve_info())
+        self.assertEqual([request.status for request in stub_server.request_log], [503, 503, 200])
+
+    def test_4_dropped_connection(self):
+        stub_server.inject_fault('POST', '/flow', None)
+        self.assertFalse(FlowSensor.send_flow_data(10, 20))
+        self.assertIsNone(stub_server.request_log[0].status)
+        self.assertTrue(FlowSensor.send_flow_data(10, 20))
+
+
 # Tests valve state after initialization
 class ValveInitTest(unittest.TestCase):
     def setUp(self):
@@ -166,6 +699,412 @@ class ValveUpdateProcessTest(unittest.TestCase):
         self.assertFalse(success)
         self.assertEqual(self.valve.state, pins.LOW)
 
+    def test_4_process_reverted_when_success_not_sent(self):
+        stub_server.reset()
+        stub_server.set_valve_state(pins.HIGH)
+        stub_server.inject_fault('POST', '/valve', 500)
+        success = self.valve.valve_update_process()
+        stub_server.reset()
+        self.assertFalse(success)
+        self.assertEqual(self.valve.state, pins.LOW)
+
+
+# Tests the long poll valve command mode against the stub server
+class ValveLongPollTest(unittest.TestCase):
+    def setUp(self):
+        self.config_backup = config.copy()
+        config['VALVE_COMMAND_MODE'] = 'long_poll'
+        config['VALVE_LONG_POLL_TIMEOUT'] = 5
+        config['VALVE_STATE_POLL_INTERVAL'] = 1
+        self.stub = stub_server
+        self.stub.reset()
+        self.valve = Valve()
+
+    def tearDown(self):
+        if self.valve.active:
+            self.valve.stop()
+        config.update(self.config_backup)
+
+    def wait_for_state(self, state, timeout=2):
+        deadline = time.time() + timeout
+        while self.valve.state != state and time.time() < deadline:
+            time.sleep(0.001)
+        return time.time()
+
+    def test_1_long_poll_held_until_timeout(self):
+        start_time = time.time()
+        valve_info = Valve.get_valve_info(wait=1, known_state=pins.LOW)
+        self.assertEqual(valve_info['state'], pins.LOW)
+        self.assertTrue(time.time() - start_time >= 0.9)
+
+    def test_2_command_latency(self):
+        self.valve.start()
+        for state in [pins.HIGH, pins.LOW, pins.HIGH]:
+            time.sleep(0.1)
+            self.stub.set_valve_state(state)
+            applied_time = self.wait_for_state(state)
+            self.assertEqual(self.valve.state, state)
+            latency = applied_time - self.stub.valve_state_time
+            logger.info('Command to GPIO latency: %.2f ms', latency * 1000)
+            self.assertTrue(latency < 0.5)
+
+    def test_3_fallback_to_polling_when_server_down(self):
+        TestUtils.configure_server_down()
+        self.valve.active = True
+        interval = self.valve.long_poll_cycle()
+        self.valve.active = False
+        self.assertEqual(interval, config['VALVE_STATE_POLL_INTERVAL'])
+
+    def test_4_next_long_poll_immediately_after_change(self):
+        self.valve.active = True
+        self.stub.set_valve_state(pins.HIGH)
+        interval = self.valve.long_poll_cycle()
+        self.valve.active = False
+        self.assertEqual(interval, 0)
+        self.assertEqual(self.valve.state, pins.HIGH)
+        self.valve.update(pins.LOW)
+
+    def test_5_stop_during_long_poll(self):
+        self.valve.start()
+        time.sleep(0.2)
+        self.assertIn(self.valve.process_loop.thread.ident, SprinklerApi.waiting_sockets)
+        start_time = time.time()
+        self.valve.stop()
+        self.assertTrue(time.time() - start_time < 0.1)
+        self.assertFalse(self.valve.process_loop.thread.is_alive())
+        self.assertEqual(self.valve.state, pins.LOW)
+        # The stub server answers the abandoned long poll, so that it does not show up in the next test
+        self.stub.set_valve_state(pins.HIGH)
+        while not self.stub.requests:
+            time.sleep(0.01)
+
+
+# Tests the conditional valve fetches and the acknowledgements of the versioned valve state
+class ValveVersionTest(unittest.TestCase):
+    def setUp(self):
+        self.config_backup = config.copy()
+        self.stub = stub_server
+        self.stub.reset()
+        self.valve = Valve()
+
+    def tearDown(self):
+        self.valve.update(pins.LOW)
+        config.update(self.config_backup)
+        self.stub.reset()
+
+    def statuses(self):
+        return [(request.method, request.status) for request in self.stub.request_log]
+
+    def test_1_unchanged_state_not_acknowledged(self):
+        self.assertTrue(self.valve.valve_update_process())
+        self.assertTrue(self.valve.valve_update_process())
+        self.assertEqual(self.statuses(), [('GET', 200), ('GET', 304)])
+        self.assertEqual(self.stub.request_log[1].query, {'version': '0'})
+
+    def test_2_changed_state_acknowledged(self):
+        self.stub.set_valve_state(pins.HIGH)
+        self.assertTrue(self.valve.valve_update_process())
+        self.assertTrue(self.valve.valve_update_process())
+        self.assertEqual(self.valve.state, pins.HIGH)
+        self.assertEqual(self.statuses(), [('GET', 200), ('POST', 200), ('GET', 304)])
+        self.assertEqual(self.stub.valve_acks, [1])
+
+    def test_3_reverted_update_fetched_again(self):
+        self.stub.set_valve_state(pins.HIGH)
+        self.stub.inject_fault('POST', '/valve', 500)
+        self.assertFalse(self.valve.valve_update_process())
+        self.assertEqual(self.valve.state, pins.LOW)
+        self.assertTrue(self.valve.valve_update_process())
+        self.assertEqual(self.valve.state, pins.HIGH)
+        self.assertEqual(self.statuses(), [('GET', 200), ('POST', 500), ('GET', 200), ('POST', 200)])
+        self.assertEqual(self.stub.valve_acks, [1])
+
+    def test_4_piggybacked_ack(self):
+        config['VALVE_ACK_MODE'] = 'piggyback'
+        self.stub.set_valve_state(pins.HIGH)
+        self.assertTrue(self.valve.valve_update_process())
+        self.assertEqual(self.valve.state, pins.HIGH)
+        self.assertEqual(self.stub.valve_acks, [])
+        self.assertTrue(self.valve.valve_update_process())
+        self.assertTrue(self.valve.valve_update_process())
+        self.assertEqual(self.statuses(), [('GET', 200), ('GET', 304), ('GET', 304)])
+        self.assertEqual(self.stub.request_log[1].query, {'version': '1', 'ack': '1'})
+        self.assertEqual(self.stub.valve_acks, [1])
+
+    def test_5_piggybacked_ack_failure_reverts(self):
+        config['VALVE_ACK_MODE'] = 'piggyback'
+        self.stub.set_valve_state(pins.HIGH)
+        self.assertTrue(self.valve.valve_update_process())
+        self.stub.inject_fault('GET', '/valve', 500)
+        self.assertFalse(self.valve.valve_update_process())
+        self.assertEqual(self.valve.state, pins.LOW)
+        self.assertTrue(self.valve.valve_update_process())
+        self.assertEqual(self.valve.state, pins.HIGH)
+        self.assertEqual(self.stub.request_log[2].query, {})
+        self.assertEqual(self.stub.request_log[2].status, 200)
+
+
+# Tests the fixed rate scheduler of the component loops
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.config_backup = config.copy()
+        self.clock = Clock.VirtualClock(0.0)
+        self.tasks = []
+
+    def tearDown(self):
+        for task in self.tasks:
+            task.cancel()
+            task.join()
+        config.update(self.config_backup)
+
+    def schedule(self, work, interval, **kwargs):
+        task = Scheduler.get_scheduler().schedule('TestTask', work, interval, **kwargs)
+        self.tasks.append(task)
+        return task
+
+    def fake_task(self, policy):
+        task = Scheduler.ScheduledTask('TestTask', None, 1, policy, clock=self.clock)
+        task.next_tick = 0.0
+        return task
+
+    def test_1_fixed_rate(self):
+        runs = []
+
+        def work():
+            runs.append(time.monotonic())
+            time.sleep(0.03)
+
+        self.schedule(work, 0.05)
+        time.sleep(0.52)
+        intervals = [end - start for start, end in zip(runs, runs[1:])]
+        self.assertTrue(len(runs) >= 10)
+        self.assertAlmostEqual(sum(intervals) / len(intervals), 0.05, delta=0.005)
+
+    def test_2_skip_missed_ticks(self):
+        task = self.fake_task('skip')
+        self.clock.now = 2.5
+        task.advance(1)
+        self.assertEqual(task.next_tick, 3.0)
+        self.assertEqual(task.skipped, 2)
+
+    def test_3_catch_up_missed_ticks(self):
+        task = self.fake_task('catch_up')
+        self.clock.now = 2.5
+        task.advance(1)
+        self.assertEqual(task.next_tick, 1.0)
+        task.advance(1)
+        self.assertEqual(task.next_tick, 2.0)
+        self.clock.now = 100
+        task.advance(1)
+        self.assertEqual(task.next_tick, 100)
+        self.assertRaises(ValueError, Scheduler.ScheduledTask, 'TestTask', None, 1, 'block')
+
+    def test_4_interval_from_work(self):
+        task = self.fake_task('skip')
+        self.clock.now = 0.2
+        task.advance(0)
+        self.assertEqual(task.next_tick, 0.2)
+        task.advance(5)
+        self.assertEqual(task.next_tick, 5.2)
+
+    def test_5_jitter(self):
+        task = Scheduler.ScheduledTask('TestTask', None, 1, jitter=0.5, seed=1)
+        offsets = [task.random.uniform(0, task.jitter) for _ in range(100)]
+        self.assertTrue(all(0 <= offset <= 0.5 for offset in offsets))
+        self.assertNotEqual(len(set(offsets)), 1)
+
+    def test_6_cancel_immediately(self):
+        task = self.schedule(lambda: None, 60)
+        time.sleep(0.05)
+        start_time = time.time()
+        task.cancel()
+        self.assertTrue(task.join(1))
+        self.assertEqual(task.runs, 1)
+        self.assertTrue(time.time() - start_time < 0.1)
+
+    def test_7_components_stop_quickly(self):
+        config['VALVE_STATE_POLL_INTERVAL'] = 60
+        config['FLOW_DATA_SAVE_INTERVAL'] = 60
+        flow = FlowSensor()
+        valve = Valve(flow_sensor=flow)
+        valve.start()
+        flow.start()
+        time.sleep(0.1)
+        start_time = time.time()
+        valve.stop()
+        flow.stop()
+        self.assertTrue(time.time() - start_time < 0.5)
+        self.assertEqual(valve.process_loop.runs, 1)
+        self.assertEqual(flow.process_loop.runs, 1)
+
+
+# Tests long running scenarios on the virtual clock, which run much faster than real time
+class VirtualClockTest(unittest.TestCase):
+    def setUp(self):
+        self.config_backup = config.copy()
+        self.dir = tempfile.mkdtemp()
+        self.stub = stub_server
+        self.stub.reset()
+        self.clock = Clock.VirtualClock(0.0)
+        self.system_clock = Clock.set_clock(self.clock)
+        self.components = []
+        self.start_time = time.time()
+
+    def tearDown(self):
+        for component in self.components:
+            component.stop()
+        Clock.set_clock(self.system_clock)
+        config.update(self.config_backup)
+        shutil.rmtree(self.dir)
+        self.stub.reset()
+
+    def start(self, component):
+        component.start()
+        self.components.append(component)
+        return component
+
+    def assert_faster_than_real_time(self, simulated):
+        elapsed = time.time() - self.start_time
+        logger.info('Simulated %d second(s) in %.2f second(s)', simulated, elapsed)
+        self.assertTrue(elapsed < simulated / 100.0)
+
+    def test_1_sleeps_in_order(self):
+        times = []
+
+        def sleeper(name, interval):
+            for _ in range(3):
+                self.clock.sleep(interval)
+                times.append((self.clock.monotonic(), name))
+
+        threads = [threading.Thread(target=sleeper, args=(name, interval)) for name, interval in [('a', 10), ('b', 25)]]
+        for thread in threads:
+            self.clock.add_thread(thread)
+            thread.start()
+        self.clock.advance(60)
+        self.assertEqual(times, [(10, 'a'), (20, 'a'), (25, 'b'), (30, 'a'), (50, 'b')])
+        self.assertEqual(self.clock.time(), 60)
+        self.clock.advance(15)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(times[-1], (75, 'b'))
+
+    def test_2_flow_duration_threshold(self):
+        config['FLOW_ANALYTICS_INTERVAL'] = 1
+        flow = self.start(FlowSensor())
+        self.clock.advance(config['MAX_FLOW_DURATION_FOR_SAVE'] - 1)
+        self.assertEqual(self.stub.flow_records, [])
+        self.clock.advance(1)
+        self.assertEqual(len(self.stub.flow_records), 1)
+        self.assertAlmostEqual(self.stub.flow_records[0]['duration'], config['MAX_FLOW_DURATION_FOR_SAVE'], places=3)
+        self.assertEqual(flow.process_loop.runs, config['MAX_FLOW_DURATION_FOR_SAVE'] / 10 + 1)
+        self.assert_faster_than_real_time(3600)
+
+    def test_3_valve_polls_through_outage(self):
+        config['VALVE_STATE_POLL_INTERVAL'] = 60
+        config['SERVER_BREAKER_JITTER'] = 0
+        valve = self.start(Valve())
+        self.clock.advance(3600)
+        self.assertEqual(valve.process_loop.runs, 61)
+        TestUtils.configure_server_down()
+        self.stub.set_valve_state(pins.HIGH)
+        self.clock.advance(3600)
+        self.assertEqual(valve.state, pins.LOW)
+        self.assertEqual(len(self.stub.requests), 61)
+        TestUtils.configure_stub_server(self.stub)
+        self.clock.advance(60)
+        self.assertEqual(valve.state, pins.HIGH)
+        self.assertEqual(valve.process_loop.runs, 122)
+        self.assert_faster_than_real_time(7260)
+
+    def test_4_schedule_runs_for_days(self):
+        config['SCHEDULE_CACHE_FILE'] = os.path.join(self.dir, 'schedule.json')
+        config['SCHEDULE_SYNC_INTERVAL'] = 3600
+        self.stub.set_schedule([{'id': 1, 'start': 1000, 'duration': 600, 'recurrence': 'daily'}])
+        valve = Valve()
+        executor = self.start(ScheduleControl.ScheduleExecutor({None: valve}))
+        self.clock.advance(3 * 86400)
+        self.assertEqual([(run['planned_start'], run['started'], run['ended']) for run in self.stub.schedule_runs],
+                         [(start, start, start + 600) for start in [1000, 87400, 173800]])
+        self.assertEqual(valve.state, pins.LOW)
+        self.assertEqual(executor.reports, [])
+        self.assert_faster_than_real_time(3 * 86400)
+
+    # Pulse trains fire on the virtual clock, and only while the valve is open
+    def test_5_pulse_train(self):
+        flow = FlowSensor()
+        valve = Valve(flow_sensor=flow)
+        train = DummyGPIO.start_pulse_train(config['FLOW_SENSOR_PIN'], DummyGPIO.constant_rate(10),
+                                            gate_pin=config['VALVE_PIN'])
+        try:
+            self.clock.advance(60)
+            self.assertEqual(train.fired, 0)
+            valve.update(pins.HIGH)
+            self.clock.advance(60)
+            valve.update(pins.LOW)
+            self.clock.advance(60)
+        finally:
+            train.stop()
+        self.assertIn(train.fired, (600, 601))
+        self.assertEqual(flow.pulses, train.fired)
+        self.assert_faster_than_real_time(180)
+
+
+# Tests the adaptive valve poll scheduling
+class AdaptivePollSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.config_backup = config.copy()
+        config['VALVE_POLL_MIN_INTERVAL'] = 2
+        config['VALVE_POLL_MAX_INTERVAL'] = 120
+        config['VALVE_POLL_ACTIVE_PERIOD'] = 300
+        config['VALVE_POLL_BACKOFF_FACTOR'] = 2
+        self.now = 0
+        self.flow = FlowSensor()
+        self.scheduler = AdaptivePollScheduler(self.flow, clock=lambda: self.now)
+
+    def tearDown(self):
+        config.update(self.config_backup)
+
+    def poll(self, valve_info=None, state=pins.LOW, state_changed=False):
+        interval = self.scheduler.next_interval(valve_info or {'state': state}, state, state_changed)
+        self.now += interval
+        return interval
+
+    def test_1_backoff_when_idle(self):
+        intervals = [self.poll() for _ in range(200)]
+        self.assertEqual(intervals[0], 2)
+        self.assertTrue(self.now > config['VALVE_POLL_ACTIVE_PERIOD'])
+        self.assertEqual(intervals[-1], 120)
+        self.assertEqual(sorted(intervals), intervals)
+
+    def test_2_fast_after_state_change_and_while_open(self):
+        while self.poll() < 120:
+            pass
+        self.assertEqual(self.poll(state=pins.HIGH, state_changed=True), 2)
+        for _ in range(500):
+            self.assertEqual(self.poll(state=pins.HIGH), 2)
+        self.assertEqual(self.poll(state=pins.LOW, state_changed=True), 2)
+
+    def test_3_fast_while_flowing(self):
+        while self.poll() < 120:
+            pass
+        self.poll()
+        self.flow.record_pulse()
+        self.assertEqual(self.poll(), 2)
+
+    def test_4_server_hint(self):
+        self.assertEqual(self.poll(valve_info={'state': 0, 'next_poll': 30}), 30)
+        self.assertEqual(self.poll(valve_info={'state': 0, 'next_poll': 0}), 2)
+        self.assertEqual(self.poll(valve_info={'state': 0, 'next_poll': 100000}), 120)
+
+    def test_5_request_volume_idle_day(self):
+        self.scheduler.last_activity_time = -config['VALVE_POLL_ACTIVE_PERIOD']
+        num_polls = 0
+        while self.now < 24 * 3600:
+            self.poll()
+            num_polls += 1
+        fixed_num_polls = 24 * 3600 / self.config_backup['VALVE_STATE_POLL_INTERVAL']
+        self.assertTrue(num_polls * 10 <= fixed_num_polls)
+
 
 # Tests flow sensor state after initialization
 class FlowSensorInitTest(unittest.TestCase):
@@ -207,6 +1146,118 @@ class FlowSensorRecordPulseTest(unittest.TestCase):
         self.assertEqual(self.flow.pulses, num_records)
 
 
+# Tests the pulse accumulator backing the flow sensor pulse count
+class PulseAccumulatorTest(unittest.TestCase):
+    def setUp(self):
+        self.accumulator = PulseAccumulator()
+
+    def test_1_edge_callback(self):
+        for _ in range(10):
+            self.accumulator.edge_callback(config['FLOW_SENSOR_PIN'])
+        self.assertEqual(self.accumulator.snapshot(), (10, 10))
+        self.assertEqual(self.accumulator.snapshot(), (10, 10))
+
+    def test_2_acknowledge_keeps_later_pulses(self):
+        for _ in range(10):
+            self.accumulator.record_pulse()
+        total, pending = self.accumulator.snapshot()
+        for _ in range(5):
+            self.accumulator.record_pulse()
+        self.accumulator.acknowledge(pending)
+        self.assertEqual(self.accumulator.snapshot(), (15, 5))
+
+    def test_3_parallel_edges_and_reads(self):
+        num_threads = 4
+        num_records = 10000
+        acknowledged = []
+
+        def record():
+            for _ in range(num_records):
+                self.accumulator.edge_callback(config['FLOW_SENSOR_PIN'])
+
+        def read():
+            for _ in range(100):
+                _, pending = self.accumulator.snapshot()
+                self.accumulator.acknowledge(pending)
+                acknowledged.append(pending)
+
+        threads = [threading.Thread(target=record) for _ in range(num_threads)]
+        threads.append(threading.Thread(target=read))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        total, pending = self.accumulator.snapshot()
+        self.assertEqual(total, num_threads * num_records)
+        self.assertEqual(sum(acknowledged) + pending, total)
+
+    def test_4_set_pending(self):
+        self.accumulator.record_pulse()
+        self.accumulator.set_pending(100)
+        self.assertEqual(self.accumulator.pending, 100)
+
+
+# Tests the pulse timestamp ring buffer and the flow rate summaries
+class FlowRateSeriesTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.ring = FlowRateSeries.PulseTimestampRing(100, clock=lambda: self.now)
+        self.accumulator = PulseAccumulator()
+        self.edge_callback = self.ring.make_edge_callback(self.accumulator.edge_callback)
+        self.numpy = FlowRateSeries.numpy
+
+    def tearDown(self):
+        FlowRateSeries.numpy = self.numpy
+
+    def record(self, num_pulses, interval):
+        for _ in range(num_pulses):
+            self.now += interval
+            self.edge_callback(config['FLOW_SENSOR_PIN'])
+
+    def test_1_bounded_ring(self):
+        self.record(1000, 0.01)
+        self.assertEqual(self.ring.size, 128)
+        self.assertEqual(len(self.ring.timestamps), 128)
+        self.assertEqual(self.accumulator.pending, 1000)
+        self.assertEqual(len(self.ring.window(0, self.now + 1)), 128)
+
+    def test_2_window(self):
+        self.record(10, 1)
+        self.assertEqual(list(self.ring.window(1003, 1006)), [1003, 1004, 1005])
+
+    def test_3_summarize_rates(self):
+        self.record(50, 0.01)
+        self.record(50, 0.02)
+        for numpy in [self.numpy, None]:
+            FlowRateSeries.numpy = numpy
+            summary = FlowRateSeries.summarize_rates(self.ring.window(0, self.now + 1), 365)
+            self.assertAlmostEqual(summary['max'], 60 / (0.01 * 365), places=3)
+            self.assertAlmostEqual(summary['min'], 60 / (0.02 * 365), places=3)
+            self.assertAlmostEqual(summary['p50'], 60 / (0.02 * 365), places=3)
+            self.assertEqual(summary['samples'], 99)
+
+    def test_4_summarize_too_few_pulses(self):
+        self.record(1, 0.01)
+        self.assertIsNone(FlowRateSeries.summarize_rates(self.ring.window(0, self.now + 1), 365))
+
+    def test_5_flow_data_includes_rate(self):
+        config_backup = config.copy()
+        config['FLOW_RATE_SERIES_SIZE'] = 1024
+        try:
+            flow = FlowSensor()
+        finally:
+            config.update(config_backup)
+        for _ in range(100):
+            flow.record_pulse()
+            # Pulses with the same timestamp have no rate
+            time.sleep(0.0001)
+        recorded_data = flow.read_flow_data()
+        self.assertEqual(recorded_data['recorded_pulses'], 100)
+        self.assertEqual(recorded_data['rate']['samples'], 99)
+        flow_info = FlowSensor.flow_info(recorded_data['volume'], recorded_data['duration'], recorded_data['rate'])
+        self.assertEqual(flow_info['rate'], recorded_data['rate'])
+
+
 # Tests the reset data method that resets the flow data after successful save
 class FlowSensorResetDataTest(unittest.TestCase):
     def setUp(self):
@@ -253,6 +1304,115 @@ class FlowSensorReadFlowDataTest(unittest.TestCase):
         })
 
 
+# Tests the flow sensor calibration and the K-factor table applied to the readings
+class FlowCalibrationTest(unittest.TestCase):
+    def setUp(self):
+        self.config_backup = config.copy()
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        config.update(self.config_backup)
+        shutil.rmtree(self.dir)
+
+    # K-factor of the simulated sensor at a pulse rate
+    @staticmethod
+    def true_k_factor(rate):
+        return 300 + 0.8 * rate
+
+    # Captures runs of a simulated sensor at several pulse rates with jittered pulse intervals
+    def capture_runs(self):
+        generator = random.Random(1)
+        runs = []
+        for rate in [15, 30, 50, 80, 110, 140, 170] * 2:
+            volume = generator.choice([1, 2, 5])
+            clock_times = itertools.accumulate(generator.uniform(0.8, 1.2) / rate
+                                               for _ in range(int(volume * self.true_k_factor(rate))))
+            recorder = FlowCalibration.PulseRecorder(clock=clock_times.__next__)
+            recorder.start()
+            for _ in range(int(volume * self.true_k_factor(rate))):
+                recorder.edge_callback(38)
+            runs.append(recorder.stop(volume))
+        return runs
+
+    def test_1_lookup(self):
+        table = FlowCalibration.KFactorTable(50, [300, 350, 400])
+        self.assertEqual([table.k_factor(rate) for rate in [0, 49.9, 50, 149, 1000]], [300, 300, 350, 400, 400])
+        self.assertEqual(table.pulses_per_litre(1000, 10), 400)
+        self.assertEqual(table.pulses_per_litre(10, 0), 300)
+        self.assertEqual(FlowCalibration.KFactorTable.from_dict(table.to_dict()).k_factors, table.k_factors)
+        self.assertRaises(ValueError, FlowCalibration.KFactorTable, 50, [300, 0])
+        self.assertRaises(ValueError, FlowCalibration.KFactorTable.from_dict, {'k_factors': [300]})
+
+    @unittest.skipIf(FlowCalibration.numpy is None, 'numpy is required to fit a flow calibration')
+    def test_2_fit(self):
+        runs = self.capture_runs()
+        self.assertEqual(runs[0]['timestamps'][0], 0)
+        runs_path = os.path.join(self.dir, 'runs.jsonl')
+        for run in runs:
+            FlowCalibration.append_run(runs_path, run)
+        table_path = os.path.join(self.dir, 'flow-calibration.json')
+        with contextlib.redirect_stdout(io.StringIO()):
+            FlowCalibration.main(['fit', runs_path, '--output', table_path])
+        table = FlowCalibration.load_k_table(table_path)
+        self.assertEqual(len(table.k_factors), FlowCalibration.DEFAULT_BUCKETS)
+        # Buckets with calibration data follow the K-factor curve of the sensor
+        for bucket in range(1, 17):
+            k_factor = self.true_k_factor((bucket + 0.5) * table.bucket_width)
+            self.assertAlmostEqual(table.k_factors[bucket], k_factor, delta=k_factor * 0.02)
+        validation = table.validation
+        self.assertEqual((validation['runs'], validation['folds']), (len(runs), FlowCalibration.DEFAULT_FOLDS))
+        self.assertLess(validation['mean_abs_error_pct'], 2)
+        self.assertGreater(validation['constant_mean_abs_error_pct'], 5)
+
+    def test_3_read_flow_data(self):
+        table_path = os.path.join(self.dir, 'flow-calibration.json')
+        FlowCalibration.save_k_table(table_path, FlowCalibration.KFactorTable(50, [300, 350, 400]))
+        config['FLOW_CALIBRATION_FILE'] = table_path
+        flow = FlowSensor()
+        flow.last_read_time = time.time() - 10
+        flow.pulses = 1200
+        self.assertEqual(flow.read_flow_data()['volume'], 3)
+        flow.pulses = 10
+        self.assertEqual(flow.read_flow_data()['volume'], 10 / 300)
+
+    def test_4_missing_table(self):
+        config['FLOW_CALIBRATION_FILE'] = os.path.join(self.dir, 'missing.json')
+        flow = FlowSensor()
+        self.assertIsNone(flow.k_table)
+        flow.pulses = 100
+        self.assertEqual(flow.read_flow_data()['volume'], 100 / config['PULSES_PER_LITRE'])
+
+    # A reading with a slow and a fast part gets the K-factor of each part instead of the one of its mean rate
+    def test_5_mixed_rate_reading(self):
+        table_path = os.path.join(self.dir, 'flow-calibration.json')
+        FlowCalibration.save_k_table(table_path, FlowCalibration.KFactorTable(50, [300, 350, 400]))
+        config['FLOW_CALIBRATION_FILE'] = table_path
+        start_time = time.time() - 30
+        timestamps = [start_time + i / 20.0 for i in range(300)] + [start_time + 15 + i / 200.0 for i in range(800)]
+        self.assertAlmostEqual(FlowCalibration.KFactorTable(50, [300, 350, 400]).volume(timestamps), 3, delta=0.01)
+        errors = FlowCalibration.volume_errors(FlowCalibration.KFactorTable(50, [300, 350, 400]),
+                                               [{'volume': 3, 'timestamps': timestamps}])
+        self.assertLess(abs(errors[0]), 0.5)
+        flow = FlowSensor()
+        flow.rate_histogram.clock = iter(timestamps).__next__
+        record_pulse = flow.rate_histogram.make_edge_callback(flow.accumulator.edge_callback)
+        flow.last_read_time = start_time
+        for _ in timestamps:
+            record_pulse(flow.pin)
+        recorded_data = flow.read_flow_data()
+        self.assertEqual(recorded_data['recorded_pulses'], 1100)
+        self.assertAlmostEqual(recorded_data['volume'], 3, delta=0.01)
+        # At the mean rate of the reading, the K-factor of the middle bucket would be used for all pulses
+        self.assertAlmostEqual(1100 / flow.k_table.pulses_per_litre(1100, 19), 1100 / 350.0)
+        # The next reading only counts the pulses since the reset
+        flow.reset_flow_data(recorded_data)
+        flow.rate_histogram.clock = iter([start_time + 20 + i / 200.0 for i in range(400)]).__next__
+        record_pulse = flow.rate_histogram.make_edge_callback(flow.accumulator.edge_callback)
+        for _ in range(400):
+            record_pulse(flow.pin)
+        self.assertAlmostEqual(flow.read_flow_data()['volume'], 1, delta=0.01)
+
+
 # Tests the method that checks thresholds for saving recorded flow data
 class FlowSensorSaveThresholdsTest(unittest.TestCase):
     def setUp(self):
@@ -376,5 +1536,1114 @@ class FlowSensorSaveFlowProcessTest(unittest.TestCase):
         self.assertIs(self.flow.last_read_time, last_read_time)
 
 
+# Tests the on-disk flow outbox
+class FlowOutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'flow.outbox')
+        self.outbox = FlowOutbox(self.path, 10)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_1_append_peek_commit(self):
+        for i in range(5):
+            self.outbox.append(1000.0 + i, 10.0, 0.5, i)
+        seq, records = self.outbox.peek(3)
+        self.assertEqual([record['pulses'] for record in records], [0, 1, 2])
+        self.assertEqual(records[0], {'time': 1000.0, 'duration': 10.0, 'volume': 0.5, 'pulses': 0})
+        self.outbox.commit(seq, len(records))
+        self.assertEqual(len(self.outbox), 2)
+        seq, records = self.outbox.peek(3)
+        self.assertEqual([record['pulses'] for record in records], [3, 4])
+        self.outbox.commit(seq, len(records))
+        self.assertEqual(len(self.outbox), 0)
+        self.assertEqual(os.path.getsize(self.path), 0)
+
+    def test_2_durable_across_reopen(self):
+        for i in range(5):
+            self.outbox.append(1000.0 + i, 10.0, 0.5, i)
+        seq, records = self.outbox.peek(2)
+        self.outbox.commit(seq, len(records))
+        reopened = FlowOutbox(self.path, 10)
+        self.assertEqual(len(reopened), 3)
+        self.assertEqual([record['pulses'] for record in reopened.peek(10)[1]], [2, 3, 4])
+
+    def test_3_bounded_oldest_first_eviction(self):
+        for i in range(35):
+            self.outbox.append(1000.0 + i, 10.0, 0.5, i)
+        self.assertEqual(len(self.outbox), 10)
+        self.assertEqual(self.outbox.evicted, 25)
+        self.assertEqual([record['pulses'] for record in self.outbox.peek(10)[1]], list(range(25, 35)))
+        self.assertTrue(os.path.getsize(self.path) < 20 * 20)
+
+    def test_4_commit_after_eviction(self):
+        for i in range(10):
+            self.outbox.append(1000.0 + i, 10.0, 0.5, i)
+        seq, records = self.outbox.peek(5)
+        for i in range(10, 15):
+            self.outbox.append(1000.0 + i, 10.0, 0.5, i)
+        self.outbox.commit(seq, len(records))
+        self.assertEqual([record['pulses'] for record in self.outbox.peek(10)[1]], list(range(5, 15)))
+
+    # Every append is synced to the card unless fsync is turned off
+    def test_5_fsync(self):
+        with unittest.mock.patch('os.fsync', wraps=os.fsync) as fsync:
+            self.outbox.append(1000.0, 10.0, 0.5, 1)
+            self.assertEqual(fsync.call_count, 1)
+            unsynced = FlowOutbox(os.path.join(self.dir, 'unsynced.outbox'), 10, fsync=False)
+            unsynced.append(1000.0, 10.0, 0.5, 1)
+            self.assertEqual(fsync.call_count, 1)
+        self.assertEqual(len(unsynced), 1)
+
+
+# Tests the save flow process when records are stored in the outbox
+class FlowSensorOutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.config_backup = config.copy()
+        self.dir = tempfile.mkdtemp()
+        config['FLOW_OUTBOX_FILE'] = os.path.join(self.dir, 'flow.outbox')
+        config['FLOW_OUTBOX_BATCH_SIZE'] = 2
+        self.stub = stub_server
+        self.stub.reset()
+        self.flow = FlowSensor()
+
+    def tearDown(self):
+        config.update(self.config_backup)
+        shutil.rmtree(self.dir)
+
+    def test_1_process_success(self):
+        self.flow.pulses = 10000
+        success = self.flow.save_flow_process()
+        self.assertTrue(success)
+        self.assertEqual(self.flow.pulses, 0)
+        self.assertEqual(len(self.flow.outbox), 0)
+        self.assertEqual(len(self.stub.flow_records), 1)
+        self.assertEqual(self.stub.flow_records[0]['pulses'], 10000)
+
+    def test_2_process_server_down_then_drain(self):
+        TestUtils.configure_server_down()
+        for _ in range(5):
+            self.flow.pulses = 1000
+            success = self.flow.save_flow_process()
+            self.assertFalse(success)
+            self.assertEqual(self.flow.pulses, 0)
+        self.assertEqual(len(self.flow.outbox), 5)
+        TestUtils.configure_stub_server(self.stub)
+        success = self.flow.save_flow_process()
+        self.assertTrue(success)
+        self.assertEqual(len(self.flow.outbox), 0)
+        self.assertEqual(len(self.stub.flow_records), 5)
+        self.assertEqual(self.stub.requests.count(('POST', '/flow/batch')), 3)
+
+    def test_3_process_threshold_not_satisfied(self):
+        success = self.flow.save_flow_process()
+        self.assertFalse(success)
+        self.assertEqual(self.stub.requests, [])
+
+
+# Tests the streaming flow analytics and leak detection
+class FlowAnalyticsTest(unittest.TestCase):
+    def setUp(self):
+        self.config_backup = config.copy()
+        config['PULSES_PER_LITRE'] = 60
+        config['FLOW_LEAK_GRACE_PERIOD'] = 2
+        config['FLOW_ANALYTICS_INTERVAL'] = 0.25
+        self.flow = FlowSensor()
+        self.valve = Valve(flow_sensor=self.flow)
+        self.analytics = self.flow.analytics
+        self.anomalies = []
+        self.analytics.add_listener(self.anomalies.append)
+        self.now = self.analytics.last_time
+
+    def tearDown(self):
+        config.update(self.config_backup)
+
+    # Feeds samples of the given flow rate in litres/minute, one per second
+    def flow_for(self, seconds, rate):
+        for _ in range(seconds):
+            for _ in range(int(rate)):
+                self.flow.record_pulse()
+            self.now += 1
+            self.analytics.sample(now=self.now)
+
+    def test_1_ewma(self):
+        stats = FlowAnalytics.EwmaStats(0.5)
+        for value in [10, 10, 10, 10]:
+            stats.add(value)
+        self.assertEqual((stats.mean, stats.variance), (10, 0))
+        stats.add(20)
+        self.assertEqual(stats.mean, 15)
+        self.assertEqual(stats.variance, 25)
+
+    def test_2_quantile_sketch(self):
+        generator = random.Random(0)
+        values = [generator.lognormvariate(1, 0.5) for _ in range(5000)]
+        for p in [0.5, 0.95]:
+            sketch = FlowAnalytics.P2Quantile(p)
+            for value in values:
+                sketch.add(value)
+            exact = FlowRateSeries.percentile(sorted(values), p * 100)
+            self.assertTrue(abs(sketch.value() - exact) / exact < 0.02, (p, sketch.value(), exact))
+            self.assertEqual(len(sketch.heights), 5)
+
+    def test_3_leak(self):
+        self.flow_for(5, 0)
+        self.flow_for(1, 30)
+        self.assertEqual(self.anomalies, [])
+        self.flow_for(1, 30)
+        self.assertEqual([(anomaly['kind'], anomaly['rate']) for anomaly in self.anomalies], [('leak', 30)])
+        self.flow_for(3, 30)
+        self.assertEqual(len(self.anomalies), 1)
+        self.flow_for(1, 0)
+        self.assertEqual(self.analytics.anomalies, {})
+
+    def test_4_no_leak_right_after_closing(self):
+        self.valve.update(pins.HIGH)
+        self.flow_for(5, 30)
+        self.valve.update(pins.LOW)
+        self.flow_for(2, 10)
+        self.assertEqual(self.anomalies, [])
+
+    def test_5_over_learned_rate(self):
+        self.valve.update(pins.HIGH)
+        self.flow_for(config['FLOW_EXPECTED_RATE_WARMUP'], 20)
+        self.assertEqual(self.analytics.expected_rate(), 20)
+        self.flow_for(5, 25)
+        self.assertEqual(self.anomalies, [])
+        self.flow_for(2, 40)
+        self.assertEqual([anomaly['kind'] for anomaly in self.anomalies], ['over_rate'])
+        # The expected rate follows the normal flow
+        self.assertTrue(20 < self.anomalies[0]['expected_rate'] < 25)
+        stats = self.analytics.stats()
+        self.assertEqual(stats['anomalies'], ['over_rate'])
+        self.assertAlmostEqual(stats['p50'], 20, delta=1)
+
+    # With the suggested interval and the default anomaly settings
+    def test_6_raised_within_a_second(self):
+        config['FLOW_ANALYTICS_INTERVAL'] = 1
+        for key in ('FLOW_ANOMALY_SAMPLES', 'FLOW_ANOMALY_LATENCY'):
+            config[key] = self.config_backup[key]
+        self.assertAlmostEqual(FlowAnalytics.sample_interval(config), 1.0 / 3)
+        config['FLOW_LEAK_GRACE_PERIOD'] = 0
+        raised = threading.Event()
+        self.analytics.add_listener(lambda anomaly: raised.set())
+        self.flow.start_analytics()
+        try:
+            start_time = time.time()
+            while not raised.is_set() and time.time() - start_time < 2:
+                self.flow.record_pulse()
+                time.sleep(0.01)
+        finally:
+            self.flow.stop_analytics()
+        self.assertTrue(raised.is_set())
+        self.assertTrue(time.time() - start_time < 1)
+
+    def test_7_journaled(self):
+        journal_dir = tempfile.mkdtemp()
+        config['JOURNAL_DIR'] = journal_dir
+        try:
+            self.flow_for(5, 30)
+            EventJournal.close_journal()
+            decoded = [EventJournal.decode(record) for record in EventJournal.read_journal(journal_dir)]
+        finally:
+            EventJournal.close_journal()
+            shutil.rmtree(journal_dir)
+        anomalies = [event for event in decoded if event['event'] == 'flow_anomaly']
+        self.assertEqual([(event['kind'], event['rate'], event['pin']) for event in anomalies],
+                         [('leak', 30, self.flow.pin)])
+
+    # The flow sensors of all zones are sampled by one task, which runs while any of them is started
+    def test_8_shared_sampler(self):
+        other = FlowSensor(pin=self.flow.pin + 1)
+        self.flow.start_analytics()
+        other.start_analytics()
+        try:
+            sampler = FlowAnalytics.get_sampler()
+            task = sampler.task
+            self.assertEqual(sampler.analytics, [self.analytics, other.analytics])
+            other_time = other.analytics.last_time
+            start_time = time.time()
+            while other.analytics.last_time == other_time and time.time() - start_time < 2:
+                time.sleep(0.01)
+            self.assertTrue(self.analytics.last_time > self.now and other.analytics.last_time > other_time)
+            self.flow.stop_analytics()
+            self.assertIs(sampler.task, task)
+        finally:
+            self.flow.stop_analytics()
+            other.stop_analytics()
+        self.assertIsNone(sampler.task)
+        self.assertFalse(task.thread.is_alive())
+        # Disabled by default
+        config['FLOW_ANALYTICS_INTERVAL'] = self.config_backup['FLOW_ANALYTICS_INTERVAL']
+        self.assertIsNone(FlowSensor(pin=self.flow.pin + 2).analytics)
+
+
+# Tests the in-memory flow batch
+class FlowBatchTest(unittest.TestCase):
+    def test_1_peek_and_commit(self):
+        batch = FlowBatch(10)
+        for i in range(5):
+            batch.append(1000.0 + i, 10.0, 0.5, i)
+        self.assertEqual(batch.oldest_time(), 1000.0)
+        seq, records = batch.peek(3)
+        self.assertEqual([record['pulses'] for record in records], [0, 1, 2])
+        committed = batch.commit(seq, len(records))
+        self.assertEqual([record['pulses'] for record in committed], [0, 1, 2])
+        self.assertEqual(len(batch), 2)
+        self.assertEqual(batch.oldest_time(), 1003.0)
+
+    def test_2_merge_when_full(self):
+        batch = FlowBatch(3)
+        for i in range(5):
+            batch.append(1000.0 + i, 10.0, 0.5, 100 + i)
+        self.assertEqual(len(batch), 3)
+        _, records = batch.peek(3)
+        self.assertEqual(records[0], {'time': 1002.0, 'duration': 30.0, 'volume': 1.5, 'pulses': 303})
+        self.assertEqual(sum(record['pulses'] for record in records), sum(range(100, 105)))
+
+    def test_3_commit_after_merge(self):
+        batch = FlowBatch(2)
+        batch.append(1000.0, 10.0, 0.5, 1)
+        batch.append(1001.0, 10.0, 0.5, 2)
+        seq, records = batch.peek(1)
+        batch.append(1002.0, 10.0, 0.5, 4)
+        # The peeked record is in flight, so the next two are merged instead and only the uploaded one is removed
+        self.assertEqual([record['pulses'] for record in batch.commit(seq, len(records))], [1])
+        self.assertEqual([record['pulses'] for record in batch.peek(2)[1]], [6])
+
+    # Records in flight are kept apart even if the batch overflows, and a failed upload can be peeked again
+    def test_4_in_flight_not_merged(self):
+        batch = FlowBatch(2)
+        batch.append(1000.0, 10.0, 0.5, 1)
+        batch.append(1001.0, 10.0, 0.5, 2)
+        seq, records = batch.peek(2)
+        batch.append(1002.0, 10.0, 0.5, 4)
+        batch.append(1003.0, 10.0, 0.5, 8)
+        self.assertEqual([record['pulses'] for record in batch.peek(10)[1]], [1, 2, 12])
+        seq, records = batch.peek(2)
+        self.assertEqual([record['pulses'] for record in batch.commit(seq, len(records))], [1, 2])
+        self.assertEqual(len(batch), 1)
+
+    def test_5_rate_summary(self):
+        batch = FlowBatch(1)
+        batch.append(1000.0, 10.0, 0.5, 1, {'min': 1.0, 'max': 3.0, 'mean': 2.0, 'p50': 2.0, 'samples': 1})
+        batch.append(1001.0, 10.0, 0.5, 2, {'min': 2.0, 'max': 6.0, 'mean': 5.0, 'p50': 5.0, 'samples': 3})
+        self.assertEqual(batch.peek(1)[1][0]['rate'], {'min': 1.0, 'max': 6.0, 'mean': 4.25, 'samples': 4})
+
+
+# Tests the save flow process in batch upload mode
+class FlowSensorBatchUploadTest(unittest.TestCase):
+    def setUp(self):
+        self.config_backup = config.copy()
+        config['FLOW_UPLOAD_MODE'] = 'batch'
+        config['FLOW_BATCH_MAX_RECORDS'] = 3
+        config['FLOW_BATCH_MAX_LATENCY'] = 3600
+        self.stub = stub_server
+        self.stub.reset()
+        self.flow = FlowSensor()
+
+    def tearDown(self):
+        config.update(self.config_backup)
+
+    # Records an interval with the given pulses and runs the save flow process
+    def save_interval(self, pulses):
+        self.flow.pulses += pulses
+        return self.flow.save_flow_process()
+
+    def test_1_upload_when_full(self):
+        self.assertFalse(self.save_interval(1000))
+        self.assertFalse(self.save_interval(2000))
+        self.assertEqual(self.stub.requests, [])
+        self.assertEqual(self.flow.pulses, 3000)
+        self.assertTrue(self.save_interval(3000))
+        self.assertEqual(self.stub.requests, [('POST', '/flow/batch')])
+        self.assertEqual([record['pulses'] for record in self.stub.flow_records], [1000, 2000, 3000])
+        self.assertEqual(self.flow.pulses, 0)
+        self.assertEqual(self.flow.batched_pulses, 0)
+        self.assertEqual(len(self.flow.outbox), 0)
+
+    def test_2_upload_after_max_latency(self):
+        self.assertFalse(self.save_interval(1000))
+        config['FLOW_BATCH_MAX_LATENCY'] = 0
+        self.assertTrue(self.flow.save_flow_process())
+        self.assertEqual([record['pulses'] for record in self.stub.flow_records], [1000])
+
+    def test_3_acknowledge_only_saved_records(self):
+        TestUtils.configure_server_down()
+        for pulses in [1000, 2000, 3000, 4000]:
+            self.assertFalse(self.save_interval(pulses))
+        self.assertEqual(self.flow.pulses, 10000)
+        self.assertEqual(len(self.flow.outbox), 4)
+        TestUtils.configure_stub_server(self.stub)
+        self.stub.inject_fault('POST', '/flow/batch')
+        self.assertFalse(self.save_interval(500))
+        self.assertEqual(self.flow.pulses, 10500)
+        # Only the uploaded records are acknowledged, pulses counted in the meantime stay pending
+        seq, records = self.flow.outbox.peek(2)
+        self.assertTrue(FlowSensor.send_flow_batch(records))
+        self.flow.pulses += 50
+        self.flow.commit_records(seq, records)
+        self.assertEqual(self.flow.pulses, 10550 - 3000)
+        self.assertEqual(self.flow.batched_pulses, 10500 - 3000)
+        self.assertTrue(self.save_interval(700))
+        self.assertEqual([record['pulses'] for record in self.stub.flow_records], [1000, 2000, 3000, 4000, 500, 750])
+        self.assertEqual(self.flow.pulses, 0)
+        self.assertEqual(self.flow.batched_pulses, 0)
+
+    def test_4_compressed_upload(self):
+        config['FLOW_BATCH_COMPRESSION'] = 'gzip'
+        for pulses in [1000, 2000, 3000]:
+            self.save_interval(pulses)
+        self.assertEqual([record['pulses'] for record in self.stub.flow_records], [1000, 2000, 3000])
+        kwargs = FlowSensor.flow_batch_request_args(self.stub.flow_records)
+        self.assertEqual(kwargs['headers']['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(kwargs['data']).decode('utf8')),
+                         {'records': self.stub.flow_records})
+        self.assertEqual(self.stub.bytes_received, len(kwargs['data']))
+
+    def test_5_upload_on_stop(self):
+        self.flow.start()
+        self.flow.pulses += 1000
+        self.flow.stop()
+        self.assertEqual([record['pulses'] for record in self.stub.flow_records], [1000])
+        self.assertEqual(self.flow.pulses, 0)
+
+
+# Tests the startup profile and the modules deferred until first use
+class StartupTest(unittest.TestCase):
+    def test_1_profile(self):
+        now = [100.0]
+        profile = StartupProfile.StartupProfile(clock=lambda: now[0], initial_age=0.5)
+        with profile.phase('gpio'):
+            now[0] += 0.25
+        now[0] += 1
+        profile.mark('first_valve_poll')
+        now[0] += 1
+        profile.mark('first_valve_poll')
+        profile.report()
+        summary = profile.summary()
+        self.assertEqual((summary['phases'], summary['milestones']), ({'gpio': 0.25}, {'first_valve_poll': 1.75}))
+        self.assertEqual(SprinklerMetrics.STARTUP_SECONDS.labels('phase', 'gpio').value, 0.25)
+
+    def test_2_lazy_import(self):
+        self.assertIs(SprinklerUtils.lazy_import('json'), json)
+        self.assertIsNone(SprinklerUtils.lazy_import('no_such_module'))
+        module = SprinklerUtils.LazyModule('colorsys')
+        self.assertEqual(module.rgb_to_hsv(1, 0, 0), (0, 1, 1))
+
+    # The components are imported in a new process, without requests and other modules that take long to import
+    def test_3_deferred_imports(self):
+        code = ("from SprinklerConfig import config\n"
+                "config['FORCE_DUMMY_GPIO'] = True\n"
+                "import SprinklerLogging, ConfigSnapshot, FlowSensorControl, ScheduleControl\n"
+                "import ValveControl, ZoneControl\n"
+                "import sys\n"
+                "print(' '.join(m for m in ('requests', 'urllib3', 'numpy', 'http.server') if m in sys.modules))")
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.realpath(__file__)))
+        self.assertEqual(output.decode('utf8').strip(), '')
+
+
+# Tests the binary event journal
+class EventJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.config_backup = config.copy()
+        self.dir = tempfile.mkdtemp()
+        stub_server.reset()
+
+    def tearDown(self):
+        EventJournal.close_journal()
+        config.update(self.config_backup)
+        shutil.rmtree(self.dir)
+
+    def test_1_round_trip(self):
+        journal = EventJournal.EventJournal(self.dir)
+        journal.record(EventJournal.VALVE_STATE, pins.HIGH, pins.LOW, 40, event_time=1000.0)
+        journal.record(EventJournal.FLOW_INTERVAL, 38, 1.5, 10.0, 547, event_time=1001.0)
+        journal.record(EventJournal.HTTP_REQUEST, 200, 3.5, 2, 1, event_time=1002.0)
+        self.assertEqual(list(EventJournal.read_journal(self.dir)), [])
+        journal.close()
+        decoded = [EventJournal.decode(record) for record in EventJournal.read_journal(self.dir)]
+        self.assertEqual(decoded, [
+            {'time': 1000.0, 'event': 'valve_state', 'state': 1, 'previous_state': 0.0, 'pin': 40.0},
+            {'time': 1001.0, 'event': 'flow_interval', 'pin': 38, 'volume': 1.5, 'duration': 10.0, 'pulses': 547},
+            {'time': 1002.0, 'event': 'http_request', 'status': 200, 'latency_ms': 3.5, 'route': '/flow',
+             'method': 'POST'}
+        ])
+        self.assertEqual(os.path.getsize(EventJournal.list_segments(self.dir)[0]),
+                         EventJournal.HEADER.size + 3 * EventJournal.RECORD.size)
+
+    def test_2_segments_capped(self):
+        segment_size = EventJournal.HEADER.size + 10 * EventJournal.RECORD.size
+        journal = EventJournal.EventJournal(self.dir, segment_size=segment_size, max_segments=3, flush_bytes=100)
+        for i in range(55):
+            journal.record(EventJournal.VALVE_POLL, 1, i, 10)
+        journal.close()
+        segments = EventJournal.list_segments(self.dir)
+        self.assertEqual([EventJournal.segment_seq(path) for path in segments], [4, 5, 6])
+        self.assertTrue(all(os.path.getsize(path) <= segment_size for path in segments))
+        durations = [record[3] for record in EventJournal.read_journal(self.dir)]
+        self.assertEqual(durations, list(range(30, 55)))
+
+    def test_3_resume_after_partial_write(self):
+        journal = EventJournal.EventJournal(self.dir)
+        journal.record(EventJournal.VALVE_POLL, 1, 5, 10)
+        journal.close()
+        with open(EventJournal.list_segments(self.dir)[0], 'ab') as segment:
+            segment.write(b'\x00' * 5)
+        journal = EventJournal.EventJournal(self.dir)
+        journal.record(EventJournal.VALVE_POLL, 0, 6, 10)
+        journal.close()
+        self.assertEqual(len(EventJournal.list_segments(self.dir)), 1)
+        self.assertEqual([record[3] for record in EventJournal.read_journal(self.dir)], [5, 6])
+
+    def test_4_client_events(self):
+        config['JOURNAL_DIR'] = self.dir
+        stub_server.set_valve_state(pins.HIGH)
+        valve = Valve()
+        flow = FlowSensor()
+        self.assertTrue(valve.valve_update_process())
+        flow.pulses = 1000
+        self.assertTrue(flow.save_flow_process())
+        TestUtils.configure_server_down()
+        self.assertFalse(FlowSensor.send_flow_data(1, 1))
+        EventJournal.close_journal()
+        events = [EventJournal.decode(record) for record in EventJournal.read_journal(self.dir)]
+        self.assertEqual([event['event'] for event in events],
+                         ['http_request', 'valve_state', 'http_request', 'http_request', 'flow_interval',
+                          'http_request'])
+        self.assertEqual([(event['method'], event['route'], event['status'])
+                          for event in events if event['event'] == 'http_request'],
+                         [('GET', '/valve', 200), ('POST', '/valve', 200), ('POST', '/flow', 200),
+                          ('POST', '/flow', 0)])
+        self.assertEqual(events[1]['state'], pins.HIGH)
+        self.assertEqual(events[4]['pulses'], 1000)
+        valve.update(pins.LOW)
+
+    def test_5_reader(self):
+        journal = EventJournal.EventJournal(self.dir)
+        journal.record(EventJournal.VALVE_POLL, 1, 4, 10)
+        journal.record(EventJournal.VALVE_POLL, 0, 8, 10)
+        journal.record(EventJournal.VALVE_STATE, 1, 0, 40)
+        journal.close()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            EventJournal.main([self.dir, '--event', 'valve_poll', '--json'])
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(json.loads(lines[1])['duration_ms'], 8)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            EventJournal.main([self.dir, '--summary'])
+        summary = json.loads(output.getvalue())
+        self.assertEqual(summary['valve_poll']['count'], 2)
+        self.assertEqual(summary['valve_poll']['duration_ms_mean'], 6)
+        self.assertEqual(summary['valve_state']['count'], 1)
+
+    # Buffered events are written every flush interval even if no other event arrives
+    def test_6_flushed_on_timer(self):
+        journal = EventJournal.EventJournal(self.dir, flush_interval=0.05).start()
+        try:
+            journal.record(EventJournal.VALVE_POLL, 1, 4, 10)
+            start_time = time.time()
+            while not list(EventJournal.read_journal(self.dir)) and time.time() - start_time < 2:
+                time.sleep(0.01)
+            self.assertEqual(len(list(EventJournal.read_journal(self.dir))), 1)
+        finally:
+            journal.close()
+        self.assertIsNone(journal.flush_task)
+
+    # The log file only gets the per-cycle DEBUG lines if asked for, and DEBUG records are not created otherwise
+    def test_7_log_file_level(self):
+        with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'logging.json'), 'r') as log_file:
+            log_dict = json.load(log_file)
+        SprinklerLogging.apply_log_levels(log_dict)
+        self.assertEqual((log_dict['handlers']['file_handler']['level'], log_dict['root']['level']), ('INFO', 20))
+        config['LOG_FILE_LEVEL'] = 'DEBUG'
+        SprinklerLogging.apply_log_levels(log_dict)
+        self.assertEqual(log_dict['root']['level'], 10)
+
+
+# Tests the metrics registry, its exporters and the instrumentation of the components
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.config_backup = config.copy()
+        self.dir = tempfile.mkdtemp()
+        self.registry = SprinklerMetrics.MetricsRegistry()
+        stub_server.reset()
+
+    def tearDown(self):
+        SprinklerMetrics.stop_exporters()
+        config.update(self.config_backup)
+        shutil.rmtree(self.dir)
+
+    @staticmethod
+    def sample(name):
+        for line in SprinklerMetrics.registry.expose().splitlines():
+            if line.startswith(name + ' '):
+                return float(line.split(' ')[1])
+        return 0
+
+    def test_1_exposition_format(self):
+        counter = self.registry.counter('test_requests_total', 'Requests', ['route'])
+        counter.labels('/valve').inc()
+        counter.labels('/valve').inc(2)
+        gauge = self.registry.gauge('test_state', 'State')
+        gauge.set(1)
+        histogram = self.registry.histogram('test_latency_seconds', 'Latency', buckets=[0.1, 1])
+        for value in [0.05, 0.5, 0.5, 5]:
+            histogram.observe(value)
+        self.assertEqual(self.registry.expose(), '\n'.join([
+            '# HELP test_latency_seconds Latency',
+            '# TYPE test_latency_seconds histogram',
+            'test_latency_seconds_bucket{le="0.1"} 1',
+            'test_latency_seconds_bucket{le="1"} 3',
+            'test_latency_seconds_bucket{le="+Inf"} 4',
+            'test_latency_seconds_sum 6.05',
+            'test_latency_seconds_count 4',
+            '# HELP test_requests_total Requests',
+            '# TYPE test_requests_total counter',
+            'test_requests_total{route="/valve"} 3',
+            '# HELP test_state State',
+            '# TYPE test_state gauge',
+            'test_state 1'
+        ]) + '\n')
+        self.assertRaises(ValueError, counter.labels)
+
+    def test_2_instrumented_components(self):
+        name = 'sprinkler_http_requests_total{method="GET",route="/valve",status="200"}'
+        requests_before = MetricsTest.sample(name)
+        failures_before = MetricsTest.sample('sprinkler_flow_saves_total{result="failure"}')
+        flow = FlowSensor()
+        Valve.get_valve_info()
+        DummyGPIO.fire_edges(config['FLOW_SENSOR_PIN'], 1000)
+        TestUtils.configure_server_down()
+        self.assertFalse(flow.save_flow_process())
+        self.assertEqual(MetricsTest.sample(name), requests_before + 1)
+        self.assertEqual(MetricsTest.sample('sprinkler_flow_saves_total{result="failure"}'), failures_before + 1)
+        self.assertEqual(MetricsTest.sample('sprinkler_flow_pulses_total{pin="%d"}' % config['FLOW_SENSOR_PIN']),
+                         1000)
+        self.assertTrue(MetricsTest.sample(
+            'sprinkler_http_request_duration_seconds_count{method="POST",route="/flow"}') >= 1)
+
+    def test_3_loop_drift(self):
+        SprinklerMetrics.observe_loop_drift('test', time.time() - 1.2, 1)
+        self.assertEqual(MetricsTest.sample('sprinkler_loop_drift_seconds_bucket{loop="test",le="0.1"}'), 0)
+        self.assertEqual(MetricsTest.sample('sprinkler_loop_drift_seconds_bucket{loop="test",le="0.5"}'), 1)
+
+    def test_4_exporters(self):
+        config['METRICS_PORT'] = 0
+        config['METRICS_SNAPSHOT_FILE'] = os.path.join(self.dir, 'sprinkler.prom')
+        config['METRICS_SNAPSHOT_INTERVAL'] = 0.05
+        SprinklerMetrics.start_exporters()
+        port = SprinklerMetrics.exporters[0].port
+        with urllib.request.urlopen('http://127.0.0.1:%d/metrics' % port) as resp:
+            self.assertEqual(resp.status, 200)
+            self.assertTrue(resp.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+            self.assertIn('# TYPE sprinkler_valve_updates_total counter', resp.read().decode('utf8'))
+        time.sleep(0.2)
+        with open(config['METRICS_SNAPSHOT_FILE']) as snapshot_file:
+            self.assertIn('# TYPE sprinkler_loop_drift_seconds histogram', snapshot_file.read())
+
+
+# Tests running the components on the asyncio runtime against the stub server
+class AsyncRuntimeTest(unittest.TestCase):
+    def setUp(self):
+        self.config_backup = config.copy()
+        config['VALVE_STATE_POLL_INTERVAL'] = 0.05
+        config['FLOW_DATA_SAVE_INTERVAL'] = 0.05
+        self.stub = stub_server
+        self.stub.reset()
+        self.valve = Valve()
+        self.flow = FlowSensor()
+
+    def tearDown(self):
+        config.update(self.config_backup)
+
+    def run_scenario(self):
+        runtime = SprinklerAsync.AsyncRuntime(self.valve, self.flow)
+        thread = threading.Thread(target=asyncio.run, args=(runtime.run(handle_signals=False),))
+        thread.start()
+        try:
+            self.stub.set_valve_state(pins.HIGH)
+            self.flow.pulses = 1000
+            deadline = time.time() + 5
+            while (self.valve.state != pins.HIGH or self.flow.pulses) and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(self.valve.state, pins.HIGH)
+            self.assertEqual(len(self.stub.flow_records), 1)
+            self.assertEqual(self.flow.pulses, 0)
+        finally:
+            while runtime.stopping is None:
+                time.sleep(0.01)
+            stop_time = time.time()
+            runtime.stop()
+            thread.join()
+        self.assertTrue(time.time() - stop_time < 1)
+        self.assertEqual(self.valve.state, pins.LOW)
+        self.assertFalse(self.valve.active)
+
+    def test_1_run_and_stop(self):
+        self.run_scenario()
+
+    @unittest.skipIf(SprinklerAsync.aiohttp is None, 'aiohttp is not installed')
+    def test_2_run_and_stop_with_aiohttp(self):
+        config['ASYNC_HTTP_CLIENT'] = 'aiohttp'
+        self.run_scenario()
+
+    def test_3_run_and_stop_with_compressed_batches(self):
+        config['FLOW_UPLOAD_MODE'] = 'batch'
+        config['FLOW_BATCH_MAX_LATENCY'] = 0
+        config['FLOW_BATCH_COMPRESSION'] = 'gzip'
+        self.flow = FlowSensor()
+        self.run_scenario()
+        self.assertEqual(self.stub.requests.count(('POST', '/flow/batch')), 1)
+
+    def test_4_long_poll(self):
+        config['VALVE_COMMAND_MODE'] = 'long_poll'
+        self.valve = Valve()
+        self.run_scenario()
+
+    def test_5_failing_loop_runs(self):
+        def failing_once(method):
+            calls = []
+
+            def call(*args):
+                calls.append(args)
+                if len(calls) == 1:
+                    raise RuntimeError('Failing run')
+                return method(*args)
+
+            return call
+
+        self.valve.apply_valve_info = failing_once(self.valve.apply_valve_info)
+        self.flow.prepare_flow_data = failing_once(self.flow.prepare_flow_data)
+        with self.assertLogs('SprinklerAsync', logging.ERROR) as logs:
+            self.run_scenario()
+        self.assertEqual(len([line for line in logs.output if 'Failing run' in line]), 2)
+
+    # The loops sleep on the virtual clock, so that a simulated hour runs in a fraction of the time
+    def test_6_virtual_clock(self):
+        config['VALVE_STATE_POLL_INTERVAL'] = 60
+        config['FLOW_DATA_SAVE_INTERVAL'] = 10
+        clock = Clock.VirtualClock(0.0)
+        system_clock = Clock.set_clock(clock)
+        try:
+            runtime = SprinklerAsync.AsyncRuntime(Valve(), FlowSensor())
+            thread = threading.Thread(target=asyncio.run, args=(runtime.run(handle_signals=False),))
+            thread.start()
+            while runtime.clock_waiter is None:
+                time.sleep(0.01)
+            start_time = time.time()
+            clock.advance(config['MAX_FLOW_DURATION_FOR_SAVE'] - 1)
+            self.assertEqual(self.stub.flow_records, [])
+            clock.advance(1)
+            self.assertEqual(len(self.stub.flow_records), 1)
+            self.assertAlmostEqual(self.stub.flow_records[0]['duration'], config['MAX_FLOW_DURATION_FOR_SAVE'])
+            self.assertEqual(self.stub.requests.count(('GET', '/valve')), config['MAX_FLOW_DURATION_FOR_SAVE'] / 60 + 1)
+            self.assertTrue(time.time() - start_time < config['MAX_FLOW_DURATION_FOR_SAVE'] / 100.0)
+            runtime.stop()
+            thread.join()
+        finally:
+            Clock.set_clock(system_clock)
+
+
+# Tests the locally cached irrigation schedule and its executor
+class ScheduleTest(unittest.TestCase):
+    def setUp(self):
+        self.config_backup = config.copy()
+        self.dir = tempfile.mkdtemp()
+        config['SCHEDULE_CACHE_FILE'] = os.path.join(self.dir, 'schedule.json')
+        self.stub = stub_server
+        self.stub.reset()
+        self.valve = Valve()
+        self.executor = ScheduleControl.ScheduleExecutor({None: self.valve})
+
+    def tearDown(self):
+        config.update(self.config_backup)
+        shutil.rmtree(self.dir)
+
+    def test_1_recurrence(self):
+        schedule = ScheduleControl.IrrigationSchedule(1, [
+            {'id': 1, 'start': 1000, 'duration': 600, 'recurrence': 'daily'},
+            {'id': 2, 'zone': 'b', 'start': 5000, 'duration': 60}
+        ])
+        self.assertEqual(schedule.next_transition(0), 1000)
+        self.assertEqual([(entry['id'], start, end) for entry, start, end in schedule.active_runs(1200)],
+                         [(1, 1000, 1600)])
+        self.assertEqual(schedule.next_transition(1200), 1600)
+        self.assertEqual(schedule.next_transition(1600), 5000)
+        self.assertEqual(schedule.next_transition(5060), 1000 + 86400)
+        self.assertEqual([(entry['id'], start) for entry, start, _ in schedule.active_runs(3 * 86400 + 1000)],
+                         [(1, 3 * 86400 + 1000)])
+        with self.assertRaises(ValueError):
+            ScheduleControl.IrrigationSchedule(1, [{'start': 0, 'duration': 60, 'recurrence': 'hourly'}])
+        with self.assertRaises(ValueError):
+            ScheduleControl.IrrigationSchedule(1, [{'start': 0, 'duration': 0}])
+
+    def test_2_execute_cycle(self):
+        self.executor.schedule = ScheduleControl.IrrigationSchedule(1, [
+            {'id': 1, 'start': 1000, 'duration': 600},
+            {'id': 2, 'start': 1300, 'duration': 600}
+        ])
+        self.assertEqual(self.executor.execute_cycle(now=500), 1000)
+        self.assertEqual(self.valve.state, pins.LOW)
+        self.assertEqual(self.executor.execute_cycle(now=1000), 1300)
+        self.assertEqual(self.valve.state, pins.HIGH)
+        self.assertEqual(self.executor.execute_cycle(now=1300), 1600)
+        self.assertEqual(self.executor.execute_cycle(now=1600), 1900)
+        # The overlapping run keeps the valve open
+        self.assertEqual(self.valve.state, pins.HIGH)
+        self.assertIsNone(self.executor.execute_cycle(now=1900))
+        self.assertEqual(self.valve.state, pins.LOW)
+        self.assertEqual([(report['id'], report['started'], report['ended'], report['success'])
+                          for report in self.executor.reports], [(1, 1000, 1600, True), (2, 1300, 1900, True)])
+
+    def test_3_sync_and_cache(self):
+        self.stub.set_schedule([{'id': 7, 'start': time.time() + 3600, 'duration': 60}])
+        self.executor.sync_cycle()
+        self.assertEqual(self.executor.schedule.version, 1)
+        self.executor.sync_cycle()
+        self.assertEqual([request.query for request in self.stub.request_log], [{}, {'version': '1'}])
+        self.assertEqual([request.status for request in self.stub.request_log], [200, 304])
+        # The cached schedule is used without contacting the server
+        TestUtils.configure_server_down()
+        executor = ScheduleControl.ScheduleExecutor({None: self.valve})
+        self.assertEqual(executor.schedule.to_dict(), self.executor.schedule.to_dict())
+        executor.sync_cycle()
+        self.assertEqual(executor.schedule.version, 1)
+
+    def test_4_run_and_report(self):
+        start = time.time() + 0.2
+        self.stub.set_schedule([{'id': 1, 'start': start, 'duration': 0.2}])
+        self.executor.sync_cycle()
+        self.executor.start()
+        try:
+            while self.valve.state != pins.HIGH and time.time() < start + 1:
+                time.sleep(0.005)
+            opened = time.time()
+            while self.valve.state != pins.LOW and time.time() < start + 1:
+                time.sleep(0.005)
+            closed = time.time()
+        finally:
+            self.executor.stop()
+        self.assertTrue(abs(opened - start) < 0.05)
+        self.assertTrue(abs(closed - start - 0.2) < 0.05)
+        # Only the schedule download and the final report contacted the server
+        self.assertEqual(self.stub.requests, [('GET', '/schedule'), ('GET', '/schedule'), ('POST', '/schedule/runs')])
+        self.assertEqual(len(self.stub.schedule_runs), 1)
+        self.assertEqual(self.stub.schedule_runs[0]['planned_start'], start)
+
+    def test_5_stop_during_run(self):
+        self.stub.set_schedule([{'id': 1, 'start': time.time() - 10, 'duration': 3600}])
+        self.executor.sync_cycle()
+        self.executor.start()
+        while self.valve.state != pins.HIGH:
+            time.sleep(0.005)
+        self.executor.stop()
+        self.assertEqual(self.valve.state, pins.LOW)
+        self.assertEqual(len(self.stub.schedule_runs), 1)
+        self.assertIsNotNone(self.stub.schedule_runs[0]['ended'])
+
+    def test_6_invalid_zones(self):
+        for entry in [{'zone': ['a']}, {'zone': {}}, {'id': [1]}, {'zone': True}, {'zone': 'b'}]:
+            with self.assertRaises(ValueError):
+                ScheduleControl.IrrigationSchedule(1, [dict(entry, start=0, duration=60)], self.executor.valves)
+        # A schedule for zones of another device is not applied
+        self.stub.set_schedule([{'id': 1, 'zone': 'b', 'start': time.time(), 'duration': 60}])
+        self.executor.sync_cycle()
+        self.assertIsNone(self.executor.schedule)
+
+    # A failing cycle ends the runs in progress and the executor keeps going
+    def test_7_failing_cycle(self):
+        self.stub.set_schedule([{'id': 1, 'start': time.time() - 10, 'duration': 3600}])
+        self.executor.sync_cycle()
+        failures = []
+
+        def next_transition(at):
+            failures.append(at)
+            raise RuntimeError('Schedule failed')
+
+        self.executor.start()
+        try:
+            while self.valve.state != pins.HIGH:
+                time.sleep(0.005)
+            with unittest.mock.patch.object(self.executor.schedule, 'next_transition', side_effect=next_transition):
+                self.executor.changed.set()
+                deadline = time.time() + 5
+                while self.valve.state != pins.LOW and time.time() < deadline:
+                    time.sleep(0.005)
+                self.assertEqual(self.valve.state, pins.LOW)
+                self.assertTrue(failures)
+            self.executor.changed.set()
+            deadline = time.time() + 5
+            while self.valve.state != pins.HIGH and time.time() < deadline:
+                time.sleep(0.005)
+            self.assertEqual(self.valve.state, pins.HIGH)
+            self.assertTrue(self.executor.thread.is_alive())
+        finally:
+            self.executor.stop()
+        self.assertEqual(self.valve.state, pins.LOW)
+        self.assertEqual(len(self.stub.schedule_runs), 2)
+
+
+# Tests operating several zones with batched requests against the stub server
+class ZoneManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.config_backup = config.copy()
+        self.stub = stub_server
+        self.stub.reset()
+        self.manager = ZoneManager([
+            {'ID': 1, 'VALVE_PIN': 11, 'FLOW_SENSOR_PIN': 12},
+            {'ID': 2, 'VALVE_PIN': 13, 'FLOW_SENSOR_PIN': 15},
+            {'ID': 3, 'VALVE_PIN': 16, 'FLOW_SENSOR_PIN': 18}
+        ])
+
+    def tearDown(self):
+        config.update(self.config_backup)
+
+    def test_1_valve_update_single_request(self):
+        self.stub.set_zone_state(1, pins.HIGH)
+        self.stub.set_zone_state(3, pins.HIGH)
+        success = self.manager.valve_update_process()
+        self.assertTrue(success)
+        self.assertEqual([self.manager.zones[zone].valve.state for zone in [1, 2, 3]], [pins.HIGH, pins.LOW, pins.HIGH])
+        self.assertEqual(self.stub.requests, [('GET', '/zones/valve'), ('POST', '/zones/valve')])
+
+    def test_2_valve_update_unknown_zone(self):
+        self.stub.set_zone_state(1, pins.HIGH)
+        self.stub.set_zone_state(9, pins.HIGH)
+        success = self.manager.valve_update_process()
+        self.assertFalse(success)
+        self.assertEqual(self.manager.zones[1].valve.state, pins.HIGH)
+
+    def test_3_flow_save_single_request(self):
+        self.manager.zones[1].flow_sensor.pulses = 1000
+        self.manager.zones[3].flow_sensor.pulses = 2000
+        success = self.manager.save_flow_process()
+        self.assertTrue(success)
+        self.assertEqual(sorted(record['zone'] for record in self.stub.flow_records), [1, 3])
+        self.assertEqual(self.stub.requests, [('POST', '/zones/flow')])
+        self.assertEqual([zone.flow_sensor.pulses for zone in self.manager.zones.values()], [0, 0, 0])
+
+    def test_4_flow_save_server_down(self):
+        TestUtils.configure_server_down()
+        self.manager.zones[1].flow_sensor.pulses = 1000
+        success = self.manager.save_flow_process()
+        self.assertFalse(success)
+        self.assertEqual(self.manager.zones[1].flow_sensor.pulses, 1000)
+
+    def test_5_valve_update_only_changes_acknowledged(self):
+        self.stub.set_zone_state(1, pins.HIGH)
+        self.stub.set_zone_state(2, pins.LOW)
+        self.assertTrue(self.manager.valve_update_process())
+        self.assertTrue(self.manager.valve_update_process())
+        self.assertEqual([(request.path, request.status) for request in self.stub.request_log],
+                         [('/zones/valve', 200), ('/zones/valve', 200), ('/zones/valve', 304)])
+        self.assertEqual(self.stub.request_log[1].data, {'zones': [{'zone': 1, 'state': pins.HIGH}]})
+
+    def test_6_malformed_zones(self):
+        manager = ZoneManager([
+            {'ID': 1, 'VALVE_PIN': 11, 'FLOW_SENSOR_PIN': 12},
+            {'ID': 1, 'VALVE_PIN': 13, 'FLOW_SENSOR_PIN': 15},
+            {'ID': [2], 'VALVE_PIN': 13, 'FLOW_SENSOR_PIN': 15},
+            {'ID': 3, 'VALVE_PIN': 16},
+            'zone'
+        ])
+        self.assertEqual(list(manager.zones), [1])
+        zones_valve = {'zones': [1, {'zone': [1], 'state': pins.HIGH}, {'zone': 1, 'state': pins.HIGH}]}
+        with unittest.mock.patch.object(ZoneManager, 'get_zones_valve_info', return_value=zones_valve):
+            self.assertFalse(manager.valve_update_process())
+        self.assertEqual(manager.zones[1].valve.state, pins.HIGH)
+
+    # The cycles run as scheduled tasks, which go on after a failed cycle
+    def test_7_scheduled_cycles(self):
+        config['VALVE_STATE_POLL_INTERVAL'] = 0.05
+        config['FLOW_DATA_SAVE_INTERVAL'] = 0.05
+        self.stub.set_zone_state(2, pins.HIGH)
+        valve_update_process = self.manager.valve_update_process
+        failures = []
+
+        def failing_update():
+            if not failures:
+                failures.append(True)
+                raise RuntimeError('Update failed')
+            return valve_update_process()
+
+        with unittest.mock.patch.object(self.manager, 'valve_update_process', side_effect=failing_update):
+            self.manager.start()
+            try:
+                deadline = time.time() + 5
+                while self.manager.zones[2].valve.state != pins.HIGH and time.time() < deadline:
+                    time.sleep(0.01)
+                self.assertEqual(self.manager.zones[2].valve.state, pins.HIGH)
+                self.assertEqual([task.name for task in self.manager.process_loops], ['ZoneValves', 'ZoneFlow'])
+            finally:
+                self.manager.stop()
+        self.assertEqual(failures, [True])
+        self.assertEqual(self.manager.process_loops, [])
+        self.assertEqual(self.manager.zones[2].valve.state, pins.LOW)
+
+    def test_8_invalid_zone_valve_info(self):
+        for payload in [[], ['zones'], 'zones', {'zones': 'all'}, {}]:
+            resp = unittest.mock.Mock(status_code=200, json=unittest.mock.Mock(return_value=payload))
+            with unittest.mock.patch.object(SprinklerApi.ApiClient, 'request', return_value=resp):
+                self.assertIsNone(ZoneManager.get_zones_valve_info())
+                self.assertFalse(self.manager.valve_update_process())
+        self.assertEqual([zone.valve.state for zone in self.manager.zones.values()], [pins.LOW] * 3)
+
+
+# Tests the gateway serving the valve and flow API of the LAN devices through one upstream connection
+class GatewayTest(unittest.TestCase):
+    def setUp(self):
+        self.config_backup = config.copy()
+        config['GATEWAY_SYNC_INTERVAL'] = 60
+        config['GATEWAY_COALESCE_DELAY'] = 0.1
+        config['GATEWAY_FORWARD_TIMEOUT'] = 5
+        self.stub = stub_server
+        self.stub.reset()
+        self.gateway = Gateway.Gateway('localhost', 0).start()
+        self.sessions = []
+
+    def tearDown(self):
+        for session in self.sessions:
+            session.close()
+        self.gateway.stop()
+        config.update(self.config_backup)
+        self.stub.reset()
+
+    # Sends a request of a device to the gateway the same way the device does to the server
+    def device_request(self, device, method, path, **kwargs):
+        session = requests.Session()
+        self.sessions.append(session)
+        return session.request(method, 'http://localhost:%d%s' % (self.gateway.port, path),
+                               auth=('API_KEY', device), timeout=10, **kwargs)
+
+    # Sends the requests of several devices at the same time
+    def concurrent_requests(self, requests_args):
+        responses = [None] * len(requests_args)
+
+        def send(index, args):
+            responses[index] = self.device_request(*args[:3], **(args[3] if len(args) > 3 else {}))
+
+        threads = [threading.Thread(target=send, args=(index, args)) for index, args in enumerate(requests_args)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return responses
+
+    def test_1_valve_polls_coalesced(self):
+        self.stub.set_device_valve_state('device-2', pins.HIGH)
+        responses = self.concurrent_requests([('device-1', 'GET', '/valve'), ('device-2', 'GET', '/valve')])
+        self.assertEqual([Valve.read_valve_info(resp)['state'] for resp in responses], [pins.LOW, pins.HIGH])
+        self.assertEqual(self.stub.requests, [('POST', '/gateway/valve')])
+        self.assertEqual(sorted(device['device'] for device in self.stub.request_log[0].data['devices']),
+                         ['device-1', 'device-2'])
+        # Polls are answered from the cache, including not modified
+        resp = self.device_request('device-2', 'GET', '/valve', params={'version': 1})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(Valve.read_valve_info(resp, {'state': pins.HIGH, 'version': 1})['state'], pins.HIGH)
+        self.assertEqual(len(self.stub.requests), 1)
+
+    def test_2_long_poll_fanned_out(self):
+        self.assertEqual(self.device_request('device-1', 'GET', '/valve').status_code, 200)
+        start_time = time.time()
+        self.stub.set_device_valve_state('device-1', pins.HIGH)
+        threading.Timer(0.2, self.gateway.sync_cycle).start()
+        resp = self.device_request('device-1', 'GET', '/valve', params={'wait': 5, 'state': 0, 'version': 0})
+        self.assertEqual(resp.json()['state'], pins.HIGH)
+        self.assertTrue(time.time() - start_time < 2)
+
+    def test_3_acks_and_flow_coalesced(self):
+        for device in ['device-1', 'device-2']:
+            self.device_request(device, 'GET', '/valve')
+        self.stub.reset()
+        responses = self.concurrent_requests([
+            ('device-1', 'POST', '/valve', {'json': {'state': 1, 'version': 1}}),
+            ('device-2', 'GET', '/valve', {'params': {'version': 0, 'ack': 0}}),
+            ('device-1', 'POST', '/flow', {'json': {'volume': 1.5, 'duration': 10}}),
+            ('device-2', 'POST', '/flow/batch', {'json': {'records': [{'volume': 2, 'duration': 10}] * 2}})
+        ])
+        self.assertEqual([resp.status_code for resp in responses], [200, 304, 200, 200])
+        self.assertEqual(sorted(self.stub.requests), [('POST', '/gateway/flow'), ('POST', '/gateway/valve')])
+        self.assertEqual(sorted((ack['device'], ack['version']) for ack in self.stub.device_acks),
+                         [('device-1', 1), ('device-2', 0)])
+        self.assertEqual(sorted(record['device'] for record in self.stub.flow_records),
+                         ['device-1', 'device-2', 'device-2'])
+
+    def test_4_server_down(self):
+        self.device_request('device-1', 'GET', '/valve')
+        TestUtils.configure_server_down()
+        resp = self.device_request('device-1', 'POST', '/flow', json={'volume': 1.5, 'duration': 10})
+        self.assertEqual(resp.status_code, 502)
+        self.assertFalse(FlowSensor.read_send_result(resp, 'flow data'))
+        self.assertEqual(self.device_request('device-1', 'POST', '/valve', json={'state': 1}).status_code, 502)
+        self.assertEqual(self.device_request('device-1', 'GET', '/valve').status_code, 503)
+        TestUtils.configure_stub_server(self.stub)
+        self.assertEqual(self.device_request('device-1', 'POST', '/valve', json={'state': 1}).status_code, 200)
+        self.assertEqual(self.device_request('device-1', 'GET', '/valve').status_code, 200)
+
+    def test_5_invalid_requests(self):
+        resp = requests.get('http://localhost:%d/valve' % self.gateway.port, timeout=10)
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(self.device_request('unknown-1', 'GET', '/valve').status_code, 401)
+        self.assertEqual(self.device_request('device-1', 'POST', '/flow', json={'volume': -1}).status_code, 400)
+        self.assertEqual(self.device_request('device-1', 'GET', '/zones').status_code, 404)
+        for wait in ['soon', 'nan', -1]:
+            resp = self.device_request('device-1', 'GET', '/valve', params={'wait': wait, 'state': 0})
+            self.assertEqual(resp.status_code, 400)
+        connection = http.client.HTTPConnection('localhost', self.gateway.port, timeout=10)
+        connection.putrequest('POST', '/flow')
+        connection.putheader('Authorization', 'Basic ' + base64.b64encode(b'API_KEY:device-1').decode('ascii'))
+        connection.putheader('Content-Length', 'many')
+        connection.endheaders()
+        resp = connection.getresponse()
+        self.assertEqual((resp.status, resp.getheader('Connection')), (400, 'close'))
+        connection.close()
+
+    # Requests of the zone and schedule modes are passed through to the server with the credentials of the device
+    def test_6_pass_through(self):
+        device = config['PRODUCT_KEY']
+        self.stub.set_zone_state(1, pins.HIGH)
+        resp = self.device_request(device, 'GET', '/zones/valve')
+        self.assertEqual(resp.json(), {'zones': [{'zone': 1, 'state': pins.HIGH}], 'version': 1})
+        self.assertEqual(self.device_request(device, 'GET', '/zones/valve', params={'version': 1}).status_code, 304)
+        self.assertEqual(self.device_request(device, 'POST', '/zones/flow',
+                                             json={'zones': [{'zone': 1, 'volume': 2, 'duration': 10}]}).status_code,
+                         200)
+        self.assertEqual(self.device_request(device, 'GET', '/schedule').json(), {'version': 0, 'entries': []})
+        self.assertEqual(self.device_request(device, 'POST', '/schedule/runs', json={'runs': [{}]}).status_code, 400)
+        self.assertEqual(self.device_request('device-1', 'GET', '/zones/valve').status_code, 401)
+        self.assertEqual(self.stub.flow_records, [{'zone': 1, 'volume': 2, 'duration': 10}])
+        # The devices are not synced as single valve devices
+        self.assertEqual(self.gateway.valves, {})
+        TestUtils.configure_server_down()
+        self.assertEqual(self.device_request(device, 'GET', '/schedule').status_code, 502)
+
+    # Invalid valve syncs from the server and failing sync cycles do not stop the sync loop
+    def test_7_sync_failures(self):
+        self.assertEqual(self.device_request('device-1', 'GET', '/valve').status_code, 200)
+        for payload in [{'devices': 'all'}, {'devices': [1]}, {'devices': [{'valve': {}}]}, [],
+                        {'devices': [{'device': 'device-1', 'valve': 1}]}]:
+            resp = unittest.mock.Mock(status_code=200, json=unittest.mock.Mock(return_value=payload))
+            with unittest.mock.patch.object(SprinklerApi.ApiClient, 'request', return_value=resp):
+                self.assertIsNone(Gateway.Gateway.sync_device_valves([], []))
+        failed, synced = threading.Event(), threading.Event()
+
+        def sync_cycle():
+            if not failed.is_set():
+                failed.set()
+                raise RuntimeError('Sync failed')
+            synced.set()
+
+        with unittest.mock.patch.object(self.gateway, 'sync_cycle', side_effect=sync_cycle):
+            self.gateway.wakeup.set()
+            self.assertTrue(failed.wait(5))
+            self.gateway.wakeup.set()
+            self.assertTrue(synced.wait(5))
+        self.assertTrue(self.gateway.thread.is_alive())
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,13 +1,77 @@
+import importlib
+import importlib.util
+import logging
+import os
+import sys
+import time
+
 from SprinklerConfig import config
 
+logger = logging.getLogger(__name__)
+
+# Seconds each lazily imported module took to import on first use
+import_times = {}
 
-# Computes the complete server API base url from config
-def get_server_api_base():
+
+# Computes the complete server API base url from config, or from the given settings such as a config snapshot
+def get_server_api_base(settings=config):
     url = ''
-    if config['SERVER_DNS']:
-        url += config['SERVER_DNS']
+    if settings['SERVER_DNS']:
+        url += settings['SERVER_DNS']
     else:
-        url += config['SERVER_PROTOCOL'] + config['SERVER_IP']
-        if config['SERVER_PORT']:
-            url += ':' + str(config['SERVER_PORT'])
+        url += settings['SERVER_PROTOCOL'] + settings['SERVER_IP']
+        if settings['SERVER_PORT']:
+            url += ':' + str(settings['SERVER_PORT'])
     return url
+
+
+# Converts a path relative to the src directory to an absolute path
+def get_abs_path(path):
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(dir_path, path)
+
+
+# Stands in for a module that is only imported when one of its attributes is first used
+# Keeps heavy modules such as requests and numpy out of the startup path until they are actually needed
+class LazyModule(object):
+    def __init__(self, name):
+        self.__dict__['__name__'] = name
+
+    def __getattr__(self, attr):
+        name = self.__dict__['__name__']
+        module = sys.modules.get(name)
+        if module is None:
+            # The import lock makes threads that use the module at the same time wait for a single import
+            start_time = time.perf_counter()
+            module = importlib.import_module(name)
+            if name not in import_times:
+                import_times[name] = time.perf_counter() - start_time
+                logger.debug('Imported %s on first use in %.1f ms', name, import_times[name] * 1000)
+        return getattr(module, attr)
+
+    def __setattr__(self, attr, value):
+        setattr(importlib.import_module(self.__dict__['__name__']), attr, value)
+
+
+# Returns the module if it has already been imported, otherwise a stand-in that imports it on first use
+# Returns None if the module is not installed, same as an optional import that failed
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    if importlib.util.find_spec(name) is None:
+        return None
+    return LazyModule(name)
+
+
+# Runs the steps of a process of the components and returns its result
+# The steps are a generator that yields the server calls to make as (name, args) and is sent their results, so that the
+# threaded and the asyncio runtime share the logic of the processes and only make the calls their own way. The calls
+# are looked up by name on calls
+def run_steps(steps, calls):
+    result = None
+    try:
+        while True:
+            name, args = steps.send(result)
+            result = getattr(calls, name)(*args)
+    except StopIteration as e:
+        return e.value
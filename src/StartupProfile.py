@@ -0,0 +1,95 @@
+# Timing of the startup of the client
+# Records how long each startup phase takes, the modules imported lazily on first use, and the time from the start of
+# the process until milestones such as the first valve poll, when the valve has become controllable from the server.
+# The time before the profile is started, for starting the interpreter and loading the config, is reported as the
+# interpreter phase. Kept free of heavy imports, as it is imported first
+import contextlib
+import logging
+import os
+import time
+
+import SprinklerUtils
+
+logger = logging.getLogger(__name__)
+
+SprinklerMetrics = SprinklerUtils.lazy_import('SprinklerMetrics')
+
+
+# Seconds the process has been running, e.g. for starting the interpreter. Linux only. None if not known
+def process_age():
+    try:
+        with open('/proc/self/stat', 'r') as stat_file:
+            # The process name may contain spaces, so the fields are counted from its closing parenthesis
+            start_ticks = int(stat_file.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime', 'r') as uptime_file:
+            uptime = float(uptime_file.read().split()[0])
+        return max(uptime - start_ticks / os.sysconf('SC_CLK_TCK'), 0.0)
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+
+class StartupProfile(object):
+    def __init__(self, clock=time.monotonic, initial_age=None):
+        self.clock = clock
+        self.start_time = clock()
+        # Seconds before the profile was started
+        self.initial_age = initial_age
+        # Durations of the phases in the order they ran
+        self.phases = []
+        # Seconds from the start of the process until each milestone
+        self.milestones = {}
+
+    # Seconds since the start of the process, or since the profile was started if that is not known
+    def elapsed(self):
+        return self.clock() - self.start_time + (self.initial_age or 0.0)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start_time = self.clock()
+        try:
+            yield
+        finally:
+            self.phases.append((name, self.clock() - start_time))
+
+    # Records the first time a milestone is reached. Only the first call for a milestone has an effect
+    def mark(self, milestone):
+        if milestone in self.milestones:
+            return
+        self.milestones[milestone] = self.elapsed()
+        logger.info('Startup milestone %s reached after %.3f seconds. Imported on first use (ms): %s', milestone,
+                    self.milestones[milestone], ' '.join('%s=%.1f' % (name, duration * 1000) for name, duration in
+                                                         sorted(SprinklerUtils.import_times.items())) or 'none')
+        SprinklerMetrics.STARTUP_SECONDS.labels('milestone', milestone).set(self.milestones[milestone])
+
+    def summary(self):
+        return {
+            'process_age': self.initial_age,
+            'phases': dict(self.phases),
+            'lazy_imports': dict(SprinklerUtils.import_times),
+            'milestones': dict(self.milestones)
+        }
+
+    # Logs the phases and exports them as metrics
+    def report(self):
+        logger.info('Startup phases (ms): %s', ' '.join(
+            '%s=%.1f' % (name, duration * 1000) for name, duration in
+            ([('interpreter', self.initial_age)] if self.initial_age is not None else []) + self.phases))
+        for name, duration in self.phases:
+            SprinklerMetrics.STARTUP_SECONDS.labels('phase', name).set(duration)
+
+
+profile = None
+
+
+# Returns the startup profile of the process, starting it on first use
+def get_profile():
+    global profile
+    if profile is None:
+        profile = StartupProfile(initial_age=process_age())
+    return profile
+
+
+# Records a startup milestone if the startup is being profiled
+def mark(milestone):
+    if profile is not None:
+        profile.mark(milestone)
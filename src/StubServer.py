@@ -0,0 +1,332 @@
+import base64
+import collections
+import gzip
+import json
+import logging
+import random
+import socket
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+logger = logging.getLogger(__name__)
+
+# A request received by the stub server, with the HTTP status it was answered with (None if the connection was dropped)
+RecordedRequest = collections.namedtuple('RecordedRequest', ['method', 'path', 'query', 'data', 'status', 'time'])
+
+
+# Returns a localhost port with nothing listening on it, to emulate a server that is down
+def unused_port(host='localhost'):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+# Handles the requests of the sprinkler server API
+class StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, fmt, *args):
+        logger.debug('Stub server: ' + fmt, *args)
+
+    def do_GET(self):
+        self.handle_api('GET')
+
+    def do_POST(self):
+        self.handle_api('POST')
+
+    def handle_api(self, method):
+        stub = self.server.stub
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        stub.count_bytes(length)
+        if body and self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        url = urlsplit(self.path)
+        query = dict(parse_qsl(url.query))
+        try:
+            data = json.loads(body.decode('utf8')) if body else None
+        except ValueError:
+            data = body
+        status, resp = self.respond(stub, method, url.path, query, data)
+        stub.record_request(method, url.path, query, data, status)
+        if status is None:
+            # Dropping the connection without a response looks like a network failure to the client
+            self.close_connection = True
+            return
+        self.send_json(status, resp)
+
+    def respond(self, stub, method, path, query, data):
+        stub.simulate_latency()
+        faulty, status = stub.take_fault(method, path)
+        if faulty:
+            return status, {'error': 'Injected fault'}
+        if not stub.is_authorized(self.headers.get('Authorization')):
+            return 401, {'error': 'Unauthorized'}
+        route = stub.routes.get((method, path))
+        if route is None:
+            return 404, {'error': 'Not found'}
+        if isinstance(data, bytes):
+            return 400, {'error': 'Invalid JSON'}
+        return route(data, query)
+
+    def send_json(self, status, resp):
+        body = json.dumps(resp).encode('utf8') if status != 304 else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# Local stand-in for the sprinkler server, for tests and benchmarks
+# Implements the valve and flow API on localhost and keeps the received data in memory.
+# Every response can be delayed by a configurable latency, and faults (error statuses or dropped connections) can be
+# injected for the next requests to a route.
+class StubServer(object):
+    def __init__(self, product_key, host='localhost', port=0):
+        self.product_key = product_key
+        self.lock = threading.Lock()
+        self.valve_changed = threading.Condition(self.lock)
+        self.stopping = False
+        self.reset()
+        self.routes = {
+            ('GET', '/valve'): self.get_valve,
+            ('POST', '/valve'): self.post_valve,
+            ('POST', '/flow'): self.post_flow,
+            ('POST', '/flow/batch'): self.post_flow_batch,
+            ('GET', '/zones/valve'): self.get_zones_valve,
+            ('POST', '/zones/valve'): self.post_zones_valve,
+            ('POST', '/zones/flow'): self.post_zones_flow,
+            ('GET', '/schedule'): self.get_schedule,
+            ('POST', '/schedule/runs'): self.post_schedule_runs,
+            ('POST', '/gateway/valve'): self.post_gateway_valve,
+            ('POST', '/gateway/flow'): self.post_gateway_flow
+        }
+        self.httpd = ThreadingHTTPServer((host, port), StubRequestHandler)
+        self.httpd.stub = self
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    # Starts serving in a background thread
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='StubServerThread')
+        self.thread.daemon = True
+        self.thread.start()
+        logger.debug('Stub server has been started at port %d', self.port)
+        return self
+
+    # Stops serving and closes the socket
+    def stop(self):
+        with self.lock:
+            self.stopping = True
+            self.valve_changed.notify_all()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+        logger.debug('Stub server has been stopped')
+
+    # Clears the received data, the injected faults and the latency and restores the initial valve state
+    def reset(self):
+        with self.lock:
+            self.valve_info = {'id': 1, 'state': 0, 'version': 0}
+            self.valve_state_time = None
+            # Versions acknowledged by the client, with a POST or along with a fetch
+            self.valve_acks = []
+            self.zone_states = {}
+            self.zones_version = 0
+            # Valve info of the devices behind a gateway by product key, and the acknowledgements sent for them
+            self.device_valves = {}
+            self.device_acks = []
+            self.schedule = {'version': 0, 'entries': []}
+            self.schedule_runs = []
+            self.flow_records = []
+            # (method, path) of each request, for quick assertions. request_log keeps the full requests
+            self.requests = []
+            self.request_log = []
+            # Bytes of the request bodies as sent, before decompression
+            self.bytes_received = 0
+            self.faults = {}
+            self.latency = 0.0
+            self.latency_jitter = 0.0
+            self.random = random.Random(0)
+            self.valve_changed.notify_all()
+
+    # Delays every response by latency seconds, varied uniformly by up to +/- jitter seconds
+    def set_latency(self, latency, jitter=0.0):
+        with self.lock:
+            self.latency = latency
+            self.latency_jitter = jitter
+
+    # Answers the next count requests to the route with the given status, or drops the connection if status is None
+    def inject_fault(self, method, path, status=500, count=1):
+        with self.lock:
+            self.faults.setdefault((method, path), collections.deque()).extend([status] * count)
+
+    # Returns whether a fault is pending for a request to the route, and its status
+    def take_fault(self, method, path):
+        with self.lock:
+            faults = self.faults.get((method, path))
+            if not faults:
+                return False, None
+            return True, faults.popleft()
+
+    def simulate_latency(self):
+        with self.lock:
+            latency = self.latency + self.random.uniform(-self.latency_jitter, self.latency_jitter)
+        if latency > 0:
+            time.sleep(latency)
+
+    def count_bytes(self, length):
+        with self.lock:
+            self.bytes_received += length
+
+    def record_request(self, method, path, query, data, status):
+        with self.lock:
+            self.requests.append((method, path))
+            self.request_log.append(RecordedRequest(method, path, query, data, status, time.time()))
+
+    def is_authorized(self, header):
+        expected = base64.b64encode(('API_KEY:%s' % self.product_key).encode('utf8')).decode('ascii')
+        return header == 'Basic ' + expected
+
+    # Sets the valve state that the server expects the client to apply, bumps its version and wakes up pending long
+    # polls
+    def set_valve_state(self, state):
+        with self.lock:
+            self.valve_info = dict(self.valve_info, state=state, version=self.valve_info['version'] + 1)
+            self.valve_state_time = time.time()
+            self.valve_changed.notify_all()
+
+    # Returns the valve info unless the client already has its version. A long poll (wait and state given) is held
+    # until the version (or the state if no version is given) differs or wait elapses
+    def get_valve(self, _data, query):
+        with self.lock:
+            if 'ack' in query:
+                self.valve_acks.append(int(query['ack']))
+            if 'wait' in query and 'state' in query:
+                key = 'version' if 'version' in query else 'state'
+                self.valve_changed.wait_for(
+                    lambda: self.stopping or str(self.valve_info[key]) != query[key], float(query['wait']))
+            if query.get('version') == str(self.valve_info['version']):
+                return 304, None
+            return 200, self.valve_info
+
+    def post_valve(self, data, _query):
+        if not isinstance(data, dict) or data.get('state') not in (0, 1):
+            return 400, {'error': 'Invalid valve info'}
+        with self.lock:
+            self.valve_acks.append(data.get('version'))
+        return 200, {}
+
+    @staticmethod
+    def is_valid_flow(data):
+        return isinstance(data, dict) and all(
+            isinstance(data.get(key), (int, float)) and data[key] >= 0 for key in ('volume', 'duration'))
+
+    def post_flow(self, data, _query):
+        if not StubServer.is_valid_flow(data):
+            return 400, {'error': 'Invalid flow info'}
+        with self.lock:
+            self.flow_records.append(data)
+        return 200, {}
+
+    def post_flow_batch(self, data, _query):
+        records = data.get('records') if isinstance(data, dict) else None
+        if not isinstance(records, list) or not all(StubServer.is_valid_flow(record) for record in records):
+            return 400, {'error': 'Invalid flow records'}
+        with self.lock:
+            self.flow_records.extend(records)
+        return 200, {'saved': len(records)}
+
+    # Sets the valve state of a zone and bumps the version of the zone valve states
+    def set_zone_state(self, zone, state):
+        with self.lock:
+            self.zone_states[zone] = state
+            self.zones_version += 1
+
+    def get_zones_valve(self, _data, query):
+        with self.lock:
+            if query.get('version') == str(self.zones_version):
+                return 304, None
+            zones = [{'zone': zone, 'state': state} for zone, state in sorted(self.zone_states.items())]
+            return 200, {'zones': zones, 'version': self.zones_version}
+
+    def post_zones_valve(self, data, _query):
+        zones = data.get('zones') if isinstance(data, dict) else None
+        if not isinstance(zones, list) or not all(isinstance(zone, dict) and zone.get('state') in (0, 1)
+                                                  for zone in zones):
+            return 400, {'error': 'Invalid zone valve info'}
+        return 200, {}
+
+    def post_zones_flow(self, data, _query):
+        zones = data.get('zones') if isinstance(data, dict) else None
+        if not isinstance(zones, list) or not all(StubServer.is_valid_flow(zone) and 'zone' in zone for zone in zones):
+            return 400, {'error': 'Invalid zone flow info'}
+        with self.lock:
+            self.flow_records.extend(zones)
+        return 200, {}
+
+    # Sets the valve state of a device behind a gateway and bumps its version
+    def set_device_valve_state(self, device, state):
+        with self.lock:
+            valve_info = self.device_valves.get(device, {'id': 1, 'state': 0, 'version': 0})
+            self.device_valves[device] = dict(valve_info, state=state, version=valve_info['version'] + 1)
+
+    # Records the acknowledgements of the devices and returns the valve info of those whose version has changed
+    # Devices whose product key starts with unknown are rejected
+    def post_gateway_valve(self, data, _query):
+        devices = data.get('devices') if isinstance(data, dict) else None
+        acks = data.get('acks') if isinstance(data, dict) else None
+        if not isinstance(devices, list) or not isinstance(acks, list) or \
+                not all(isinstance(ack, dict) and 'device' in ack for ack in acks):
+            return 400, {'error': 'Invalid device valve sync'}
+        entries = []
+        with self.lock:
+            self.device_acks.extend(acks)
+            for device in devices:
+                if device['device'].startswith('unknown'):
+                    entries.append({'device': device['device'], 'error': 'Unknown device'})
+                    continue
+                valve_info = self.device_valves.setdefault(device['device'], {'id': 1, 'state': 0, 'version': 0})
+                if device.get('version') != valve_info['version']:
+                    entries.append({'device': device['device'], 'valve': valve_info})
+        return 200, {'devices': entries}
+
+    def post_gateway_flow(self, data, _query):
+        records = data.get('records') if isinstance(data, dict) else None
+        if not isinstance(records, list) or not all(StubServer.is_valid_flow(record) and 'device' in record
+                                                    for record in records):
+            return 400, {'error': 'Invalid device flow records'}
+        with self.lock:
+            self.flow_records.extend(records)
+        return 200, {'saved': len(records)}
+
+    # Sets the irrigation schedule and bumps its version
+    def set_schedule(self, entries):
+        with self.lock:
+            self.schedule = {'version': self.schedule['version'] + 1, 'entries': entries}
+
+    # Returns the schedule unless the client already has its version
+    def get_schedule(self, _data, query):
+        with self.lock:
+            if query.get('version') == str(self.schedule['version']):
+                return 304, None
+            return 200, self.schedule
+
+    def post_schedule_runs(self, data, _query):
+        runs = data.get('runs') if isinstance(data, dict) else None
+        if not isinstance(runs, list) or not all(isinstance(run, dict) and 'planned_start' in run for run in runs):
+            return 400, {'error': 'Invalid schedule runs'}
+        with self.lock:
+            self.schedule_runs.extend(runs)
+        return 200, {}
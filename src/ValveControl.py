@@ -1,27 +1,49 @@
 import logging
-import requests
-import threading
-import time
-
-from requests.auth import HTTPBasicAuth
 
+import Clock
+import ConfigSnapshot
+import EventJournal
+import Scheduler
+import SprinklerMetrics
 import SprinklerUtils
+import StartupProfile
+from AdaptivePolling import AdaptivePollScheduler
 from GPIOWrapper import pins
-from SprinklerConfig import config
 
 logger = logging.getLogger(__name__)
 
+# Imported on first use, so that the valve is set up before requests is loaded
+SprinklerApi = SprinklerUtils.lazy_import('SprinklerApi')
+
+# Seconds a stop waits for an aborted long poll to end
+LONG_POLL_STOP_TIMEOUT = 0.5
+
 
 # Operates the valve directly by changing the state of the GPIO pin
-# Starts in a separate thread for valve updates
-class Valve(object):
-    def __init__(self):
-        pins.setup(config['VALVE_PIN'], pins.OUT)
+# Starts in a separate thread for valve updates. Each valve update process reads its settings from one config snapshot
+class Valve(ConfigSnapshot.SnapshotBound):
+    def __init__(self, pin=None, flow_sensor=None):
+        settings = self.bind()
+        self.pin = settings['VALVE_PIN'] if pin is None else pin
+        self.clock = Clock.get_clock()
+        pins.setup(self.pin, pins.OUT)
         self.state = pins.LOW
-        pins.output(config['VALVE_PIN'], pins.LOW)
-        logger.debug("Valve has been configured at pin %d and state %d", config['VALVE_PIN'], self.state)
+        pins.output(self.pin, pins.LOW)
+        SprinklerMetrics.VALVE_STATE.labels(self.pin).set(self.state)
+        logger.debug("Valve has been configured at pin %d and state %d", self.pin, self.state)
         self.process_loop = None
         self.active = False
+        self.last_valve_info = None
+        # Last valve info applied to the valve. Its version is sent with the fetches so that the server can answer
+        # that nothing has changed instead of sending the valve info again
+        self.known_valve_info = None
+        # Original state and known valve info of an update whose acknowledgement is carried by the next fetch
+        self.pending_ack = None
+        self.poll_scheduler = None
+        if settings['VALVE_POLL_ADAPTIVE']:
+            self.poll_scheduler = AdaptivePollScheduler(flow_sensor, clock=self.clock.time)
+        if flow_sensor is not None:
+            flow_sensor.attach_valve(self)
 
     # Updates the state of the valve
     def update(self, state):
@@ -35,9 +57,12 @@ class Valve(object):
         else:
             logger.debug("Valve state needs to be updated")
             try:
-                pins.output(config['VALVE_PIN'], state)
-                self.state = state
+                pins.output(self.pin, state)
+                previous_state, self.state = self.state, state
                 logger.info("Valve state updated successfully")
+                EventJournal.record(EventJournal.VALVE_STATE, state, previous_state, self.pin)
+                SprinklerMetrics.VALVE_STATE.labels(self.pin).set(state)
+                SprinklerMetrics.VALVE_STATE_CHANGES.labels(self.pin).inc()
             except Exception:
                 logger.exception('Failed to update valve state: Error occurred while updating')
                 return False
@@ -45,14 +70,37 @@ class Valve(object):
         return True
 
     # Updates the state of the valve by communicating with the server
-    def valve_update_process(self):
+    # If wait is given, the server holds the request for up to wait seconds until the valve state changes
+    # The server is only notified if the state has changed, either right away or with the next fetch
+    def valve_update_process(self, wait=None):
+        return SprinklerUtils.run_steps(self.valve_update_steps(wait), Valve)
+
+    # Steps of the valve update process, yielding the server calls. See SprinklerUtils.run_steps
+    def valve_update_steps(self, wait=None):
+        self.bind()
         orig_state = self.state
         logger.debug('Starting valve update process. Orig state: %d', orig_state)
+        valve_info = yield 'get_valve_info', (wait, orig_state, self.known_valve_info, self.pending_ack_version())
+        if not self.complete_pending_ack(valve_info is not None):
+            return False
+        if not self.apply_valve_info(valve_info, wait):
+            return False
+        if not self.needs_ack(valve_info, orig_state):
+            return True
+        send_success = yield 'send_success', (valve_info,)
+        return self.complete_update(send_success, orig_state, valve_info)
 
-        valve_info = Valve.get_valve_info()
+    # Applies the valve info fetched from the server to the valve
+    def apply_valve_info(self, valve_info, wait=None):
+        self.last_valve_info = valve_info
         if valve_info is None:
             logger.error('Update loop failed as valve info was not fetched')
             return False
+        StartupProfile.mark('first_valve_poll')
+
+        if wait and not self.active:
+            logger.debug('Valve was stopped while waiting for valve info. Discarding %s', valve_info)
+            return False
 
         try:
             next_state = valve_info['state']
@@ -64,8 +112,41 @@ class Valve(object):
         if not update_success:
             logger.error('Update loop failed as valve could not be updated')
             return False
+        return True
+
+    # Returns whether the server has to be notified of the applied valve info now
+    # Nothing is sent if the state is unchanged. In the piggyback mode the acknowledgement of a versioned valve info is
+    # deferred to the next fetch instead
+    def needs_ack(self, valve_info, orig_state):
+        if self.state == orig_state:
+            self.known_valve_info = valve_info
+            return False
+        if self.settings['VALVE_ACK_MODE'] == 'piggyback' and Valve.valve_version(valve_info) is not None:
+            logger.debug('Acknowledging valve info version %s with the next fetch', valve_info['version'])
+            self.pending_ack = (orig_state, self.known_valve_info)
+            self.known_valve_info = valve_info
+            return False
+        return True
 
-        send_success = Valve.send_success(valve_info)
+    # Version acknowledged by the next fetch, if any
+    def pending_ack_version(self):
+        return Valve.valve_version(self.known_valve_info) if self.pending_ack is not None else None
+
+    # Completes the update whose acknowledgement was carried by a fetch, once it is known whether the fetch reached
+    # the server. Returns whether the valve update process can go on
+    def complete_pending_ack(self, delivered):
+        if self.pending_ack is None:
+            return True
+        orig_state, orig_valve_info = self.pending_ack
+        self.pending_ack = None
+        if not delivered:
+            self.known_valve_info = orig_valve_info
+        return self.complete_update(delivered, orig_state)
+
+    # Completes the valve update process once the server has been notified of the update
+    # Reverts to the original state if the server could not be notified. The known valve info is only advanced to
+    # valve_info once notified, so that a reverted update is fetched and applied again instead of answered as unchanged
+    def complete_update(self, send_success, orig_state, valve_info=None):
         if not send_success:
             logger.error(
                 'Valve has been updated but server could not be communicated. Hence reverting to original state %d',
@@ -77,45 +158,131 @@ class Valve(object):
             logger.info('Reverted valve state to original state %d', orig_state)
             return False
 
+        if valve_info is not None:
+            self.known_valve_info = valve_info
         logger.debug('Valve update process was successful')
         return True
 
+    # Waits for the next valve command with a long poll and applies it as soon as the server answers
+    # Returns the interval until the next long poll
+    def long_poll_cycle(self):
+        return SprinklerUtils.run_steps(self.poll_steps(long_poll=True), Valve)
+
+    # Polls the server once. Returns the interval until the next poll
+    def poll_cycle(self):
+        return SprinklerUtils.run_steps(self.poll_steps(), Valve)
+
+    # Steps of a poll or a long poll of the server, yielding the server calls
+    # Returns the seconds from the start of this poll until the next one, which both runtimes wait for
+    def poll_steps(self, long_poll=False):
+        orig_state = self.state
+        start_time = self.clock.time()
+        if long_poll:
+            success = yield from self.valve_update_steps(wait=self.bind()['VALVE_LONG_POLL_TIMEOUT'])
+            interval = self.long_poll_interval(success, orig_state)
+        else:
+            success = yield from self.valve_update_steps()
+            interval = self.next_poll_interval(orig_state)
+        Valve.record_poll(success, start_time, interval)
+        logger.debug('Valve update completed with status %s. Next poll in %.2f second(s)', success,
+                     max(start_time + interval - self.clock.time(), 0))
+        return interval
+
+    # Seconds from the start of a long poll until the next one: none after a state change or after the server has held
+    # the request. If the request failed or the server answered early without a change (e.g. it does not support long
+    # polls), the poll interval, so that this falls back to regular polling
+    def long_poll_interval(self, success, orig_state):
+        if success and self.state != orig_state:
+            return 0
+        return self.settings['VALVE_STATE_POLL_INTERVAL']
+
+    # Records the outcome of a valve update process started at start_time in the event journal and the metrics
+    @staticmethod
+    def record_poll(success, start_time, delay):
+        duration = Clock.now() - start_time
+        EventJournal.record(EventJournal.VALVE_POLL, int(bool(success)), duration * 1000, delay)
+        SprinklerMetrics.VALVE_UPDATES.labels('success' if success else 'failure').inc()
+        SprinklerMetrics.VALVE_UPDATE_DURATION.observe(duration)
+
+    # Seconds to wait before the next poll after a valve update process
+    def next_poll_interval(self, orig_state):
+        if self.poll_scheduler is None:
+            return self.settings['VALVE_STATE_POLL_INTERVAL']
+        return self.poll_scheduler.next_interval(self.last_valve_info, self.state, self.state != orig_state,
+                                                 self.settings)
+
     # Starts the valve state update client
     def start(self):
-        def keep_updating():
-            logger.debug('Starting process loop for Valve')
-            while self.active:
-                success = self.valve_update_process()
-                logger.debug('Update loop completed with status %s. Sleeping for %d second(s)', success,
-                             config['VALVE_STATE_POLL_INTERVAL'])
-                time.sleep(config['VALVE_STATE_POLL_INTERVAL'])
-            logger.debug('Ending process loop for Valve')
-
-        logger.info("Starting Valve")
+        settings = self.bind()
+        long_poll = settings['VALVE_COMMAND_MODE'] == 'long_poll'
+        logger.info("Starting Valve in %s mode", settings['VALVE_COMMAND_MODE'])
         self.active = True
-        self.process_loop = threading.Thread(target=keep_updating, name='ValveThread')
-        self.process_loop.start()
+        # A pending long poll must not keep the process alive
+        self.process_loop = Scheduler.get_scheduler().schedule(
+            'Valve', self.long_poll_cycle if long_poll else self.poll_cycle,
+            lambda: self.settings['VALVE_STATE_POLL_INTERVAL'], settings['LOOP_MISSED_TICKS'],
+            settings['VALVE_POLL_JITTER'], daemon=long_poll)
         logger.info("Valve has been started")
 
     # Stops the valve state update client
+    # A pending long poll is aborted, and not waited for longer than LONG_POLL_STOP_TIMEOUT. Its result is discarded
     def stop(self):
         logger.info("Stopping Valve")
         self.active = False
-        self.process_loop.join()
+        self.process_loop.cancel()
+        if self.process_loop.thread.daemon:
+            SprinklerApi.abort_request(self.process_loop.thread)
+            self.process_loop.join(LONG_POLL_STOP_TIMEOUT)
+        else:
+            self.process_loop.join()
         self.state = pins.LOW
-        pins.output(config['VALVE_PIN'], pins.LOW)
+        pins.output(self.pin, pins.LOW)
         logger.info("Valve has been stopped")
 
     # Fetches the latest valve info from the server
+    # If wait is given, asks the server to hold the request until the state differs from known_state, or the version
+    # from the one of known_info. Returns known_info if the server has answered that it is unchanged
+    # ack_version acknowledges the update to that version along with the fetch
     @staticmethod
-    def get_valve_info():
+    def get_valve_info(wait=None, known_state=None, known_info=None, ack_version=None):
         logger.debug('Fetching valve state from serve')
-        api = SprinklerUtils.get_server_api_base() + '/valve'
+        request_args = Valve.valve_info_request_args(wait, known_state, Valve.valve_version(known_info), ack_version)
         try:
-            resp = requests.get(api, auth=HTTPBasicAuth('API_KEY', config['PRODUCT_KEY']))
-        except requests.ConnectionError:
+            resp = SprinklerApi.get_api_client().get('/valve', **request_args)
+        except SprinklerApi.REQUEST_ERRORS:
             logger.exception("Error occurred while fetching valve state from server")
             return None
+        return Valve.read_valve_info(resp, known_info)
+
+    # Request arguments for fetching the valve info
+    @staticmethod
+    def valve_info_request_args(wait, known_state, version=None, ack_version=None):
+        params = {}
+        if version is not None:
+            params['version'] = version
+        if ack_version is not None:
+            params['ack'] = ack_version
+        if not wait:
+            return {'params': params} if params else {}
+        params.update(wait=wait, state=known_state)
+        settings = ConfigSnapshot.current()
+        return {
+            'params': params,
+            'timeout': (settings['SERVER_CONNECT_TIMEOUT'], wait + settings['SERVER_READ_TIMEOUT']),
+            'deadline': wait + settings['SERVER_CALL_DEADLINE']
+        }
+
+    # Version of the valve info assigned by the server, or None if the server does not version the valve state
+    @staticmethod
+    def valve_version(valve_info):
+        return valve_info.get('version') if valve_info is not None else None
+
+    # Reads the valve info from the server response. Not modified means that known_info is still current
+    @staticmethod
+    def read_valve_info(resp, known_info=None):
+        if resp.status_code == 304 and known_info is not None:
+            logger.debug('Valve info version %s is up to date', known_info.get('version'))
+            return known_info
         if resp.status_code == 200:
             valve_info = resp.json()
             logger.debug('Fetched valve info from server: %s', valve_info)
@@ -128,13 +295,17 @@ class Valve(object):
     # Notifies the server regarding the latest valve update
     @staticmethod
     def send_success(valve_info):
-        api = SprinklerUtils.get_server_api_base() + '/valve'
         logger.debug('Sending valve state update success to server: %s', valve_info)
         try:
-            resp = requests.post(api, json=valve_info, auth=HTTPBasicAuth('API_KEY', config['PRODUCT_KEY']))
-        except requests.ConnectionError:
+            resp = SprinklerApi.get_api_client().post('/valve', json=valve_info)
+        except SprinklerApi.REQUEST_ERRORS:
             logger.exception("Error occurred while sending valve state update success to server")
             return None
+        return Valve.read_send_success(resp)
+
+    # Reads the result of notifying the valve update from the server response
+    @staticmethod
+    def read_send_success(resp):
         if resp.status_code == 200:
             logger.debug('Sent valve state update success to server successfully')
             return True
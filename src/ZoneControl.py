@@ -0,0 +1,210 @@
+import logging
+
+import ConfigSnapshot
+import Scheduler
+import SprinklerUtils
+from FlowSensorControl import FlowSensor
+from GPIOWrapper import pins
+from ValveControl import Valve
+
+logger = logging.getLogger(__name__)
+
+SprinklerApi = SprinklerUtils.lazy_import('SprinklerApi')
+
+
+# A zone is a valve with its own flow sensor
+class Zone(object):
+    def __init__(self, zone_id, valve_pin, flow_sensor_pin):
+        self.id = zone_id
+        self.valve = Valve(valve_pin)
+        # Records of all zones are uploaded together by the zone manager, hence the flow outbox is not used
+        self.flow_sensor = FlowSensor(flow_sensor_pin, outbox_file='', upload_mode='single')
+        self.flow_sensor.attach_valve(self.valve)
+        logger.debug('Zone %s has been configured with valve pin %d and flow sensor pin %d', zone_id, valve_pin,
+                     flow_sensor_pin)
+
+
+# Operates several zones in one process
+# All valve states are fetched with a single request and the flow data of all zones is uploaded with a single request
+# per cycle, from one scheduled task each. All zones of a cycle read their settings from the same config snapshot
+class ZoneManager(ConfigSnapshot.SnapshotBound):
+    def __init__(self, zones_config=None):
+        zones_config = self.bind()['ZONES'] if zones_config is None else zones_config
+        self.zones = {}
+        for zone_config in zones_config:
+            if not ZoneManager.is_valid_zone_config(zone_config) or zone_config['ID'] in self.zones:
+                logger.error('Ignoring invalid or duplicate zone: %s', zone_config)
+                continue
+            zone = Zone(zone_config['ID'], zone_config['VALVE_PIN'], zone_config['FLOW_SENSOR_PIN'])
+            self.zones[zone.id] = zone
+        # Version of the zone valve states last applied, so that the server can answer that nothing has changed
+        self.valve_version = None
+        self.process_loops = []
+        self.active = False
+        logger.debug('Zone manager has been configured with %d zone(s)', len(self.zones))
+
+    # Whether a zone of the ZONES setting has a hashable ID and the pins of its valve and flow sensor
+    @staticmethod
+    def is_valid_zone_config(zone_config):
+        if not isinstance(zone_config, dict) or not isinstance(zone_config.get('ID'), (int, str)):
+            return False
+        return all(isinstance(zone_config.get(key), int) and not isinstance(zone_config[key], bool)
+                   for key in ('VALVE_PIN', 'FLOW_SENSOR_PIN'))
+
+    # Zone a valve info from the server is meant for, or None if it does not name a zone of this manager
+    def find_zone(self, valve_info):
+        zone_id = valve_info.get('zone') if isinstance(valve_info, dict) else None
+        try:
+            return self.zones.get(zone_id)
+        except TypeError:
+            return None
+
+    # Updates the state of all valves by communicating with the server
+    # Only the valves whose state has changed are acknowledged. If the server could not be notified of the updates, all
+    # updated valves are reverted and the version is kept, so that the updates are fetched again
+    def valve_update_process(self):
+        logger.debug('Starting zone valve update process')
+        self.bind()
+        zones_valve = ZoneManager.get_zones_valve_info(self.valve_version)
+        if zones_valve is None:
+            logger.error('Zone update loop failed as valve info was not fetched')
+            return False
+        zones_info = zones_valve['zones']
+
+        applied = []
+        changed = []
+        for valve_info in zones_info:
+            zone = self.find_zone(valve_info)
+            if zone is None:
+                logger.warning('Ignoring valve info for unknown zone: %s', valve_info)
+                continue
+            orig_state = zone.valve.state
+            if zone.valve.apply_valve_info(valve_info):
+                applied.append(zone)
+                if zone.valve.state != orig_state:
+                    changed.append((zone, valve_info, orig_state))
+
+        results = [True]
+        if changed:
+            send_success = ZoneManager.send_zones_success([valve_info for _, valve_info, _ in changed])
+            results = [zone.valve.complete_update(send_success, orig_state) for zone, _, orig_state in changed]
+        else:
+            logger.debug('No valve has been updated')
+        success = len(applied) == len(zones_info) and all(results)
+        if success:
+            self.valve_version = zones_valve.get('version', self.valve_version)
+        return success
+
+    # Records the flow data of all zones and sends it to the server
+    def save_flow_process(self):
+        logger.debug('Starting zone save flow process')
+        settings = self.bind()
+        recorded = []
+        for zone in self.zones.values():
+            zone.flow_sensor.bind(settings)
+            recorded_data = zone.flow_sensor.prepare_flow_data()
+            if recorded_data is not None:
+                recorded.append((zone, recorded_data))
+        if not recorded:
+            return False
+        flow_infos = []
+        for zone, recorded_data in recorded:
+            flow_info = FlowSensor.flow_info(recorded_data['volume'], recorded_data['duration'],
+                                             recorded_data.get('rate'))
+            flow_info['zone'] = zone.id
+            flow_infos.append(flow_info)
+        send_success = ZoneManager.send_zones_flow_data(flow_infos)
+        results = [zone.flow_sensor.complete_save(send_success, recorded_data) for zone, recorded_data in recorded]
+        return all(results)
+
+    # Runs the valve update process once
+    def valve_cycle(self):
+        success = self.valve_update_process()
+        logger.debug('Zone valve update completed with status %s', success)
+
+    # Runs the save flow process once
+    def save_cycle(self):
+        success = self.save_flow_process()
+        logger.debug('Zone flow save completed with status %s', success)
+
+    # Starts the zones update client
+    def start(self):
+        logger.info("Starting Zone Manager")
+        settings = self.bind()
+        for zone in self.zones.values():
+            zone.valve.active = zone.flow_sensor.active = True
+            zone.flow_sensor.start_analytics()
+        self.active = True
+        scheduler = Scheduler.get_scheduler()
+        # In schedule mode the valves are operated by the schedule executor instead
+        if settings['VALVE_COMMAND_MODE'] != 'schedule':
+            self.process_loops.append(scheduler.schedule(
+                'ZoneValves', self.valve_cycle, lambda: self.settings['VALVE_STATE_POLL_INTERVAL'],
+                settings['LOOP_MISSED_TICKS'], settings['VALVE_POLL_JITTER']))
+        self.process_loops.append(scheduler.schedule(
+            'ZoneFlow', self.save_cycle, lambda: self.settings['FLOW_DATA_SAVE_INTERVAL'],
+            settings['LOOP_MISSED_TICKS'], settings['FLOW_DATA_SAVE_JITTER']))
+        logger.info("Zone Manager has been started")
+
+    # Stops the zones update client and closes all valves
+    def stop(self):
+        logger.info("Stopping Zone Manager")
+        self.active = False
+        for process_loop in self.process_loops:
+            process_loop.cancel()
+        for process_loop in self.process_loops:
+            process_loop.join()
+        self.process_loops = []
+        for zone in self.zones.values():
+            zone.flow_sensor.stop_analytics()
+            zone.valve.active = zone.flow_sensor.active = False
+            zone.valve.update(pins.LOW)
+        logger.info("Zone Manager has been stopped")
+
+    # Fetches the latest valve info of all zones from the server, with the version of the zone valve states if the
+    # server versions them. Unless the server still has the given version, in which case no zone is returned
+    @staticmethod
+    def get_zones_valve_info(version=None):
+        logger.debug('Fetching zone valve states from server. Known version: %s', version)
+        params = {'version': version} if version is not None else None
+        try:
+            resp = SprinklerApi.get_api_client().get('/zones/valve', params=params)
+        except SprinklerApi.REQUEST_ERRORS:
+            logger.exception("Error occurred while fetching zone valve states from server")
+            return None
+        if resp.status_code == 304 and version is not None:
+            logger.debug('Zone valve states version %s are up to date', version)
+            return {'zones': [], 'version': version}
+        if resp.status_code == 200:
+            zones_valve = resp.json()
+            logger.debug('Fetched zone valve info from server: %s', zones_valve)
+            if not isinstance(zones_valve, dict) or not isinstance(zones_valve.get('zones'), list):
+                logger.error('Zone valve info received is invalid')
+                return None
+            return zones_valve
+        else:
+            logger.error("Request to obtain zone valve states failed with status %s", resp.status_code)
+            logger.debug("Failed response: Reason: %s, Text: %s", resp.reason, resp.text)
+            return None
+
+    # Notifies the server regarding the latest valve updates of all zones
+    @staticmethod
+    def send_zones_success(zones_info):
+        logger.debug('Sending zone valve state update success to server: %s', zones_info)
+        try:
+            resp = SprinklerApi.get_api_client().post('/zones/valve', json={'zones': zones_info})
+        except SprinklerApi.REQUEST_ERRORS:
+            logger.exception("Error occurred while sending zone valve state update success to server")
+            return None
+        return Valve.read_send_success(resp)
+
+    # Sends the recorded flow data of all zones to the server
+    @staticmethod
+    def send_zones_flow_data(flow_infos):
+        logger.debug('Sending zone flow data to server: %s', flow_infos)
+        try:
+            resp = SprinklerApi.get_api_client().post('/zones/flow', json={'zones': flow_infos})
+        except SprinklerApi.REQUEST_ERRORS:
+            logger.exception("Error occurred while sending zone flow data to server")
+            return None
+        return FlowSensor.read_send_result(resp, 'zone flow data')